@@ -19,8 +19,12 @@ from __future__ import unicode_literals
 
 # standard libs
 import os
-import re
+import time
+import marshal
+from itertools import islice
 from os.path import join, basename, dirname
+from stat import S_ISREG, S_ISDIR
+from threading import RLock
 
 #
 # manage media files
@@ -28,6 +32,11 @@ from os.path import join, basename, dirname
 # tags
 from mediamanager import MediaManager, UnsupportedMediaError
 from mediamanager import stringutils
+from iposonicstore import RecordStore, Journal, MARSHAL_VERSION
+from iposoniccache import ResultCache
+from iposonicindex import (
+    TokenIndex, HashIndex, SortedIndex, SampleIndex, GroupIndex, CountIndex)
+from iposonicquery import QueryPlan
 # logging and json
 import logging
 log = logging.getLogger('iposonic')
@@ -65,10 +74,23 @@ class SubsonicMissingParameterException(SubsonicProtocolException):
 ## The app ;)
 ##
 
+#
+# DAO classes describe the tables shared by the backends:
+#  - __fields__ the list of fields
+#  - __fields_types__ the non-string fields, eg. {'track': int}
+#  - __indexes__ the fields to be indexed by the SQL backends
+#
+# Album songCount and duration, and artist albumCount are
+#  aggregates kept up to date by the backends on every write.
+#  Songs belong to the album albumId.
+#
 class ArtistDAO:
     __tablename__ = "artist"
     __fields__ = ['id', 'name', 'isDir', 'path', 'userRating',
-                  'averageRating', 'coverArt', 'starred', 'created']
+                  'averageRating', 'coverArt', 'starred', 'created',
+                  'albumCount']
+    __fields_types__ = {'userRating': int, 'created': int, 'albumCount': int}
+    __indexes__ = ['starred']
 
     def get_info(self, path_u):
         return {
@@ -86,8 +108,14 @@ class MediaDAO:
                   'genre', 'track', 'tracknumber', 'date', 'suffix',
                   'isvideo', 'duration', 'size', 'bitRate',
                   'userRating', 'averageRating', 'coverArt',
-                  'starred', 'created', 'albumId', 'scrobbleId'  # scrobbleId is an internal parameter used to match songs with last.fm
+                  'starred', 'created', 'albumId', 'scrobbleId',  # scrobbleId is an internal parameter used to match songs with last.fm
+                  'year'
                   ]
+    __fields_types__ = {'track': int, 'size': int, 'bitRate': int,
+                        'created': int, 'userRating': int, 'year': int,
+                        'duration': int, 'albumId': int}
+    __indexes__ = ['parent', 'albumId', 'genre', 'starred', 'created',
+                   'scrobbleId', 'userRating', 'year']
 
 
 class AlbumDAO:
@@ -95,8 +123,20 @@ class AlbumDAO:
     __fields__ = ['id', 'name', 'isDir', 'path', 'title',
                       'parent', 'album', 'artist',
                       'userRating', 'averageRating', 'coverArt',
-                      'starred', 'created'
+                      'starred', 'created', 'artistId', 'songCount', 'duration'
                       ]
+    __fields_types__ = {'userRating': int, 'created': int, 'artistId': int,
+                        'songCount': int, 'duration': int}
+    __indexes__ = ['parent', 'starred', 'created', 'userRating',
+                   'name', ('artist', 'name'), 'artistId']
+    # getAlbumList types sorted by the backend,
+    #  { type: ([fields], is_desc) }
+    __orders__ = {
+        'newest': (['created'], True),
+        'highest': (['userRating'], True),
+        'alphabeticalByName': (['name'], False),
+        'alphabeticalByArtist': (['artist', 'name'], False)
+    }
 
     def get_info(self, path):
         """TODO use path_u directly."""
@@ -113,6 +153,7 @@ class AlbumDAO:
             'parent': MediaManager.uuid(parent),
             'album': dirname_u,
             'artist': basename(parent),
+            'artistId': MediaManager.uuid(parent),
             'coverArt': eid
         }
 
@@ -122,6 +163,7 @@ class PlaylistDAO:
     __fields__ = ['id', 'name', 'comment', 'owner', 'public',
                       'songCount', 'duration', 'created', 'entry'
                       ]
+    __fields_types__ = {'songCount': int, 'duration': int}
 
     def get_info(self, name):
         return {
@@ -136,15 +178,53 @@ class UserDAO:
                   'scrobbleUser', 'scrobblePassword', 'nowPlaying']
 
 
+class DirectoryDAO:
+    """Map every entry id to the table storing it."""
+    __tablename__ = "directory"
+    __fields__ = ['id', 'kind']
+
+
 class UserMediaDAO:
-    """TODO use this table for storing per-user metadata.
+    """Per-user annotations (rating, star) of a song, album or artist.
 
-        Each user should have his own media rating.
-        Queries should get a list of uids from here, then
-        fetch playlist content by mid.
+        The key eid is "uid:mid", so that a user has at most one
+        record per entry. The starred entries of a user are read
+        in order from the (uid, starred, mid) index, the ratings
+        of an entry from the (mid, userRating) one.
     """
     __tablename__ = "usermedia"
     __fields__ = ['eid', 'uid', 'mid', 'userRating', 'starred']
+    __fields_types__ = {'uid': int, 'mid': int, 'userRating': int}
+    __indexes__ = [('uid', 'mid'), ('uid', 'starred', 'mid'), ('mid', 'userRating')]
+    # the annotations: a record without them is removed
+    user_fields = ['userRating', 'starred']
+
+    @staticmethod
+    def get_eid(uid, mid):
+        return "%s:%s" % (uid, mid)
+
+
+class ManifestDAO:
+    """The fingerprint of the path of an entry when it was scanned,
+        see MediaManager.get_fingerprint.
+    """
+    __tablename__ = "manifest"
+    __fields__ = ['id', 'size', 'mtime', 'inode']
+    __fields_types__ = {'size': long, 'mtime': int, 'inode': long}
+
+
+def split_scan_item(item):
+    """Return the (path, album, stat) of an add_paths item.
+
+        An item is a path, a (path, album) or a (path, album, stat),
+        where stat is the os.stat of path if already known, eg. by
+        the walker. A missing stat is None.
+    """
+    if not isinstance(item, tuple):
+        return (item, False, None)
+    if len(item) == 2:
+        return item + (None,)
+    return item
 
 
 class IposonicDBTables:
@@ -210,9 +290,19 @@ class IposonicDB(object, IposonicDBTables):
     """
     log = logging.getLogger('IposonicDB')
 
-    def __init__(self, music_folders, **kwargs):
-        """Initialize using music_folders, and ignore other kwargs."""
+    def __init__(self, music_folders, datadir=None, recreate_db=False, **kwargs):
+        """Initialize using music_folders, and ignore other kwargs.
+
+            datadir: where to persist the entries, see init_db
+            recreate_db: discard the persisted entries
+        """
         self.music_folders = music_folders
+        self.datadir = datadir
+        self.recreate_db = recreate_db
+        # the changes since the last snapshot, opened by init_db
+        self.journal = None
+        # serializes the changes, their journal records and snapshots
+        self.write_lock = RLock()
         #
         # Private data
         #
@@ -220,31 +310,244 @@ class IposonicDB(object, IposonicDBTables):
         #
         # artists = { id: {path:, name: }}
         #
-        self.artists = dict()
+        self.artists = self._create_store(ArtistDAO)
         #
         # albums = { id: {path:, name:, parent: }}
         #
-        self.albums = dict()
+        self.albums = self._create_store(AlbumDAO)
         #
         # songs = { id: {path: ..., {info}} ,   id: {path: , {info}}}
         #
-        self.songs = dict()
+        self.songs = self._create_store(MediaDAO)
         #
         # playlists = { id: {name: .., entry: [], ...}
         self.playlists = dict()
+        #
+        # directory = { id: hash name, eg. 'songs' }
+        #
+        self.directory = dict()
+        #
+        # full-text indexes used by search2, by hash name
+        #
+        self.text_indexes = {
+            'artists': TokenIndex(['name']),
+            'albums': TokenIndex(['title']),
+            'songs': TokenIndex(['title', 'artist', 'album'])
+        }
+        #
+        # secondary indexes on hot equality fields, by hash name
+        #   { 'songs': { 'parent': HashIndex, ..}, .. }
+        #
+        self.field_indexes = {
+            'artists': self._create_field_indexes(['starred']),
+            'albums': self._create_field_indexes(['parent', 'starred', 'artistId']),
+            'songs': self._create_field_indexes([
+                'parent', 'albumId', 'genre', 'scrobbleId', 'starred'])
+        }
+        #
+        # entries kept sorted for paging, by hash name and order
+        #   { 'albums': { 'newest': SortedIndex, ..}, .. }
+        #
+        self.sorted_indexes = {
+            'artists': {},
+            'albums': dict([(k, SortedIndex(fields, reverse=is_desc))
+                            for (k, (fields, is_desc)) in AlbumDAO.__orders__.items()]),
+            'songs': {'highest': SortedIndex(['userRating'], reverse=True)}
+        }
+        #
+        # entry ids for random sampling, by hash name
+        #
+        self.sample_indexes = {
+            'artists': SampleIndex(),
+            'albums': SampleIndex(),
+            'songs': SampleIndex()
+        }
+        #
+        # artists grouped by initial for getIndexes
+        #
+        self.artist_index = GroupIndex('name', f_key=MediaManager.get_sort_name)
+        #
+        # aggregates, by the hash name of the counted entries
+        #   { 'songs': (CountIndex, 'albums', count field, sum field) }
+        #
+        self.aggregates = {
+            'songs': (CountIndex('albumId', 'duration'), 'albums', 'songCount', 'duration'),
+            'albums': (CountIndex('artistId'), 'artists', 'albumCount', None)
+        }
+        #
+        # per-user annotations, see UserMediaDAO
+        #   usermedia = { 'uid:mid': {'uid':, 'mid':, 'starred':, ..} }
+        #   user_starred = { uid: { mid: starred } }
+        #   media_users = { mid: set(uid) }, the users annotating mid
+        #
+        self.usermedia = dict()
+        self.user_starred = dict()
+        self.media_users = dict()
+        #
+        # manifest = { id: (size, mtime, inode) }, see ManifestDAO
+        #
+        self.manifest = dict()
+
+    # fields stored as ids or shared strings by the RecordStores
+    id_fields = ['parent', 'albumId', 'artistId', 'coverArt', 'scrobbleId']
+    symbol_fields = ['artist', 'album', 'genre', 'suffix', 'isDir', 'isVideo']
+
+    # hashes persisted in the snapshot as RecordStores
+    stored_hashes = ['artists', 'albums', 'songs']
+    snapshot_file = "iposonic.snapshot"
+    snapshot_magic = b"IPOSNAP1"
+    journal_file = "iposonic.journal"
+    # write a snapshot when the journal has more records than this
+    #  and than the entries, so that snapshots cost O(1) per change
+    min_checkpoint = 10000
+
+    def _create_store(self, dao):
+        """Return a RecordStore for the entries of dao, written under write_lock."""
+        return RecordStore(dao.__fields__ + ['isVideo'],
+                           ints=getattr(dao, '__fields_types__', {}),
+                           ids=IposonicDB.id_fields,
+                           symbols=IposonicDB.symbol_fields,
+                           factory=IposonicDBTables.BaseB,
+                           lock=self.write_lock)
+
+    @staticmethod
+    def _create_field_indexes(fields):
+        return dict([(f, HashIndex(f)) for f in fields])
 
     def init_db(self):
-        pass
+        """Load the last snapshot in datadir and replay the journal.
+
+            Without datadir the entries are not persisted.
+        """
+        if not self.datadir:
+            return
+        if not os.path.isdir(self.datadir):
+            os.makedirs(self.datadir)
+        (snapshot, journal) = [join(self.datadir, x)
+                               for x in (self.snapshot_file, self.journal_file)]
+        if self.recreate_db:
+            for path in (snapshot, journal):
+                if os.path.isfile(path):
+                    os.unlink(path)
+        with self.write_lock:
+            self.reset()
+            self.load_snapshot(snapshot)
+            journal = Journal(journal)
+            for record in journal.replay():
+                self._replay(record)
+            self.journal = journal
+        self.log.info("Loaded %s entries, %s from the journal" % (
+            len(self.directory), len(journal)))
 
     def end_db(self):
-        pass
+        """Write a snapshot and close the journal."""
+        with self.write_lock:
+            if self.journal is None:
+                return
+            self.checkpoint()
+            self.journal.close()
+            self.journal = None
+
+    def checkpoint(self):
+        """Write a snapshot of the entries and empty the journal.
+
+            The snapshot is replaced atomically: if writing fails,
+            the previous one and the journal are still valid.
+        """
+        with self.write_lock:
+            path = join(self.datadir, self.snapshot_file)
+            try:
+                with open(path + ".tmp", 'wb') as f:
+                    f.write(self.snapshot_magic)
+                    for name in self.stored_hashes:
+                        self.__getattribute__(name).dump(f)
+                    marshal.dump({
+                        'directory': self.directory,
+                        'playlists': dict([(k, dict(v)) for (k, v) in self.playlists.items()]),
+                        'usermedia': self.usermedia,
+                        'manifest': self.manifest
+                    }, f, MARSHAL_VERSION)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(path + ".tmp", path)
+            except (IOError, OSError, ValueError) as e:
+                self.log.exception("Can't write snapshot %s: %s" % (path, e))
+                return False
+            self.journal.truncate()
+            self.log.info("Written snapshot of %s entries" % len(self.directory))
+            return True
+
+    def load_snapshot(self, path):
+        """Load the entries from a snapshot and rebuild the indexes.
+
+            An invalid or outdated snapshot is ignored.
+        """
+        if not os.path.isfile(path):
+            return False
+        try:
+            with open(path, 'rb') as f:
+                if f.read(len(self.snapshot_magic)) != self.snapshot_magic:
+                    raise ValueError("Unsupported snapshot version")
+                for name in self.stored_hashes:
+                    self.__getattribute__(name).load(f)
+                data = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError, KeyError) as e:
+            self.log.warn("Ignoring snapshot %s: %s" % (path, e))
+            self.reset()
+            return False
+        self.directory = data['directory']
+        self.playlists = dict([(k, IposonicDBTables.BaseB(v))
+                               for (k, v) in data['playlists'].items()])
+        for record in data.get('usermedia', {}).values():
+            self.update_usermedia(record['uid'], record['mid'], record)
+        self.manifest = data.get('manifest', {})
+        for name in self.stored_hashes:
+            for eid in self.__getattribute__(name):
+                self._index_entry(name, eid)
+        return True
+
+    def _log(self, *record):
+        """Append a change to the journal, eventually writing a snapshot."""
+        if self.journal is None:
+            return
+        try:
+            self.journal.append(*record)
+        except ValueError as e:
+            self.log.error("Can't journal %s: %s" % (record[:2], e))
+            return
+        if len(self.journal) > max(self.min_checkpoint, len(self.directory)):
+            self.checkpoint()
+
+    def _replay(self, record):
+        """Apply a journal record, see _log."""
+        (op, args) = (record[0], record[1:])
+        try:
+            if op == 'set':
+                # older journals don't have the fingerprint
+                (name, eid, entry, fingerprint) = (args + (None,))[:4]
+                self._set_entry(name, eid, IposonicDBTables.BaseB(entry), fingerprint)
+            elif op == 'update':
+                self.update_entry(*args)
+            elif op == 'delete':
+                self.delete_entry(*args)
+            elif op == 'usermedia':
+                self.update_usermedia(*args)
+        except (KeyError, ValueError) as e:
+            self.log.warn("Skipping journal record %s: %s" % (op, e))
 
     def reset(self):
         self.indexes = dict()
-        self.artists = dict()
-        self.albums = dict()
-        self.songs = dict()
+        for name in ['artists', 'albums', 'songs']:
+            self.__getattribute__(name).reset()
         self.playlists = dict()
+        self.directory = dict()
+        self.usermedia = dict()
+        self.user_starred = dict()
+        self.media_users = dict()
+        self.manifest = dict()
+        for name in self.text_indexes:
+            for index in self._get_indexes(name):
+                index.reset()
 
     def create_entry(self, entry):
         """Add an entry to the persistent store.
@@ -257,20 +560,25 @@ class IposonicDB(object, IposonicDBTables):
             raise NotImplementedError("Only for playlists")
 
         eid = entry.get('id')
-        if eid in hash_:
-            hash_[eid].update(entry)
-        else:
-            hash_[eid] = entry
+        with self.write_lock:
+            if eid in hash_:
+                hash_[eid].update(entry)
+            else:
+                hash_[eid] = entry
+            self.directory[eid] = 'playlists'
+            self._log('set', 'playlists', eid, dict(hash_[eid]))
 
     update_entry = create_entry
 
     @staticmethod
-    def _search(hash_, query, limit=10, key_only=False):
+    def _search(hash_, query, limit=None, key_only=False):
         """return values in hash matching query.
 
             query is a dict, eg {'title': 'Viva l'Italia'}
                 it has two protected words: 'Null' and 'notNull', ex.
                 {'starred' : 'notNull' }
+                and supports the predicates of QueryPlan, ex.
+                {'year': ('range', 1990, 1999)}
             return a list of values or keys:
             [
                 {'id':.., 'name':.., 'path': ..},
@@ -280,69 +588,207 @@ class IposonicDB(object, IposonicDBTables):
         """
         assert query, "Query is required"
         assert hash_, "Hash is required"
-        ret = []
-        for (field, value) in query.items():
-            re_query = re.compile(".*%s.*" % value, re.IGNORECASE)
-
-            def f_get_field(x):
-                try:
-                    value = hash_.get(x).get(field)
-                    return re_query.match(value) is not None
-                except:
-                    pass
-                return False
-
-            def f_is_null(x):
-                try:
-                    return  hash_.get(x).get(field) is None
-                except:
-                    return False
-
-            def f_is_not_null(x):
-                return not f_is_null(x)
-
-            if value == 'isNull':
-                f_filter = f_is_null
-            elif value == 'notNull':
-                f_filter = f_is_not_null
-            else:
-                f_filter = f_get_field
-
-            ret = filter(f_filter, hash_)
-            if not key_only:
-                ret = [hash_[x] for x in ret]
-            return ret
-        raise IposonicException("No entries returned")
+        ret = QueryPlan(hash_, query).select(limit)
+        if key_only:
+            return list(ret)
+        return [hash_[x] for x in ret]
 
     @staticmethod
-    def _get_hash(hash_, eid=None, query=None, order=None):
+    def _get_hash(hash_, eid=None, query=None, order=None, indexes=None,
+                  offset=0, size=None):
+        """Get entries from hash_ by id or matching a query.
+
+            indexes: the indexes used by QueryPlan to
+                resolve the query without scanning hash_.
+            offset, size: the page to return.
+        """
         if eid:
             return hash_.get(eid)
         if query:
-            return IposonicDB._search(hash_, query)
-        return hash_.values()
+            ids = QueryPlan(hash_, query, indexes).select()
+        elif offset or size:
+            ids = iter(hash_)
+        else:
+            return hash_.values()
+        if offset or size:
+            ids = islice(ids, offset or 0, (offset or 0) + size if size else None)
+        # skip the entries deleted in the meantime
+        return filter(None, [hash_.get(k) for k in ids])
 
     def add(self, entry):
         return self.db.add(entry)
 
     def update_entry(self, eid, new):
-        for h in [self.songs, self.artists, self.albums]:
-            record = self._get_hash(h, eid)
-            if record:
-                h[eid].update(new)
-                return
+        name = self.directory.get(eid)
+        if name in ['songs', 'artists', 'albums']:
+            with self.write_lock:
+                self.__getattribute__(name).update_record(eid, new)
+                self._index_entry(name, eid, changed=new)
+                self._log('update', eid, dict(new))
+            return
         raise ValueError(
             "Media Entry (song, artist, album) not found. eid: %s" % eid)
 
-    def get_songs(self, eid=None, query=None):
+    def delete_entry(self, eid):
+        """Delete an entry and its annotations, update indexes and aggregates."""
+        with self.write_lock:
+            name = self.directory.pop(eid, None)
+            if name is None:
+                raise EntryNotFoundException("Missing entry with id: %s " % eid)
+            del self.__getattribute__(name)[eid]
+            self.manifest.pop(eid, None)
+            if name in self.text_indexes:
+                self._index_entry(name, eid)
+            for uid in self.media_users.pop(eid, ()):
+                self.usermedia.pop(UserMediaDAO.get_eid(uid, eid), None)
+                starred = self.user_starred.get(uid, {})
+                starred.pop(eid, None)
+                if not starred:
+                    self.user_starred.pop(uid, None)
+            self._log('delete', eid)
+
+    def delete_paths(self, paths):
+        """Delete the entries of paths and the ones under them,
+            eg. when a directory is removed. Missing paths are skipped.
+
+            Return the list of the deleted ids.
+        """
+        ret = []
+        with self.write_lock:
+            level = [MediaManager.uuid(p) for p in paths]
+            while level:
+                children = []
+                for eid in level:
+                    for name in ('songs', 'albums'):
+                        children.extend(self.field_indexes[name]['parent'].lookup(eid))
+                    if eid in self.directory:
+                        self.delete_entry(eid)
+                        ret.append(eid)
+                level = children
+        return ret
+
+    def _set_entry(self, name, eid, entry, fingerprint=None):
+        """Add or replace an entry of the hash `name` and index it.
+
+            fingerprint: the one of the entry path, see ManifestDAO
+        """
+        self.__getattribute__(name)[eid] = entry
+        self.directory[eid] = name
+        if fingerprint is not None:
+            self.manifest[eid] = tuple(fingerprint)
+        if name in self.text_indexes:
+            self._index_entry(name, eid)
+
+    def _is_unchanged(self, name, eid, fingerprint):
+        """Return True if the entry is stored and its path didn't change since.
+
+            This avoids parsing again the files loaded from a snapshot,
+            and keeps the user fields like starred.
+        """
+        if eid not in self.__getattribute__(name):
+            return False
+        return self.manifest.get(eid) == fingerprint
+
+    def get_fingerprints(self, eids):
+        """Return the fingerprints of the entries eids: { eid: (size, mtime, inode) }."""
+        manifest = self.manifest
+        return dict([(k, manifest[k]) for k in eids if k in manifest])
+
+    def get_entry_by_id(self, eid):
+        """Return an entry (song, album, artist, playlist) by id."""
+        try:
+            return self.__getattribute__(self.directory[eid])[eid]
+        except KeyError:
+            raise EntryNotFoundException("Missing entry with id: %s " % eid)
+
+    def get_songs(self, eid=None, query=None, offset=0, size=None):
         """Return a list of songs in the following form.
 
             [{'id': ..., 'title': ...}]
+
+            offset, size: the page to return.
         """
-        return IposonicDB._get_hash(self.songs, eid, query)
+        return IposonicDB._get_hash(self.songs, eid, query,
+                                    indexes=self._get_query_indexes('songs'),
+                                    offset=offset, size=size)
 
-    def get_albums(self, eid=None, query=None, order=None):
-        return IposonicDB._get_hash(self.albums, eid, query=query, order=order)
+    def get_albums(self, eid=None, query=None, order=None, offset=0, size=None):
+        """Return a page of albums matching query.
+
+            order: an album list type (see AlbumDAO.__orders__)
+                or a (field, is_desc) tuple.
+            offset, size: the page to return.
+        """
+        if eid:
+            return self.albums.get(eid)
+        index = None
+        if isinstance(order, basestring):
+            index = self.sorted_indexes['albums'].get(order)
+        if index:
+            # entries missing the sort fields are not indexed
+            query = dict([(k, v) for (k, v) in (query or {}).items()
+                          if not (k in index.fields and v == 'notNull')])
+            if not query:
+                return [self.albums[k] for k in index.page(offset, size)]
+            plan = QueryPlan(self.albums, query, self._get_query_indexes('albums'))
+            if plan.candidates is None:
+                # walk the index until the page is filled
+                ids = (k for k in index.walk() if plan.accept(k))
+                end = offset + size if size else None
+                return [self.albums[k] for k in islice(ids, offset or 0, end)]
+            # sort the few candidates by their index key
+            ids = sorted([k for k in plan.select() if k in index.entries],
+                         key=index.entries.get, reverse=index.reverse)
+            return [self.albums[k] for k in IposonicDB._get_page(ids, offset, size)]
+
+        ret = IposonicDB._get_hash(self.albums, query=query,
+                                   indexes=self._get_query_indexes('albums'))
+        if isinstance(order, basestring):
+            (fields, is_desc) = AlbumDAO.__orders__.get(order, ([], False))
+        elif order:
+            (fields, is_desc) = ([order[0]], order[1])
+        if order and fields:
+            ret = [x for x in ret if None not in [x.get(f) for f in fields]]
+            ret = sorted(ret, key=lambda x: [x.get(f) for f in fields] + [x['id']],
+                         reverse=bool(is_desc))
+        return IposonicDB._get_page(ret, offset, size)
+
+    @staticmethod
+    def _get_page(items, offset=0, size=None):
+        offset = offset or 0
+        return list(items[offset:offset + size if size else None])
+
+    def get_random_songs(self, size=10, genre=None, fromYear=None, toYear=None, folder=None):
+        """Return size random songs.
+
+            genre: only songs of this genre
+            fromYear, toYear: only songs published in this range
+            folder: only songs in this music folder
+        """
+        (fromYear, toYear) = map(stringutils.to_int, [fromYear, toYear])
+        query = dict()
+        if genre:
+            query['genre'] = ('eq', genre)
+        if fromYear or toYear:
+            query['year'] = ('range', fromYear or None, toYear or None)
+        if folder:
+            query['path'] = ('prefix', join(stringutils.to_unicode(folder), ""))
+        return [self.songs[k] for k in self._sample('songs', size, query)]
+
+    def get_random_albums(self, size=10, folder=None):
+        """Return size random albums, eventually in a music folder."""
+        query = dict()
+        if folder:
+            query['path'] = ('prefix', join(stringutils.to_unicode(folder), ""))
+        return [self.albums[k] for k in self._sample('albums', size, query)]
+
+    def _sample(self, name, size, query):
+        """Return size random ids of the hash `name` matching query."""
+        plan = QueryPlan(self.__getattribute__(name), query,
+                         self._get_query_indexes(name))
+        return self.sample_indexes[name].sample(
+            size, accept=plan.accept if plan.is_filtered() else None,
+            candidates=plan.candidates)
 
     def get_artists(self, eid=None, query=None):
         """This method should trigger a filesystem initialization.
@@ -356,59 +802,223 @@ class IposonicDB(object, IposonicDBTables):
         """
         if not self.artists:
             raise NotImplementedError("rewrite me in scanner thread")
-        return IposonicDB._get_hash(self.artists, eid, query)
+        return IposonicDB._get_hash(self.artists, eid, query,
+                                    indexes=self._get_query_indexes('artists'))
 
     def get_playlists(self, eid=None, query=None):
         return IposonicDB._get_hash(self.playlists, eid, query)
 
+    def _get_query_indexes(self, name):
+        """Return the indexes of the hash `name` usable by QueryPlan, by field.
+
+            SortedIndexes on many fields don't index the entries
+            missing any of them, so they are not used.
+        """
+        ret = dict([(index.fields[0], index) for index in self.sorted_indexes[name].values()
+                    if len(index.fields) == 1])
+        ret.update(self.field_indexes[name])
+        return ret
+
+    def _get_indexes(self, name):
+        """Return all the indexes of the hash `name`."""
+        ret = ([self.text_indexes[name], self.sample_indexes[name]]
+               + self.field_indexes[name].values()
+               + self.sorted_indexes[name].values())
+        if name == 'artists':
+            ret.append(self.artist_index)
+        if name in self.aggregates:
+            ret.append(self.aggregates[name][0])
+        return ret
+
+    def _index_entry(self, name, eid, changed=None):
+        """Update the indexes of the hash `name` for entry eid.
+
+            changed: the updated fields, if None reindex the whole entry.
+        """
+        entry = self.__getattribute__(name).get(eid)
+        for index in self._get_indexes(name):
+            if changed is not None and not set(index.fields) & set(changed):
+                continue
+            if entry is None:
+                index.remove(eid)
+            else:
+                index.add(eid, entry)
+        self._update_aggregates(name, eid)
+
+    def _update_aggregates(self, name, eid):
+        """Copy the changed aggregates to their entries.
+
+            A new entry of the hash `name` gets its aggregates too,
+            eg. an album added after its songs.
+        """
+        for (index, parent, count_f, sum_f) in self.aggregates.values():
+            groups = index.pop_changed()
+            if parent == name:
+                groups.add(eid)
+            hash_ = self.__getattribute__(parent)
+            for group in groups:
+                if group in hash_:
+                    (count, total) = index.get(group)
+                    new = {count_f: count}
+                    if sum_f:
+                        new[sum_f] = total
+                    hash_.update_record(group, new)
+
+    def _search_text(self, name, query, limit):
+        hash_ = self.__getattribute__(name)
+        return [hash_[eid] for eid in self.text_indexes[name].search(query, limit)]
+
+    def search2(self, query, artistCount=10, albumCount=10, songCount=10):
+        """Search artists, albums and songs using the full-text indexes.
+
+            Every token in query should match the beginning of a word,
+            results are ranked and limited to the given count.
+        """
+        return {
+            'artist': self._search_text('artists', query, artistCount),
+            'album': self._search_text('albums', query, albumCount),
+            'title': self._search_text('songs', query, songCount)
+        }
+
     def get_indexes(self):
-        return self.indexes
+        """Return the artists grouped by initial, see GroupIndex.tree."""
+        return self.artist_index.tree()
 
     def get_music_folders(self):
         return self.music_folders
 
-    def get_highest(self):
-        """Return a list of songs. [ { id:, title:, ..} ,..]"""
-        f_sort = lambda x: self.songs.get(x).get('userRating')
-        return sorted(self.songs, key=f_sort, reverse=True)[0:20]
+    def get_highest(self, size=20):
+        """Return the size top rated songs. [ { id:, title:, ..} ,..]
+
+            Like on SQL, unrated songs come last.
+        """
+        index = self.sorted_indexes['songs']['highest']
+        ret = index.page(0, size)
+        if len(ret) < size:
+            # every rated song is in ret, so this skips less than size ids
+            unrated = (k for k in self.songs if k not in index.entries)
+            ret += list(islice(unrated, size - len(ret)))
+        return filter(None, [self.songs.get(k) for k in ret])
 
     def get_song_list(self, eids=[]):
         """return iterable"""
-        ret = []
-        for k in eids:
-            if k is None:
-                continue
-            try:
-                ret.append(self.get_songs(eid=k))
-            except Exception as e:
-                log.exception("error retrieving %s due %s" % (k, e))
-        return ret
+        return self.get_songs_by_ids(eids)
 
-    def add_path(self, path, album=False):
-        """Create an entry from path and add it to the DB."""
-        if os.path.isdir(path):
+    def get_songs_by_ids(self, eids):
+        """Return the songs with the given ids, in the same order.
+
+            Missing ids are skipped.
+        """
+        songs = self.songs
+        return [songs[k] for k in eids if k in songs]
+
+    def add_path(self, path, album=False, info=None, st=None):
+        """Create an entry from path and add it to the DB.
+
+            info: the mediamanager.parse_file info of a file, if already parsed
+            st: the os.stat of path, if already known
+        """
+        try:
+            st = st or os.stat(path)
+        except OSError as e:
+            raise IposonicException(e)
+        if S_ISDIR(st.st_mode):
+            eid = MediaManager.uuid(path)
+            name = 'albums' if album else 'artists'
+            fingerprint = MediaManager.get_fingerprint(path, st)
+            if self._is_unchanged(name, eid, fingerprint):
+                return eid
+            if name == 'artists' and eid in self.artists:
+                # the entry doesn't depend on the directory contents,
+                #  keep it and record the fingerprint for the poller
+                with self.write_lock:
+                    self.manifest[eid] = fingerprint
+                return eid
             self.log.warn(
                 "Adding %s: %s " % ("album" if album else "artist", stringutils.to_unicode(path)))
-            eid = MediaManager.uuid(path)
             if album:
-                self.albums[eid] = IposonicDB.Album(path)
+                entry = IposonicDB.Album(path)
+                entry['created'] = int(st.st_ctime)
             else:
-                self.artists[eid] = IposonicDB.Artist(path)
+                entry = IposonicDB.Artist(path)
+            with self.write_lock:
+                self._set_entry(name, eid, entry, fingerprint)
+                self._log('set', name, eid, dict(entry), fingerprint)
             self.log.info(u"adding directory: %s, %s " % (eid, stringutils.to_unicode(path)))
             return eid
         elif MediaManager.is_allowed_extension(path):
+            eid = MediaManager.uuid(path)
+            fingerprint = MediaManager.get_fingerprint(path, st)
+            if self._is_unchanged('songs', eid, fingerprint):
+                return eid
             try:
-                info = MediaManager.get_info(path)
-                info.update({
-                    'coverArt': MediaManager.cover_art_uuid(info)
-                })
-                self.songs[info['id']] = info
+                if not info:
+                    info = MediaManager.get_info(path, st)
+                    info.update({
+                        'coverArt': MediaManager.cover_art_uuid(info)
+                    })
+                info.setdefault('albumId', info['parent'])
+                with self.write_lock:
+                    self._set_entry('songs', info['id'], info, fingerprint)
+                    self._log('set', 'songs', info['id'], dict(info), fingerprint)
                 self.log.info("adding file: %s, %s " % (info['id'], path))
                 return info['id']
             except UnsupportedMediaError as e:
                 raise IposonicException(e)
         raise IposonicException("Path not found or bad extension: %s " % path)
 
+    def add_paths(self, paths, chunk_size=500, parse=None, written=None):
+        """Add an iterable of path, (path, album) or (path, album, stat),
+            logging errors.
+
+            parse: a function parsing a list of files, see
+                SqliteIposonicDB.add_paths. The new or changed files
+                are parsed chunk_size at a time, otherwise one by one.
+            written: a function called after every chunk_size paths
+                are added, eg. invalidating a cache
+
+            Return the list of the added ids.
+        """
+        ret = []
+        paths = iter(paths)
+        while True:
+            items = []
+            for item in islice(paths, chunk_size):
+                (path, album, st) = split_scan_item(item)
+                if st is None:
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        # add_path logs it
+                        pass
+                items.append((path, album, st))
+            if not items:
+                break
+            parsed = dict()
+            if parse:
+                files = [(path, st) for (path, album, st) in items
+                         if self._is_changed_file(path, st)]
+                if files:
+                    parsed = dict([(x[0], x[1:]) for x in parse(files)])
+            for (path, album, st) in items:
+                (info, error) = parsed.get(path, (None, None))
+                try:
+                    if error:
+                        raise IposonicException(error)
+                    ret.append(self.add_path(path, album, info, st))
+                except Exception as e:
+                    self.log.error("Can't add path: %s" % e)
+            if written:
+                written()
+        return ret
+
+    def _is_changed_file(self, path, st):
+        """Return True if path is a media file to be parsed."""
+        if st is None:
+            return False
+        return S_ISREG(st.st_mode) and MediaManager.is_allowed_extension(path) and not (
+            self._is_unchanged('songs', MediaManager.uuid(path), MediaManager.get_fingerprint(path, st)))
+
     def walk_music_directory_old(self):
         """Find all artists (top-level directories) and create indexes.
 
@@ -454,6 +1064,59 @@ class IposonicDB(object, IposonicDBTables):
         raise NotImplementedError(
             "In-memory datastore doesn't support multiple users")
 
+    #
+    # Per-user annotations
+    #
+    def get_usermedia(self, uid, mids):
+        """Return the annotations of uid on mids: { mid: {'starred':, ..} }."""
+        ret = dict()
+        for mid in mids:
+            record = self.usermedia.get(UserMediaDAO.get_eid(uid, mid))
+            if record:
+                ret[str(mid)] = record
+        return ret
+
+    def update_usermedia(self, uid, mid, new):
+        """Update the annotations of uid on mid, eg. {'starred': None}."""
+        eid = UserMediaDAO.get_eid(uid, mid)
+        with self.write_lock:
+            record = dict(self.usermedia.get(eid) or {'eid': eid, 'uid': uid, 'mid': mid})
+            record.update(new)
+            starred = self.user_starred.setdefault(uid, dict())
+            if record.get('starred'):
+                starred[mid] = record['starred']
+            else:
+                starred.pop(mid, None)
+            if not starred:
+                del self.user_starred[uid]
+            users = self.media_users.setdefault(mid, set())
+            if [f for f in UserMediaDAO.user_fields if record.get(f) is not None]:
+                self.usermedia[eid] = record
+                users.add(uid)
+            else:
+                self.usermedia.pop(eid, None)
+                users.discard(uid)
+            if not users:
+                del self.media_users[mid]
+            self._log('usermedia', uid, mid, dict(new))
+
+    def get_average_rating(self, mid):
+        """Return the average rating of mid over its users, or None."""
+        ratings = [self.usermedia.get(UserMediaDAO.get_eid(uid, mid), {}).get('userRating')
+                   for uid in list(self.media_users.get(mid, ()))]
+        ratings = [x for x in ratings if x]
+        if not ratings:
+            return None
+        return float(sum(ratings)) / len(ratings)
+
+    def get_user_starred(self, uid, name, offset=0, size=None):
+        """Return a page of the entries of hash `name` starred by uid, latest first."""
+        starred = self.user_starred.get(uid, {})
+        mids = sorted([k for k in starred if self.directory.get(k) == name],
+                      key=lambda k: (starred[k], k), reverse=True)
+        hash_ = self.__getattribute__(name)
+        return [hash_[k] for k in IposonicDB._get_page(mids, offset, size)]
+
 
 #
 # IpoSonic
@@ -471,11 +1134,12 @@ class Iposonic:
                         or the included SQL backends (MySQL and Sqlite)
         - recreate_db: a handler for sql storages that delete the previous
                         copy of the db
+        - cache: cache the results of the read methods, see cached
 
         """
     log = logging.getLogger('Iposonic')
 
-    def __init__(self, music_folders, dbhandler=IposonicDB, recreate_db=False, tmp_dir="/tmp/iposonic"):
+    def __init__(self, music_folders, dbhandler=IposonicDB, recreate_db=False, tmp_dir="/tmp/iposonic", cache=True):
         self.log.info("Creating Iposonic with music folders: %s, dbhandler: %s" %
                       (music_folders, dbhandler))
 
@@ -492,6 +1156,7 @@ class Iposonic:
 
         self.db = dbhandler(
             music_folders, recreate_db=recreate_db, datadir=tmp_dir)
+        self.cache = ResultCache(enabled=cache)
         self.log.setLevel(logging.INFO)
 
     def jsonize(fn):
@@ -508,15 +1173,46 @@ class Iposonic:
         tmp.__name__ = fn.__name__
         return tmp
 
+    def cached(*depends):
+        """Cache the results of a read method in self.cache.
+
+            depends: the generations the results depend on,
+                'media' for the entries and 'usermedia'
+                for the user annotations.
+        """
+        def decorator(fn):
+            def tmp(self, *args, **kwds):
+                return self.cache.call(
+                    (fn.__name__, args, kwds), depends, fn, self, *args, **kwds)
+            tmp.__name__ = fn.__name__
+            tmp.__doc__ = fn.__doc__
+            return tmp
+        return decorator
+
+    def invalidates(*depends):
+        """Bump the generations changed by a write method, see cached.
+
+            Generations are bumped after the write, so that
+            a result computed during the write is stale.
+        """
+        def decorator(fn):
+            def tmp(self, *args, **kwds):
+                try:
+                    return fn(self, *args, **kwds)
+                finally:
+                    self.cache.bump(*depends)
+            tmp.__name__ = fn.__name__
+            tmp.__doc__ = fn.__doc__
+            return tmp
+        return decorator
+
     def __getattr__(self, method):
         """Proxies DB methods."""
         if method in [
             #'get_artists',
-            'get_albums',
-            'get_song_list',
+            'get_songs_by_ids',
             'get_music_folders',
             'get_highest',
-            'get_playlists',
             'delete_entry',
             # User management
             'get_users'
@@ -529,11 +1225,53 @@ class Iposonic:
 
         #    raise NotImplementedError("Method not found: %s" % method, e)
 
+    @cached('media')
     @jsonize
     def get_artists(self, *args, **kwds):
         """Render artists in a webapp-able way."""
         return  self.db.get_artists(*args, **kwds)
 
+    @cached('media')
+    def get_albums(self, *args, **kwds):
+        return self.db.get_albums(*args, **kwds)
+
+    @cached('media')
+    def get_playlists(self, *args, **kwds):
+        return self.db.get_playlists(*args, **kwds)
+
+    @cached('media')
+    def get_song_list(self, eids=[]):
+        return self.db.get_song_list(eids)
+
+    @cached('media')
+    def get_artists_index(self):
+        """Return the artists grouped by initial, with their albumCount.
+
+            Used by the id3 browsing: see getArtists.
+        """
+        artists = dict([(a['id'], a) for a in self.get_artists() or []])
+        return {'index': [{
+            'name': index['name'],
+            'artist': [self._format_artist(artists.get(a['id'], a))
+                       for a in index['artist']]
+        } for index in self.db.get_indexes()['index']]}
+
+    @cached('media')
+    def get_artist(self, eid):
+        """Return an artist with its albums, see getArtist."""
+        ret = self._format_artist(self.db.get_entry_by_id(eid))
+        ret['album'] = self.db.get_albums(query={'artistId': eid})
+        return ret
+
+    @staticmethod
+    def _format_artist(artist):
+        return {
+            'id': artist['id'],
+            'name': artist['name'],
+            'coverArt': artist['id'],
+            'albumCount': artist.get('albumCount') or 0
+        }
+
     def get_folder_by_id(self, folder_id):
         """It's ok just because self.db.get_music_folders() are few"""
         for folder in self.db.get_music_folders():
@@ -541,34 +1279,40 @@ class Iposonic:
                 return folder
         raise IposonicException("Missing music folder with id: %s" % folder_id)
 
+    def get_random_songs(self, size=10, genre=None, fromYear=None, toYear=None, musicFolderId=None):
+        """Return size random songs, see IposonicDB.get_random_songs."""
+        folder = self.get_folder_by_id(musicFolderId) if musicFolderId else None
+        return self.db.get_random_songs(size, genre=genre, fromYear=fromYear,
+                                        toYear=toYear, folder=folder)
+
+    def get_random_albums(self, size=10, musicFolderId=None):
+        folder = self.get_folder_by_id(musicFolderId) if musicFolderId else None
+        return self.db.get_random_albums(size, folder=folder)
+
+    @cached('media')
     def get_entry_by_id(self, eid):
-        ret = None
-        for f in [self.get_artists, self.get_albums, self.get_songs]:
-            try:
-                ret = f(eid)
-            except EntryNotFoundException:
-                pass
-            if ret:
-                return ret
-        raise IposonicException("Missing entry with id: %s " % eid)
+        """Return an entry using the db id directory."""
+        ret = self.db.get_entry_by_id(eid)
+        if ret.get('isDir') in [False, 'false']:
+            # add album coverArt to songs, see get_songs
+            ret.update({'coverArt': ret.get('id')})
+        return ret
 
     def get_directory_path_by_id(self, eid):
         """TODO return a single path"""
         info = self.get_entry_by_id(eid)
         return (info['path'], info['path'])
 
-    def get_indexes(self):
+    @cached('media')
+    def get_indexes(self, ifModifiedSince=None):
         """Return subsonic-formatted indexes.
 
-        {'A':
-        [{'artist':
-            {'id': '517674445', 'name': 'Antonello Venditti'}
-            },
-            {'artist': {'id': '-87058509', 'name':
-                'Anthony and the Johnsons'}},
-
+            ifModifiedSince: a lastModified value returned by
+                a previous call. If nothing changed since then,
+                only lastModified is returned.
 
              "indexes": {
+              "lastModified": 1352469545000,
               "index": [
                {    "name": "A",
 
@@ -583,28 +1327,48 @@ class Iposonic:
                  },
 
         """
-        assert self.db.get_indexes()
-        items = []
-        for (name, artists) in self.db.get_indexes().iteritems():
-            items.append(
-                {'name': name, 'artist': [v['artist'] for v in artists]})
-        return {'index': items}
+        ret = self.db.get_indexes()
+        if ifModifiedSince and stringutils.to_int(ifModifiedSince, 0) >= ret['lastModified']:
+            # unchanged since the last poll
+            return {'lastModified': ret['lastModified']}
+        return ret
 
     #
     #   Create Update Delete
     #
 
+    @invalidates('media')
     def add_path(self, path, album=False):
         """Add imageart related stuff here."""
         return self.db.add_path(path, album)
 
-    def delete_entry(self, path):
-        raise NotImplementedError("deleting entry: %s" % path)
+    @invalidates('media')
+    def add_paths(self, paths, parse=None):
+        """Bulk add an iterable of path, (path, album) or (path, album, stat).
+
+            parse: parse the files in bulk, see IposonicDB.add_paths
+
+            The cache is invalidated after every written chunk,
+            so that a scan shows up before its end.
+        """
+        return self.db.add_paths(paths, parse=parse,
+                                 written=lambda: self.cache.bump('media'))
+
+    @invalidates('media')
+    def delete_entry(self, eid):
+        return self.db.delete_entry(eid)
+
+    @invalidates('media')
+    def delete_paths(self, paths):
+        """Bulk delete the entries of paths and the ones under them."""
+        return self.db.delete_paths(paths)
 
+    @invalidates('media')
     def update_entry(self, eid, new):
         """TODO move do db"""
         return self.db.update_entry(eid, new)
 
+    @invalidates('media')
     def create_entry(self, entry):
         return self.db.create_entry(entry)
 
@@ -630,6 +1394,7 @@ class Iposonic:
     # Retrieve
     #
 
+    @cached('media')
     def get_songs(self, eid=None, query=None):
         """return one or more songs.
 
@@ -645,16 +1410,17 @@ class Iposonic:
 
         # add album coverArt to each song
         # XXX find a smart way to get coverArt
-        if songs.__class__.__name__ == 'dict':
+        if isinstance(songs, dict):
             songs.update({'coverArt': songs.get('id')})
             return songs
 
         return [x.update({'coverArt': x.get('id')}) or x for x in songs]
 
-    def get_genre_songs(self, query):
-        songs = []
-        return self.db.get_songs(query={'genre': query})
+    @cached('media')
+    def get_genre_songs(self, query, offset=0, size=None):
+        return self.db.get_songs(query={'genre': query}, offset=offset, size=size)
 
+    @cached('media')
     def search2(self, query, artistCount=10, albumCount=10, songCount=10):
         """Return items matching the query in their principal name.
 
@@ -668,17 +1434,14 @@ class Iposonic:
             }
             TODO return song instead of title
         """
-        # TODO merge them or use sets
-        return {
-            'artist': self.db.get_artists(query={'name': query}),
-            'album': self.db.get_albums(query={'title': query}),
-            'title': self.db.get_songs(query={'title': query})
-        }
-
-    def get_starred(self, artistCount=10, albumCount=10, songCount=10):
-        """Return items matching the query in their principal name.
+        # counts may come straight from the request
+        (artistCount, albumCount, songCount) = [int(x) if x else 10 for x in (
+            artistCount, albumCount, songCount)]
+        return self.db.search2(query, artistCount, albumCount, songCount)
 
-            ex. (song.title | album.title | artist.name) ~ query
+    @cached('media', 'usermedia')
+    def get_starred(self, artistCount=None, albumCount=None, songCount=None, username=None):
+        """Return the items starred by username, latest first.
 
             return:
             {
@@ -687,12 +1450,80 @@ class Iposonic:
                 song: [{}, .. ,{}]
             }
         """
-        query = {'starred': 'notNull'}
-        return {
-            'artist': self.db.get_artists(query=query),
-            'album': self.db.get_albums(query=query),
-            'title': self.db.get_songs(query=query)
-        }
+        # counts may come straight from the request
+        (artistCount, albumCount, songCount) = [int(x) if x else None for x in (
+            artistCount, albumCount, songCount)]
+        uid = self.get_uid(username)
+        return dict([(k, self.annotate(self.db.get_user_starred(uid, name, size=count), username))
+                     for (k, name, count) in [('artist', 'artists', artistCount),
+                                              ('album', 'albums', albumCount),
+                                              ('title', 'songs', songCount)]])
+
+    @cached('media', 'usermedia')
+    def get_starred_albums(self, offset=0, size=None, username=None):
+        """Return a page of the albums starred by username, see getAlbumList."""
+        return self.annotate(self.db.get_user_starred(
+            self.get_uid(username), 'albums', offset=offset, size=size), username)
+
+    #
+    # Per-user annotations, see UserMediaDAO
+    #
+    @staticmethod
+    def get_uid(username):
+        """Return the id of username in the annotations.
+
+            Requests without username share the same annotations.
+        """
+        return MediaManager.uuid(username or "")
+
+    def annotate(self, entries, username=None):
+        """Set starred and userRating of entries to the ones of username.
+
+            The shared values of the entries are removed, so that
+            an entry not annotated by username has none. The average
+            of the users is in averageRating, see set_rating.
+        """
+        usermedia = self.db.get_usermedia(
+            self.get_uid(username), [x['id'] for x in entries])
+        for x in entries:
+            record = usermedia.get(str(x['id'])) or {}
+            for f in UserMediaDAO.user_fields:
+                x.pop(f, None)
+                if record.get(f) is not None:
+                    x[f] = record[f]
+        return entries
+
+    @invalidates('usermedia')
+    def star(self, eid, username=None):
+        # raise if the entry is missing
+        self.db.get_entry_by_id(eid)
+        self.db.update_usermedia(self.get_uid(username), eid, {
+            'starred': time.strftime("%Y-%m-%dT%H:%M:%S")})
+
+    @invalidates('usermedia')
+    def unstar(self, eid, username=None):
+        self.db.update_usermedia(self.get_uid(username), eid, {'starred': None})
+
+    @invalidates('media', 'usermedia')
+    def set_rating(self, eid, rating, username=None):
+        """Set the rating of username from 1 to 5, 0 removes it.
+
+            Rating 5 stars the entry too. The rating of username is
+            stored in its annotations, while the entry gets the
+            average over the users: averageRating, and userRating
+            rounded as the server-wide value used by the highest lists.
+        """
+        # raise if the entry is missing
+        self.db.get_entry_by_id(eid)
+        rating = int(rating) or None
+        new = {'userRating': rating}
+        if rating == 5:
+            new['starred'] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.db.update_usermedia(self.get_uid(username), eid, new)
+        average = self.db.get_average_rating(eid)
+        self.db.update_entry(eid, {
+            'userRating': int(round(average)) if average else None,
+            'averageRating': "%.1f" % average if average else None})
 
     def refresh(self):
         """Find all artists (top-level directories) and create indexes.
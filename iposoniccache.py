@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# iposonic - a micro implementation of the subsonic server API
+#
+# Cache of the results of the Iposonic read methods.
+#
+# license:  AGPL v3
+#
+from __future__ import unicode_literals
+
+from threading import Lock
+from collections import OrderedDict
+
+
+def freeze(x):
+    """Return a hashable version of the arguments x, or raise TypeError."""
+    if isinstance(x, dict):
+        return tuple(sorted([(k, freeze(v)) for (k, v) in x.items()]))
+    if isinstance(x, (list, tuple)):
+        return tuple([freeze(v) for v in x])
+    hash(x)
+    return x
+
+
+def copy_result(x):
+    """Copy the dicts and lists of x, as callers modify the results."""
+    if isinstance(x, dict):
+        # keep the dict subclass, without calling its __init__
+        ret = dict.__new__(x.__class__)
+        for (k, v) in x.iteritems():
+            ret[k] = copy_result(v)
+        return ret
+    if isinstance(x, list):
+        return [copy_result(v) for v in x]
+    return x
+
+
+def get_weight(x):
+    """Return the number of entries in a result, eg. in a list of songs."""
+    if isinstance(x, list):
+        return len(x) or 1
+    if isinstance(x, dict):
+        return sum([get_weight(v) for v in x.values() if isinstance(v, (list, dict))]) or 1
+    return 1
+
+
+class ResultCache(object):
+    """A LRU cache of method results invalidated by generations.
+
+        Every result depends on some generations, eg. 'media', and
+        every write bumps the generations it changes: results computed
+        before the bump are stale and are dropped on lookup.
+
+        size: max number of results
+        max_weight: max number of entries in all the results,
+            see get_weight. Results bigger than a quarter
+            of it are not cached.
+        enabled: if False, just call the methods
+    """
+    def __init__(self, size=1024, max_weight=100000, enabled=True):
+        self.size = size
+        self.max_weight = max_weight
+        self.enabled = enabled
+        self.lock = Lock()
+        # depend -> generation
+        self.generations = dict()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            # key -> (generations, weight, result), least recently used first
+            self.results = OrderedDict()
+            self.weight = 0
+            self.hits = 0
+            self.misses = 0
+
+    def bump(self, *depends):
+        """Invalidate the results depending on these generations."""
+        with self.lock:
+            for depend in depends:
+                self.generations[depend] = self.generations.get(depend, 0) + 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'results': len(self.results), 'weight': self.weight}
+
+    def _put(self, key, generations, weight, result):
+        self.results[key] = (generations, weight, result)
+        self.weight += weight
+        while len(self.results) > self.size or self.weight > self.max_weight:
+            self.weight -= self.results.popitem(last=False)[1][1]
+
+    def call(self, key, depends, fn, *args, **kwds):
+        """Return the cached result of fn(*args, **kwds) or compute it.
+
+            key: identifies fn and its arguments, eg. (method, args)
+            depends: the generations the result depends on
+        """
+        if not self.enabled:
+            return fn(*args, **kwds)
+        try:
+            key = freeze(key)
+        except TypeError:
+            return fn(*args, **kwds)
+
+        cached = None
+        with self.lock:
+            # the generations must be read before computing the result,
+            #  so that a write during fn() makes it stale.
+            generations = tuple([self.generations.get(d, 0) for d in depends])
+            if key in self.results:
+                cached = self.results.pop(key)
+                if cached[0] == generations:
+                    # most recently used
+                    self.results[key] = cached
+                    self.hits += 1
+                else:
+                    self.weight -= cached[1]
+                    cached = None
+            if cached is None:
+                self.misses += 1
+        if cached is not None:
+            # cached results are never modified, copy them unlocked
+            return copy_result(cached[2])
+
+        ret = fn(*args, **kwds)
+        weight = get_weight(ret)
+        if weight <= self.max_weight / 4:
+            result = copy_result(ret)
+            with self.lock:
+                if key in self.results:
+                    self.weight -= self.results.pop(key)[1]
+                self._put(key, generations, weight, result)
+        return ret
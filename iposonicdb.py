@@ -8,7 +8,10 @@
 import os
 import sys
 import time
+import random
+from itertools import islice
 from os.path import join, basename
+from stat import S_ISREG, S_ISDIR
 
 # logging
 import logging
@@ -18,10 +21,12 @@ logging.basicConfig(level=logging.INFO)
 from iposonic import (
     IposonicException, EntryNotFoundException,
     ArtistDAO, AlbumDAO, MediaDAO, PlaylistDAO,
-    UserDAO, UserMediaDAO
+    UserDAO, UserMediaDAO, DirectoryDAO, ManifestDAO, split_scan_item
 )
 from mediamanager import MediaManager, UnsupportedMediaError
-from mediamanager.stringutils import to_unicode
+from mediamanager.stringutils import to_unicode, to_int
+from iposonicindex import tokenize, GroupIndex
+from iposonicquery import Predicate
 
 # add local path for loading _mysqlembedded
 sys.path.insert(0, './lib')
@@ -33,15 +38,18 @@ except:
     pass
 
 # SqlAlchemy for ORM
-from sqlalchemy import Table, Column, Integer, String, MetaData, ForeignKey
-from sqlalchemy import create_engine, desc
+from sqlalchemy import Table, Column, Integer, BigInteger, String, MetaData, ForeignKey
+from sqlalchemy import create_engine, desc, text, select, bindparam
+from sqlalchemy import Index, and_, or_, func, case, literal
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm.query import Query
 from sqlalchemy.ext.declarative import declarative_base, DeclarativeMeta
 from sqlalchemy.exc import ProgrammingError, OperationalError
+from sqlalchemy.pool import NullPool
+from sqlalchemy import event
 
-from threading import Lock
+from threading import RLock, local
 
 
 def synchronized(lock):
@@ -62,32 +70,48 @@ class LazyDeveloperMeta(DeclarativeMeta):
     """This class allows a lazy initialization of DAOs.
 
        Just add __tablename__ and __fields__ attribute to a subclass
-       to associate a table.
+       to associate a table. Column types are taken from __fields_types__
+       (long for 64 bit integers)
+       and indexes are created for the fields in __indexes__: a tuple
+       of fields creates a composite index.
 
        Should subclass DeclarativeMeta because it should contain Base initialization methods.
-
-       TODO: make customizable columns types, but it's ok for small collections ;)
        """
     def __init__(klass, classname, bases, dict_):
         """ Create a new class type.
 
-            DeclarativeMeta stores class attributes in dict_
+            DeclarativeMeta stores class attributes in dict_,
+            while __fields_types__ and __indexes__ may be inherited
+            by the DAO.
          """
+        types = getattr(klass, '__fields_types__', {})
+        indexes = getattr(klass, '__indexes__', [])
         # Additionally, set attributes on the new object.
         is_pk = True
         for name in dict_.get('__fields__', []):
-            if name in ['id', 'duration']:
+            if types.get(name) is long:
+                kol = BigInteger()
+            elif name in ['id', 'duration'] or types.get(name) is int:
                 kol = Integer()
             elif name in ['path', 'entry']:
                 kol = String(192)
             else:
                 kol = String(64)
             setattr(
-                klass, name, Column(name, kol, primary_key=is_pk))
+                klass, name, Column(name, kol, primary_key=is_pk,
+                                    index=(name in indexes)))
             is_pk = False
 
         # Return the new object using super().
-        return DeclarativeMeta.__init__(klass, classname, bases, dict_)
+        ret = DeclarativeMeta.__init__(klass, classname, bases, dict_)
+
+        # Composite indexes need the table columns.
+        if '__fields__' in dict_:
+            for fields in indexes:
+                if isinstance(fields, tuple):
+                    Index("ix_%s_%s" % (klass.__tablename__, "_".join(fields)),
+                          *[klass.__table__.c[f] for f in fields])
+        return ret
 
 Base = declarative_base(metaclass=LazyDeveloperMeta)
 
@@ -106,6 +130,11 @@ class IposonicDBTables:
         """
         __fields__ = []
         log = logging.getLogger(__name__)
+        # fields serialized as integers, while averageRating
+        #  is a decimal string, see Iposonic.set_rating
+        json_ints = ['userrating', 'duration', 'bitrate']
+        # class -> row serializer, see serialize_row
+        serializers = dict()
 
         def json(self):
             """Return a dict/json representation of the public fields of
@@ -139,21 +168,52 @@ class IposonicDBTables:
 #                        #assert title
 #                        v = os.path.join(artist, album, title)
                         pass
-                    elif k.lower() in ['userrating',
-                                       'averagerating',
-                                       'duration',
-                                       'bitrate']:
+                    elif k.lower() in self.json_ints:
                         v = int(v) if v is not None else 0
                     ret.append((k, v))
             return dict(ret)
 
+        @classmethod
+        def columns(klass):
+            """Return the table columns in __fields__ order."""
+            return [klass.__table__.c[k] for k in klass.__fields__]
+
+        @classmethod
+        def serialize_row(klass):
+            """Return a function converting a row of columns()
+                to the dict returned by json().
+
+                The function is generated once per class
+                from __fields__, unrolling the json() loop.
+            """
+            if klass not in klass.serializers:
+                code = ["def serialize(row):", "    ret = {}"]
+                for (i, k) in enumerate(klass.__fields__):
+                    if k.lower() == 'isdir':
+                        value = "(v.lower() == 'true')"
+                    elif k.lower() in klass.json_ints:
+                        value = "int(v)"
+                    else:
+                        value = "v"
+                    code += ["    v = row[%d]" % i,
+                             "    if v is not None:",
+                             "        ret[%r] = %s" % (k, value)]
+                code.append("    return ret")
+                namespace = dict()
+                exec "\n".join(code) in namespace
+                klass.serializers[klass] = namespace['serialize']
+            return klass.serializers[klass]
+
         def get(self, attr, default=None):
             """Expose __dict__.get"""
             return self.__dict__.get(attr, default)
 
         def update(self, dict_):
-            """Expose __dict__.update"""
-            return self.__dict__.update(dict_)
+            """Expose __dict__.update converting integer fields."""
+            types = getattr(self, '__fields_types__', {})
+            return self.__dict__.update([
+                (k, to_int(v) if types.get(k) is int else v)
+                for (k, v) in dict_.items()])
 
         def __repr__(self):
             return "<%s: %s>" % (
@@ -170,12 +230,14 @@ class IposonicDBTables:
     class Media(Base, SerializerMixin, MediaDAO):
         __fields__ = MediaDAO.__fields__
 
-        def __init__(self, path):
+        def __init__(self, path, info=None, st=None):
             """Fill entry using MediaManager.get_info.
 
+                info: the parsed info of path, if already known
+                st: the os.stat of path, if already known
             """
             Base.__init__(self)
-            self.update(MediaManager.get_info(path))
+            self.update(info or MediaManager.get_info(path, st))
 
     class Album(Base, SerializerMixin, AlbumDAO):
         __fields__ = AlbumDAO.__fields__
@@ -201,12 +263,30 @@ class IposonicDBTables:
                 'username': username}
             )
 
+    class Directory(Base, SerializerMixin, DirectoryDAO):
+        __fields__ = DirectoryDAO.__fields__
+
+        def __init__(self, eid, kind):
+            Base.__init__(self)
+            self.update({'id': eid, 'kind': kind})
+
     class UserMedia(Base, SerializerMixin, UserMediaDAO):
         __fields__ = UserMediaDAO.__fields__
 
-        def __init__(self, email, mid):
+        def __init__(self, uid, mid):
             Base.__init__(self)
-            self.update({'email': email, 'mid': mid})
+            self.update({
+                'eid': UserMediaDAO.get_eid(uid, mid),
+                'uid': uid,
+                'mid': mid})
+
+    class Manifest(Base, SerializerMixin, ManifestDAO):
+        __fields__ = ManifestDAO.__fields__
+
+        def __init__(self, eid, fingerprint):
+            Base.__init__(self)
+            (size, mtime, inode) = fingerprint
+            self.update({'id': int(eid), 'size': size, 'mtime': mtime, 'inode': inode})
 
 
 class SqliteIposonicDB(object, IposonicDBTables):
@@ -223,31 +303,94 @@ class SqliteIposonicDB(object, IposonicDBTables):
         - connectable for read
         - transactional for write
 
+        Concurrency model: every read opens its own connection
+        and never takes a lock, while writes are serialized
+        by sql_lock. On sqlite the database runs in WAL mode, so that
+        readers don't block on the writer (eg. the scanner thread)
+        and vice versa.
+
         The DAO part is inherited from IposonicDBTables, containing:
         - Album
         - Artist
         - Media
         - Playlist
         - User
+        - Directory, mapping every entry id to its table
+        - Manifest, the fingerprints of the scanned paths
 
 
     """
     log = logging.getLogger('SqliteIposonicDB')
     engine_s = "sqlite"
-    sql_lock = Lock()
+    # the single writer lock
+    sql_lock = RLock()
+
+    #
+    # FTS5 tables used by search2: { table: [(column, bm25 weight), ..] }
+    #
+    fts_tables = {
+        'artist': [('name', 1.0)],
+        'album': [('title', 1.0)],
+        'song': [('title', 10.0), ('artist', 5.0), ('album', 1.0)]
+    }
+
+    #
+    # indexed text columns compared case-insensitively on sqlite, like
+    #  the HashIndexes of IposonicDB: { table: [column, ..] }
+    #
+    nocase_indexes = {
+        'song': ['genre'],
+        'album': ['name']
+    }
+
+    # fields set by users, preserved when rescanning
+    user_fields = ['userRating', 'averageRating', 'starred']
+
+    # tables whose entries are tracked in the directory
+    directory_tables = ['song', 'album', 'artist', 'playlist']
+
+    # tables annotated by users, by the IposonicDB hash name
+    user_tables = {'artists': 'artist', 'albums': 'album', 'songs': 'song'}
+
+    # max ids in a IN (...) query, sqlite supports up to 999 variables
+    max_variables = 500
+    # bound the keyset pagination cache
+    max_page_keys = 1024
+
+    def _enter(self):
+        """Track nested decorated calls in the current thread.
+
+            Return the nesting depth before the call.
+        """
+        depth = getattr(self.local, 'depth', 0)
+        self.local.depth = depth + 1
+        return depth
+
+    def _exit(self, depth):
+        self.local.depth = depth
+
+    @staticmethod
+    def _is_locked(e):
+        """Busy database errors must not trigger a reset."""
+        return 'locked' in ("%s" % e)
 
-    @synchronized(sql_lock)
     def connectable(fn):
         """add connectable semantics to a method.
 
+            Reads don't take locks. The outermost call closes the
+            thread session, so that the next read doesn't return
+            entries cached before another thread's write.
         """
         def connect(self, *args, **kwds):
             session = self.Session()
             kwds['session'] = session
+            depth = self._enter()
             try:
                 ret = fn(self, *args, **kwds)
                 return ret
             except (ProgrammingError, OperationalError) as e:
+                if self._is_locked(e):
+                    raise
                 self.log.exception(
                     "Corrupted database: removing and recreating", e)
                 self.reset()
@@ -263,42 +406,60 @@ class SqliteIposonicDB(object, IposonicDBTables):
                 self.log.exception(
                     u"error: string: %s, ex: %s" % (ret.__class__, e))
                 raise
+            finally:
+                self._exit(depth)
+                if not depth:
+                    session.close()
         connect.__name__ = fn.__name__
         return connect
 
-    @synchronized(sql_lock)
     def transactional(fn):
         """add transactional semantics to a method.
 
+            Writes are serialized by sql_lock.
         """
         def transact(self, *args, **kwds):
-            session = self.Session()
-            kwds['session'] = session
-            try:
-                ret = fn(self, *args, **kwds)
-                session.commit()
-                return ret
-            except (ProgrammingError, OperationalError) as e:
-                session.rollback()
-                self.log.exception(
-                    "Corrupted database: removing and recreating")
-                self.reset()
-            except Exception as e:
-                session.rollback()
-                if len(args):
-                    ret = to_unicode(args[0])
-                else:
-                    ret = ""
-                self.log.exception(
-                    u"error: string: %s, ex: %s" % (ret.__class__, e))
-                raise
+            with self.sql_lock:
+                session = self.Session()
+                kwds['session'] = session
+                depth = self._enter()
+                try:
+                    ret = fn(self, *args, **kwds)
+                    session.commit()
+                    self.page_keys.clear()
+                    return ret
+                except (ProgrammingError, OperationalError) as e:
+                    session.rollback()
+                    if self._is_locked(e):
+                        raise
+                    self.log.exception(
+                        "Corrupted database: removing and recreating")
+                    self.reset()
+                except Exception as e:
+                    session.rollback()
+                    if len(args):
+                        ret = to_unicode(args[0])
+                    else:
+                        ret = ""
+                    self.log.exception(
+                        u"error: string: %s, ex: %s" % (ret.__class__, e))
+                    raise
+                finally:
+                    self._exit(depth)
         transact.__name__ = fn.__name__
         return transact
 
     def __init__(self, music_folders, dbfile="iposonic1",
                  refresh_interval=60, user="iposonic", passwd="iposonic",
-                 host="localhost", recreate_db=False, datadir="/tmp/iposonic"):
+                 host="localhost", recreate_db=False, datadir="/tmp/iposonic",
+                 chunk_size=500, busy_timeout=30):
         self.music_folders = music_folders
+        # entries per transaction in add_paths
+        self.chunk_size = chunk_size
+        # sqlite: seconds to wait for the writer
+        self.busy_timeout = busy_timeout
+        # per-thread state
+        self.local = local()
 
         # database credentials
         self.dbfile = dbfile
@@ -308,7 +469,10 @@ class SqliteIposonicDB(object, IposonicDBTables):
 
         # sql alchemy db connector
         self.engine = create_engine(
-            self.create_uri(), echo=False, convert_unicode=True, encoding='utf8')
+            self.create_uri(), echo=False, convert_unicode=True, encoding='utf8',
+            **self.create_engine_args())
+        if self.engine_s == 'sqlite' and self.dbfile:
+            event.listen(self.engine, 'connect', self.on_connect)
 
         #self.engine.raw_connection().connection.text_factory = str
         self.Session = scoped_session(sessionmaker(bind=self.engine))
@@ -319,6 +483,14 @@ class SqliteIposonicDB(object, IposonicDBTables):
         self.initialized = False
         self.recreate_db = recreate_db
         self.datadir = datadir
+        self.fts_enabled = False
+        # keyset pagination: (table, order, query, offset) -> last sort key
+        self.page_keys = dict()
+        # getIndexes tree, loaded on first use and updated by writes
+        # under index_lock: artist_serial counts the updates
+        self.artist_index = None
+        self.artist_serial = 0
+        self.index_lock = RLock()
         assert self.log.isEnabledFor(logging.INFO)
 
     def create_uri(self):
@@ -332,98 +504,341 @@ class SqliteIposonicDB(object, IposonicDBTables):
                 self.host,
                 self.dbfile)
 
+    def create_engine_args(self):
+        """On sqlite open a connection per checkout.
+
+            Connections to a database file are cheap and share it
+            in WAL mode, so no connection is ever used by two threads.
+            An in-memory database lives in its connection: it keeps
+            the default pool, one connection per thread.
+        """
+        if self.engine_s != 'sqlite' or not self.dbfile:
+            return {}
+        return {
+            'poolclass': NullPool,
+            'connect_args': {'timeout': self.busy_timeout}
+        }
+
+    @staticmethod
+    def on_connect(dbapi_con, connection_record):
+        """Use WAL, so that readers don't block on the writer."""
+        cursor = dbapi_con.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
     def init_db(self):
-        """On sqlite does nothing."""
+        """On sqlite just create missing tables."""
         if self.recreate_db:
             self.reset()
+        else:
+            Base.metadata.create_all(self.engine)
+            self.create_nocase_indexes()
+            self.create_fts()
 
     def end_db(self):
         pass
 
     def reset(self):
         """Drop and recreate database. Reinstantiate session."""
-        Base.metadata.drop_all(self.engine)
-        Base.metadata.create_all(self.engine)
+        with self.sql_lock:
+            self.drop_fts()
+            Base.metadata.drop_all(self.engine)
+            Base.metadata.create_all(self.engine)
+            self.create_nocase_indexes()
+            self.create_fts()
+            with self.index_lock:
+                self.artist_index = None
+                self.artist_serial += 1
+
+    def create_nocase_indexes(self):
+        """Index the nocase_indexes columns with COLLATE NOCASE on sqlite,
+            so that their case-insensitive comparisons use an index.
+        """
+        if self.engine_s != 'sqlite':
+            return
+        self._execute_script([
+            "CREATE INDEX IF NOT EXISTS ix_%s_%s_nocase ON %s (%s COLLATE NOCASE)"
+            % (table, column, table, column)
+            for (table, columns) in self.nocase_indexes.items() for column in columns])
+
+    #
+    # Full text search
+    #
+    def _execute_script(self, statements):
+        conn = self.engine.connect()
+        trans = conn.begin()
+        try:
+            for sql in statements:
+                conn.execute(sql)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        finally:
+            conn.close()
 
-    def _query_and_format(self, table_o, query, eid=None, order=None, session=None):
+    def drop_fts(self):
+        if self.engine_s != 'sqlite':
+            return
+        self._execute_script(["DROP TABLE IF EXISTS %s_fts" % table
+                              for table in self.fts_tables])
+
+    def create_fts(self):
+        """Create the FTS5 tables indexing artists, albums and songs.
+
+            FTS tables use the original ones as external content and
+            are kept in sync by triggers, so that even bulk updates
+            are indexed.
+
+            Sets self.fts_enabled and returns it. When FTS5 is not
+            available search2 falls back to LIKE queries.
+        """
+        self.fts_enabled = False
+        if self.engine_s != 'sqlite':
+            return self.fts_enabled
+
+        for (table, columns) in self.fts_tables.items():
+            fts = "%s_fts" % table
+            cols = ", ".join([c for (c, w) in columns])
+            new_cols = ", ".join(["new.%s" % c for (c, w) in columns])
+            old_cols = ", ".join(["old.%s" % c for (c, w) in columns])
+            delete_old = (
+                "INSERT INTO %s(%s, rowid, %s) VALUES('delete', old.id, %s);"
+                % (fts, fts, cols, old_cols))
+            insert_new = ("INSERT INTO %s(rowid, %s) VALUES(new.id, %s);"
+                          % (fts, cols, new_cols))
+            is_new = not self.engine.execute(
+                "SELECT name FROM sqlite_master WHERE name = ?", fts).fetchall()
+            try:
+                self._execute_script([
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5("
+                    "%s, content='%s', content_rowid='id')" % (fts, cols, table),
+                    "CREATE TRIGGER IF NOT EXISTS %s_ai AFTER INSERT ON %s "
+                    "BEGIN %s END" % (fts, table, insert_new),
+                    "CREATE TRIGGER IF NOT EXISTS %s_ad AFTER DELETE ON %s "
+                    "BEGIN %s END" % (fts, table, delete_old),
+                    "CREATE TRIGGER IF NOT EXISTS %s_au AFTER UPDATE OF %s ON %s "
+                    "BEGIN %s %s END" % (fts, cols, table, delete_old, insert_new)
+                ])
+                if is_new:
+                    # index pre-existing entries
+                    self._execute_script([
+                        "INSERT INTO %s(%s) VALUES('rebuild')" % (fts, fts)])
+            except OperationalError as e:
+                self.log.warn("FTS5 not available, using LIKE: %s" % e)
+                return self.fts_enabled
+
+        self.fts_enabled = True
+        return self.fts_enabled
+
+    def _query_and_format(self, table_o, query, eid=None, order=None, session=None,
+                          offset=0, limit=None, after=None):
         """Query and return json entries  .
 
            this method can't be use for modifying items
 
         """
         ret = self._query(
-            table_o, query, eid=eid, order=order, session=session)
+            table_o, query, eid=eid, order=order, session=session,
+            offset=offset, limit=limit, after=after, rows=True)
         if eid:
-            return ret.json()
-        if ret:
-            return [r.json() for r in ret]
-        return []
+            if not ret:
+                raise orm.exc.NoResultFound("No row found for id: %s" % eid)
+            return ret[0]
+        return ret
+
+    @staticmethod
+    def _read_rows(table_o, rs, session):
+        """Return the json entries selected by the query rs on table_o.
+
+            Only the table columns are selected with SQLAlchemy Core,
+            and the rows are converted by the table serializer
+            without creating the database objects.
+        """
+        serialize = table_o.serialize_row()
+        return [serialize(row) for row in session.execute(
+            rs.statement.with_only_columns(table_o.columns()))]
 
     #
     # Query a-la-sqlalchemy supporting ordering and filtering
     #
-    def _query(self, table_o, query, eid=None, order=None, session=None):
+    def _query(self, table_o, query, eid=None, order=None, session=None,
+               offset=0, limit=None, after=None, rows=False):
         """Query db and return database objects.
 
+            order: a (field, is_desc) tuple or a list of them
+            offset, limit: the page to return
+            after: the sort key of the last entry of the previous
+                page (see _get_sort_key). If set, the page starts
+                right after it instead of skipping offset rows.
+            rows: return the json entries instead, see _read_rows.
+                The entry by eid is returned in a list.
         """
         assert table_o, "Table must not be null"
-        order_f = None
         qmodel = session.query(table_o)
         if eid:
+            if rows:
+                return self._read_rows(
+                    table_o, qmodel.filter_by(id=eid), session)
             rs = qmodel.filter_by(id=eid).one()
             return rs
 
         # Multiple results support ordering
-        if order:
-            (order_f, is_desc) = order
-            order_f = table_o.__getattribute__(table_o, order_f)
-            self.log.debug("order: %s" % [order])
-            if is_desc:
-                order_f = order_f.desc()
-
-        # TODO does it works with (k,v) = query.popitem()?
-        if query:
-            for (k, v) in query.items():
-                field_o = table_o.__getattribute__(table_o, k)
-                assert field_o, "Field must not be null"
-                if v == 'isNull':
-                    rs = qmodel.filter(field_o == None)
-                elif v == 'notNull':
-                    rs = qmodel.filter(field_o != None)
-                else:
-                    rs = qmodel.filter(field_o.like("%%%s%%" % v))
-        else:
-            rs = qmodel
-        if not rs:
+        order_l = self._get_order(table_o, order)
+        self.log.debug("order: %s" % [order])
+
+        rs = qmodel
+        filters = self._get_filters(table_o, query)
+        if filters:
+            rs = rs.filter(and_(*filters))
+        if after:
+            rs = rs.filter(self._after_key(order_l, after))
+        for (field_o, is_desc) in order_l:
+            rs = rs.order_by(field_o.desc() if is_desc else field_o)
+        if offset and not after:
+            rs = rs.offset(offset)
+        if limit:
+            rs = rs.limit(limit)
+        if rows:
+            return self._read_rows(table_o, rs, session)
+        return rs.all()
+
+    @classmethod
+    def _get_filters(klass, table_o, query):
+        """Return the conditions of all the query predicates.
+
+            query: { field: value }, see iposonicquery.Predicate.
+                Plain values match the integer and indexed columns,
+                and are searched in the other ones.
+
+            String equalities are case-insensitive: on sqlite they use
+            COLLATE NOCASE, except on the indexed columns not in
+            nocase_indexes, eg. parent, whose values are ids.
+            On mysql the default collation is case-insensitive.
+        """
+        ret = []
+        nocase = klass.nocase_indexes.get(table_o.__tablename__, [])
+        for (k, v) in (query or {}).items():
+            predicate = Predicate.parse(k, v)
+            field_o = getattr(table_o, k)
+            is_int = isinstance(table_o.__table__.c[k].type, Integer)
+            is_indexed = k in getattr(table_o, '__indexes__', [])
+            op = predicate.op
+            if op == 'match':
+                op = 'eq' if (is_int or is_indexed) else 'like'
+            if op == 'isNull':
+                ret.append(field_o == None)
+            elif op == 'notNull':
+                ret.append(field_o != None)
+            elif op == 'range':
+                (low, high) = predicate.args
+                if low is not None:
+                    ret.append(field_o >= low)
+                if high is not None:
+                    ret.append(field_o <= high)
+            elif op == 'eq' and is_int:
+                ret.append(field_o == predicate.number)
+            elif op == 'eq':
+                if klass.engine_s == 'sqlite' and (k in nocase or not is_indexed):
+                    field_o = field_o.collate('NOCASE')
+                ret.append(field_o == predicate.args[0])
+            else:
+                pattern = predicate.args[0]
+                if not isinstance(pattern, basestring):
+                    pattern = "%s" % pattern
+                # escape the LIKE wildcards, backslashes are
+                #  string escapes on mysql
+                pattern = pattern.replace("/", "//").replace(
+                    "%", "/%").replace("_", "/_")
+                if op == 'like':
+                    pattern = "%" + pattern
+                ret.append(field_o.like(pattern + "%", escape="/"))
+        return ret
+
+    @staticmethod
+    def _get_order(table_o, order):
+        """Return a list of (column, is_desc) from order.
+
+            The id is added as a tie-breaker, so that
+            the order is total and pages are stable.
+        """
+        if not order:
             return []
-        return  rs.order_by(order_f).all()
+        if isinstance(order, tuple):
+            order = [order]
+        ret = [(getattr(table_o, f), bool(d)) for (f, d) in order]
+        if order[-1][0] != 'id':
+            ret.append((table_o.id, ret[-1][1]))
+        return ret
 
-    def _query_id(self, eid, table=None, session=None):
-        """Get an entry by id. If table is unspecified
-           it will search in any.
+    @staticmethod
+    def _get_sort_key(order_l, record):
+        return tuple([record.get(field_o.key) for (field_o, is_desc) in order_l])
+
+    @staticmethod
+    def _after_key(order_l, key):
+        """Return the condition selecting the rows following key in order_l.
+
+            eg. for [(a, desc), (id, desc)]: a < ka OR (a = ka AND id < kid)
+        """
+        clauses = []
+        for i, (field_o, is_desc) in enumerate(order_l):
+            equals = [f == k for ((f, d), k) in zip(order_l[:i], key)]
+            follows = field_o < key[i] if is_desc else field_o > key[i]
+            clauses.append(and_(*(equals + [follows])))
+        return or_(*clauses)
+
+    def _get_row(self, eid, table=None, session=None):
+        """Return the row of an entry by id, or raise NoResultFound.
+
+            If table is unspecified the entry tables are outer joined
+            to the directory, so that the row is read with a single
+            lookup on the primary keys.
         """
         assert eid, "Missing eid"
-        table_l = [self.Media, self.Album, self.Artist, self.Playlist]
         if table:
-            table_l = [table]
+            return session.query(table).filter_by(id=eid).one()
+        table_l = [self.Media, self.Album, self.Artist, self.Playlist]
+        rs = session.query(*table_l).select_from(self.Directory.__table__)
         for table_o in table_l:
-            qmodel = session.query(table_o)
-            try:
-                rs = qmodel.filter_by(id=eid)
-                if rs.one():
-                    return rs
-            except:
-                pass
-        raise ValueError("Eid not in db: %s" % eid)
+            rs = rs.outerjoin(table_o, table_o.id == self.Directory.id)
+        for row in rs.filter(self.Directory.id == eid).first() or ():
+            if row is not None:
+                return row
+        # entry missing in directory, eg. created by an older
+        #  version of iposonic: search in every table
+        self.log.info("id not in directory: %s" % eid)
+        for table_o in table_l:
+            row = session.query(table_o).filter_by(id=eid).first()
+            if row is not None:
+                return row
+        raise orm.exc.NoResultFound("No row found for id: %s" % eid)
+
+    def get_table(self, kind):
+        """Return the DAO class associated to a table name."""
+        for table_o in [self.Media, self.Album, self.Artist, self.Playlist]:
+            if table_o.__tablename__ == kind:
+                return table_o
+        raise ValueError("Unsupported table: %s" % kind)
+
+    @connectable
+    def get_entry_by_id(self, eid, session=None):
+        """Return an entry (song, album, artist, playlist) by id.
+
+            The table is resolved with a single lookup in the directory.
+        """
+        try:
+            return self._get_row(eid, session=session).json()
+        except orm.exc.NoResultFound:
+            raise EntryNotFoundException("Missing entry with id: %s " % eid)
 
     def _query_top(self, table_o, field_o, limit=20, session=None):
         """Return a list of songs, in json"""
         assert table_o and field_o
         qmodel = session.query(table_o)
         rs = qmodel.order_by(field_o.desc()).limit(limit)
-        if not rs:
-            return []
-        return [r.json() for r in rs.all()]
+        return self._read_rows(table_o, rs, session)
 
     #
     # User management
@@ -445,16 +860,82 @@ class SqliteIposonicDB(object, IposonicDBTables):
     def update_user(self, eid, new, session=None):
         assert session
         self.log.info("get_users: eid: %s, new: %s" % (eid, new))
-        old = self._query_id(
-            eid, table=self.User, session=session).update(new)
-        self.log.info("user found, updating: %s" % old)
+        if not session.query(self.User).filter_by(id=eid).update(new):
+            raise orm.exc.NoResultFound("No row found for id: %s" % eid)
+        self.log.info("user found, updating: %s" % eid)
 
     @transactional
     def delete_user(self, eid, session=None):
         assert session, "Missing Session"
         assert eid, "Missing eid"
-        old = self._query_id(eid, table=self.User, session=session).delete()
+        if not session.query(self.User).filter_by(id=eid).delete():
+            raise orm.exc.NoResultFound("No row found for id: %s" % eid)
         self.log.info("user correctly deleted")
+
+    #
+    # Per-user annotations
+    #
+    @connectable
+    def get_usermedia(self, uid, mids, session=None):
+        """Return the annotations of uid on mids: { mid: {'starred':, ..} }.
+
+            Records are retrieved by key, max_variables at a time.
+        """
+        assert session
+        eids = [UserMediaDAO.get_eid(uid, mid) for mid in mids]
+        ret = dict()
+        for i in range(0, len(eids), self.max_variables):
+            for r in session.query(self.UserMedia).filter(
+                    self.UserMedia.eid.in_(eids[i:i + self.max_variables])).all():
+                ret[str(r.mid)] = r.json()
+        return ret
+
+    @transactional
+    def update_usermedia(self, uid, mid, new, session=None):
+        """Update the annotations of uid on mid, eg. {'starred': None}.
+
+            Records without annotations are removed.
+        """
+        assert session
+        rs = session.query(self.UserMedia).filter_by(
+            eid=UserMediaDAO.get_eid(uid, mid))
+        old = rs.first()
+        record = old.json() if old else dict()
+        record.update(new)
+        if not [f for f in UserMediaDAO.user_fields if record.get(f) is not None]:
+            if old:
+                rs.delete()
+        elif old:
+            rs.update(dict([(k, to_int(v) if k == 'userRating' else v)
+                            for (k, v) in new.items()]))
+        else:
+            entry = self.UserMedia(uid, mid)
+            entry.update(new)
+            session.add(entry)
+
+    @connectable
+    def get_average_rating(self, mid, session=None):
+        """Return the average rating of mid over its users, or None."""
+        assert session
+        um = self.UserMedia
+        ret = session.query(func.avg(um.userRating)).filter(
+            um.mid == to_int(mid)).filter(um.userRating != None).scalar()
+        return float(ret) if ret else None
+
+    @connectable
+    def get_user_starred(self, uid, name, offset=0, size=None, session=None):
+        """Return a page of the entries of hash `name` starred by uid, latest first."""
+        assert session
+        table_o = self.get_table(self.user_tables[name])
+        um = self.UserMedia
+        rs = session.query(table_o).join(um, um.mid == table_o.id).filter(
+            um.uid == to_int(uid)).filter(um.starred != None).order_by(
+                um.starred.desc(), um.mid.desc())
+        if offset:
+            rs = rs.offset(offset)
+        if size:
+            rs = rs.limit(size)
+        return self._read_rows(table_o, rs, session)
     #
     # Media management
     #
@@ -462,36 +943,160 @@ class SqliteIposonicDB(object, IposonicDBTables):
     @connectable
     def get_song_list(self, eids=[], session=None):
         """return iterable"""
-        ret = []
+        return self.get_songs_by_ids(eids)
+
+    @connectable
+    def get_songs_by_ids(self, eids, session=None):
+        """Return the songs with the given ids, in the same order.
+
+            Missing ids are skipped. Songs are retrieved with one
+            IN (...) query every max_variables ids.
+        """
+        assert session
+        ids = []
         for k in eids:
-            if k is None:
-                continue
             try:
-                ret.append(self.get_songs(eid=k))
-            except Exception as e:
-                self.log.warn("error retrieving %s due %s" % (k, e))
-        return ret
+                ids.append(int(k))
+            except (ValueError, TypeError):
+                self.log.warn("skipping bad song id: %s" % k)
+        found = dict()
+        unique = list(set(ids))
+        for i in range(0, len(unique), self.max_variables):
+            chunk = unique[i:i + self.max_variables]
+            for r in self._read_rows(self.Media, session.query(self.Media).filter(
+                    self.Media.id.in_(chunk)), session):
+                found[r['id']] = r
+        self.log.info("get_songs_by_ids: %s/%s" % (len(found), len(unique)))
+        return [found[k] for k in ids if k in found]
 
-    @transactional
-    def get_highest(self, session=None):
-        return self._query_top(self.Media, self.Media.userRating, session=session)
+    @connectable
+    def get_highest(self, size=20, session=None):
+        """Return the size top rated songs, walking the userRating index."""
+        return self._query_top(self.Media, self.Media.userRating, limit=size, session=session)
 
     @connectable
-    def get_songs(self, eid=None, query=None, session=None):
+    def get_songs(self, eid=None, query=None, offset=0, size=None, session=None):
+        """Return a song by eid or the songs matching query.
+
+            offset, size: the page to return, sorted by id.
+        """
         assert session
         self.log.info("get_songs: eid: %s, query: %s" % (eid, query))
-        return self._query_and_format(self.Media, query, eid=eid, session=session)
+        return self._query_and_format(self.Media, query, eid=eid, session=session,
+                                      order=('id', False) if size else None,
+                                      offset=offset, limit=size)
 
     @connectable
-    def get_albums(self, eid=None, query=None, order=None, session=None):
+    def get_albums(self, eid=None, query=None, order=None, offset=0, size=None, session=None):
+        """Return a page of albums matching query.
+
+            order: an album list type (see AlbumDAO.__orders__)
+                or a (field, is_desc) tuple.
+            offset, size: the page to return.
+
+            Clients read album lists page by page, so the sort key
+            of the last album of each page is kept: the next page
+            is then found with an index seek instead of skipping
+            offset rows.
+        """
         self.log.info("get_albums: eid: %s, query: %s" % (eid, query))
-        return self._query_and_format(self.Album, query, eid=eid, order=order, session=session)
+        if eid:
+            return self._query_and_format(self.Album, query, eid=eid, session=session)
+        if isinstance(order, basestring):
+            (fields, is_desc) = self.Album.__orders__[order]
+            query = dict(query or {})
+            query.setdefault(fields[0], 'notNull')
+            order = [(f, is_desc) for f in fields]
+        if not (order and size):
+            return self._query_and_format(self.Album, query, order=order, session=session,
+                                          offset=offset, limit=size)
+
+        order_l = self._get_order(self.Album, order)
+        page = (self.Album.__tablename__, repr(order), repr(sorted((query or {}).items())))
+        after = self.page_keys.get(page + (offset,)) if offset else None
+        ret = self._query(self.Album, query, order=order, session=session,
+                          offset=offset, limit=size, after=after, rows=True)
+        if ret:
+            if len(self.page_keys) > self.max_page_keys:
+                self.page_keys.clear()
+            self.page_keys[page + (offset + len(ret),)] = self._get_sort_key(
+                order_l, ret[-1])
+        return ret
 
     @connectable
     def get_playlists(self, eid=None, query=None, session=None):
         self.log.info("get_playlists: eid: %s, query: %s" % (eid, query))
         return self._query_and_format(self.Playlist, query, eid=eid, session=session)
 
+    @connectable
+    def get_random_songs(self, size=10, genre=None, fromYear=None, toYear=None,
+                         folder=None, session=None):
+        """Return size random songs, see IposonicDB.get_random_songs."""
+        (fromYear, toYear) = map(to_int, [fromYear, toYear])
+        query = dict()
+        if genre:
+            query['genre'] = ('eq', genre)
+        if fromYear or toYear:
+            query['year'] = ('range', fromYear or None, toYear or None)
+        if folder:
+            query['path'] = ('prefix', join(to_unicode(folder), ""))
+        return [r.json() for r in self._sample(self.Media, size, query, session)]
+
+    @connectable
+    def get_random_albums(self, size=10, folder=None, session=None):
+        """Return size random albums, eventually in a music folder."""
+        query = dict()
+        if folder:
+            query['path'] = ('prefix', join(to_unicode(folder), ""))
+        return [r.json() for r in self._sample(self.Album, size, query, session)]
+
+    def _sample(self, table_o, k, query, session):
+        """Return k distinct random rows of table_o matching query.
+
+            Ids are hashes of the paths, so they are spread evenly
+            in their range: a row is picked seeking the first id
+            following a random value, using the primary key. The seek
+            tells if the row matches the query too, and the rows not
+            matching are discarded: so a seek doesn't favour the
+            matching rows following a gap, and a query matching a
+            fraction p of the rows costs about k / p seeks.
+
+            If 4 * k seeks don't find enough rows (eg. there are few
+            rows, or few matching ones), the remaining ones are picked
+            from the ids of the matching rows, selected using the
+            indexes of the query columns, eg. genre and year.
+        """
+        filters = self._get_filters(table_o, query)
+        (lo, hi) = session.query(func.min(table_o.id), func.max(table_o.id)).one()
+        if lo is None:
+            return []
+        if filters:
+            rs = session.query(table_o, case([(and_(*filters), 1)], else_=0))
+        else:
+            rs = session.query(table_o, literal(1))
+        rs = rs.order_by(table_o.id)
+        ret = dict()
+        for i in xrange(4 * k):
+            if len(ret) == k:
+                break
+            row = rs.filter(table_o.id >= random.randint(lo, hi)).first()
+            if row is None:
+                # wrap around
+                row = rs.first()
+            (row, matches) = row
+            if matches:
+                ret[row.id] = row
+        if len(ret) < k:
+            ids = [eid for (eid, ) in session.query(table_o.id).filter(
+                and_(*filters)) if eid not in ret]
+            ids = random.sample(ids, min(k - len(ret), len(ids)))
+            for i in xrange(0, len(ids), self.max_variables):
+                ret.update([(r.id, r) for r in session.query(table_o).filter(
+                    table_o.id.in_(ids[i:i + self.max_variables]))])
+        ret = ret.values()
+        random.shuffle(ret)
+        return ret
+
     @connectable
     def get_artists(self, eid=None, query=None, order=None, session=None):
         """This method should trigger a filesystem initialization.
@@ -502,23 +1107,100 @@ class SqliteIposonicDB(object, IposonicDBTables):
         self.log.info("get_artists: %s" % eid)
         return self._query(self.Artist, query, eid=eid, order=order, session=session)
 
+    @connectable
+    def search2(self, query, artistCount=10, albumCount=10, songCount=10, session=None):
+        """Search artists, albums and songs by their principal name.
+
+            Uses the FTS5 tables ranked by bm25 when available,
+            otherwise LIKE queries. Every token in query should match
+            the beginning of a word.
+        """
+        assert session
+        self.log.info("search2: %s" % query)
+        tokens = tokenize(query)
+        if not tokens:
+            return {'artist': [], 'album': [], 'title': []}
+
+        def f_search_fts(table_o, field_o, limit):
+            table = table_o.__tablename__
+            weights = ", ".join(["%s" % w for (c, w) in self.fts_tables[table]])
+            columns = ", ".join(['%s."%s"' % (table, k) for k in table_o.__fields__])
+            sql = text(
+                "SELECT %(columns)s FROM %(table)s "
+                "JOIN %(table)s_fts ON %(table)s.id = %(table)s_fts.rowid "
+                "WHERE %(table)s_fts MATCH :q "
+                "ORDER BY bm25(%(table)s_fts, %(weights)s) LIMIT :limit"
+                % {'table': table, 'columns': columns, 'weights': weights})
+            # quote tokens to avoid FTS syntax errors
+            match = " ".join(['"%s"*' % t for t in tokens])
+            serialize = table_o.serialize_row()
+            return [serialize(row) for row in session.execute(
+                sql, {'q': match, 'limit': limit})]
+
+        def f_search_like(table_o, field_o, limit):
+            rs = session.query(table_o).filter(
+                field_o.like("%%%s%%" % query)).limit(limit)
+            return self._read_rows(table_o, rs, session)
+
+        f_search = f_search_fts if self.fts_enabled else f_search_like
+
+        return {
+            'artist': f_search(self.Artist, self.Artist.name, artistCount),
+            'album': f_search(self.Album, self.Album.title, albumCount),
+            'title': f_search(self.Media, self.Media.title, songCount)
+        }
+
     def get_indexes(self):
-        """Create a subsonic index getting artists from the database."""
-        #
-        # indexes = { 'A' : {'artist': {'id': .., 'name': ...}}}
-        #
-        indexes = dict()
-        for artist_j in self.get_artists(order=('name', 1)):
-            a = artist_j.get('name')
-            artist_j = artist_j.json()
-            if not a:
-                continue
-            first = a[0:1].upper()
-            try:
-                indexes[first].append({'artist': artist_j})
-            except KeyError:
-                indexes[first] = [{'artist': artist_j}]
-        return indexes
+        """Return a copy of the artists grouped by initial, see GroupIndex.tree.
+
+            The tree is loaded from the database on first use,
+            then kept in sync by the writes. The loading holds
+            sql_lock only to open its read snapshot: if a write
+            happens meanwhile, the loaded tree is not kept.
+        """
+        with self.index_lock:
+            index = self.artist_index
+            if index is not None:
+                return self._copy_tree(index.tree())
+        index = GroupIndex('name', f_key=MediaManager.get_sort_name)
+        table = self.Artist.__table__
+        conn = self.engine.connect()
+        try:
+            with self.sql_lock:
+                # no write is pending, so the snapshot matches serial
+                serial = self.artist_serial
+                rs = conn.execute(select([table.c.id, table.c.name]))
+            for (eid, name) in rs:
+                index.add(eid, {'name': name})
+        finally:
+            conn.close()
+        with self.index_lock:
+            if self.artist_index is None and self.artist_serial == serial:
+                self.artist_index = index
+            return self._copy_tree(index.tree())
+
+    @staticmethod
+    def _copy_tree(tree):
+        return {
+            'lastModified': tree['lastModified'],
+            'index': [{'name': x['name'], 'artist': [dict(a) for a in x['artist']]}
+                      for x in tree['index']]
+        }
+
+    def _update_artist_index(self, eid, entry=None, rename=False):
+        """Update the getIndexes tree, removing eid if entry is None.
+
+            rename: update eid only if it's an artist.
+        """
+        with self.index_lock:
+            self.artist_serial += 1
+            index = self.artist_index
+            if index is None or rename and int(eid) not in index.entries:
+                return
+            if entry is None:
+                index.remove(int(eid))
+            else:
+                index.add(int(eid), entry)
 
     def get_music_folders(self):
         return self.music_folders
@@ -527,6 +1209,8 @@ class SqliteIposonicDB(object, IposonicDBTables):
     def create_entry(self, entry, session=None):
         assert entry, "Entry is null"
         session.merge(entry)
+        if entry.__tablename__ in self.directory_tables:
+            session.merge(self.Directory(entry.get('id'), entry.__tablename__))
         return entry.get('id')
 
     @transactional
@@ -534,27 +1218,146 @@ class SqliteIposonicDB(object, IposonicDBTables):
         assert session, "Missing Session"
         assert eid, "Missing eid"
         assert new, "Missing new object"
-        old = self._query_id(eid, session=session).update(new)
+        row = self._get_row(eid, session=session)
+        parents = None
+        if set(new) & set(['albumId', 'artistId', 'duration']):
+            parents = self._get_parents(row)
+        session.query(row.__class__).filter_by(id=row.id).update(new)
+        if parents:
+            session.flush()
+            self._update_aggregates(session.connection(),
+                                    parents[0] + [new.get('albumId')],
+                                    parents[1] + [new.get('artistId')])
+        if 'name' in new:
+            self._update_artist_index(eid, new, rename=True)
 
     @transactional
     def delete_entry(self, eid, session=None):
         assert session, "Missing Session"
         assert eid, "Missing eid"
-        old = self._query_id(eid, session=session).delete()
+        row = self._get_row(eid, session=session)
+        (album_ids, artist_ids) = self._get_parents(row)
+        session.query(row.__class__).filter_by(id=row.id).delete()
+        session.query(self.Directory).filter_by(id=eid).delete()
+        session.query(self.Manifest).filter_by(id=eid).delete()
+        session.query(self.UserMedia).filter_by(mid=row.id).delete()
+        session.flush()
+        self._update_aggregates(session.connection(), album_ids, artist_ids)
+        self._update_artist_index(eid)
 
     @transactional
-    def add_path(self, path, album=False, session=None):
-        self.log.info("add_path: %s, album=%s" % (path, album))
-        assert session
+    def delete_paths(self, paths, session=None):
+        """Bulk version of delete_entry for the entries of paths
+            and the ones under them, eg. when a directory is removed.
+
+            The entries are found by id, then their children by
+            parent one level at a time, max_variables ids per query.
+            Everything is deleted in a single transaction, with
+            the user annotations of the entries.
+            Missing paths are skipped.
+
+            Return the list of the deleted ids.
+        """
+        assert session, "Missing Session"
+        (song, album, artist) = (self.Media.__table__, self.Album.__table__,
+                                 self.Artist.__table__)
+        ids = set()
+        level = [MediaManager.uuid(p) for p in paths]
+        while level:
+            ids.update([int(x) for x in level])
+            children = []
+            for i in range(0, len(level), self.max_variables):
+                chunk = level[i:i + self.max_variables]
+                for table in (song, album):
+                    children += ["%s" % r[0] for r in session.execute(
+                        select([table.c.id], table.c.parent.in_(chunk)))]
+            level = [x for x in children if int(x) not in ids]
+        ids = list(ids)
+
+        (ret, album_ids, artist_ids) = ([], [], [])
+        for i in range(0, len(ids), self.max_variables):
+            chunk = ids[i:i + self.max_variables]
+            for (table, parent, parent_ids) in [(song, song.c.albumId, album_ids),
+                                                (album, album.c.artistId, artist_ids),
+                                                (artist, None, None)]:
+                columns = [table.c.id] + ([parent] if parent is not None else [])
+                for r in session.execute(select(columns, table.c.id.in_(chunk))):
+                    ret.append("%s" % r[0])
+                    if parent is not None:
+                        parent_ids.append(r[1])
+                    if table is artist:
+                        self._update_artist_index(r[0])
+                session.execute(table.delete().where(table.c.id.in_(chunk)))
+            for table in (self.Directory.__table__, self.Manifest.__table__):
+                session.execute(table.delete().where(table.c.id.in_(chunk)))
+            usermedia = self.UserMedia.__table__
+            session.execute(usermedia.delete().where(usermedia.c.mid.in_(chunk)))
+        self._update_aggregates(session.connection(), album_ids, artist_ids)
+        return ret
+
+    def _get_parents(self, record):
+        """Return the ids of the (albums, artists) whose aggregates
+            depend on record.
+        """
+        if isinstance(record, self.Media):
+            return ([record.get('albumId')], [])
+        if isinstance(record, self.Album):
+            return ([record.get('id')], [record.get('artistId')])
+        if isinstance(record, self.Artist):
+            return ([], [record.get('id')])
+        return ([], [])
+
+    def _update_aggregates(self, conn, album_ids=(), artist_ids=()):
+        """Recompute the aggregates of the given albums and artists.
+
+            Only the songs and albums of the given ids are read,
+            using the albumId and artistId indexes.
+        """
+        song = self.Media.__table__
+        album = self.Album.__table__
+        artist = self.Artist.__table__
+
+        def f_aggregate(column, parent_column, parent):
+            return select([column]).where(
+                parent_column == parent.c.id).correlate(parent).as_scalar()
+
+        for (table, ids, values) in [
+            (album, album_ids, {
+                'songCount': f_aggregate(func.count(song.c.id), song.c.albumId, album),
+                'duration': f_aggregate(func.coalesce(func.sum(song.c.duration), 0),
+                                        song.c.albumId, album)}),
+            (artist, artist_ids, {
+                'albumCount': f_aggregate(func.count(album.c.id), album.c.artistId, artist)})
+        ]:
+            ids = list(set([to_int(x) for x in ids]) - set([None]))
+            for i in range(0, len(ids), self.max_variables):
+                conn.execute(table.update().where(
+                    table.c.id.in_(ids[i:i + self.max_variables])).values(**values))
+
+    def _get_records(self, path, album=False, info=None, st=None):
+        """Parse path and return (eid, record).
+
+            Songs belong to the album of their directory, like
+            on IposonicDB, so that the album aggregates and
+            the getArtist albums match.
+
+            info: the MediaManager.get_info of a file, if already parsed
+            st: the os.stat of path, if already known
+
+            This method doesn't access the database.
+        """
         eid = None
         record = None
-        record_a = None
         if not isinstance(path, unicode):
             path_u = to_unicode(path)
         else:
             path_u = path
+        try:
+            st = st or os.stat(path)
+        except OSError as e:
+            raise IposonicException(e)
 
-        if os.path.isdir(path):
+        if S_ISDIR(st.st_mode):
             eid = MediaManager.uuid(path)
             if album:
                 record = self.Album(path)
@@ -563,14 +1366,8 @@ class SqliteIposonicDB(object, IposonicDBTables):
             self.log.info("adding directory: %s, %s " % (eid, path_u))
         elif MediaManager.is_allowed_extension(path_u):
             try:
-                record = self.Media(path)
-                # Create a virtual album using a mock album id
-                #   every song with the same virtual album (artist,album)
-                #   is tied to it.
-                if record.album != basename(path) and record.artist and record.album:
-                    vpath = join("/", record.artist, record.album)
-                    record_a = self.Album(vpath)
-                    record.albumId = MediaManager.uuid(vpath)
+                record = self.Media(path, info, st)
+                record.albumId = record.parent
                 eid = record.id
                 self.log.info("adding file: %s, %s " % (
                     eid, path_u))
@@ -578,16 +1375,203 @@ class SqliteIposonicDB(object, IposonicDBTables):
                 raise IposonicException(e)
 
         if record and eid:
-            record.update({'created': int(os.stat(path).st_ctime)})
-
-            self.log.info("Adding entry: %s " % record)
-            session.merge(record)
-            if record_a:
-                session.merge(record_a)
-            return eid
+            record.update({'created': int(st.st_ctime)})
+            return (eid, record)
 
         raise IposonicException("Path not found or bad extension: %s " % path)
 
+    @connectable
+    def get_fingerprints(self, eids, session=None):
+        """Return the fingerprints of the entries eids: { eid: (size, mtime, inode) }."""
+        assert session
+        manifest = self.Manifest.__table__
+        ids = list(set([to_int(x) for x in eids]) - set([None]))
+        ret = dict()
+        for i in range(0, len(ids), self.max_variables):
+            for (eid, size, mtime, inode) in session.execute(select(
+                    self.Manifest.columns(),
+                    manifest.c.id.in_(ids[i:i + self.max_variables]))):
+                ret[str(eid)] = (size, mtime, inode)
+        return ret
+
+    @transactional
+    def add_path(self, path, album=False, session=None):
+        """Add or update the entry of path, unless it didn't change since the last scan."""
+        self.log.info("add_path: %s, album=%s" % (path, album))
+        assert session
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            raise IposonicException(e)
+        fingerprint = MediaManager.get_fingerprint(path, st)
+        old = session.query(self.Manifest).get(int(MediaManager.uuid(path)))
+        if old and (old.size, old.mtime, old.inode) == fingerprint:
+            return MediaManager.uuid(path)
+        (eid, record) = self._get_records(path, album, st=st)
+        self.log.info("Adding entry: %s " % record)
+        (album_ids, artist_ids) = ([], [])
+        # update the aggregates of the old and new parents
+        old = session.query(record.__class__).get(int(record.id))
+        for x in filter(None, [old, record]):
+            (albums, artists) = self._get_parents(x)
+            album_ids += albums
+            artist_ids += artists
+        session.merge(record)
+        session.merge(self.Directory(record.id, record.__tablename__))
+        session.merge(self.Manifest(eid, fingerprint))
+        session.flush()
+        self._update_aggregates(session.connection(), album_ids, artist_ids)
+        if isinstance(record, self.Artist):
+            self._update_artist_index(eid, record)
+        return eid
+
+    def add_paths(self, paths, chunk_size=None, parse=None, written=None):
+        """Bulk version of add_path.
+
+            paths is an iterable of path, (path, album) or
+                (path, album, stat), see split_scan_item
+            parse: a function parsing a list of (path, stat) files,
+                returning an iterable of mediamanager.parse_file
+                results in any order, eg. using a multiprocessing pool
+            written: a function called after every committed
+                transaction, eg. invalidating a cache
+
+            Paths are stat'ed and their fingerprints compared with
+            the manifest ones chunk_size at a time: only new or
+            changed files are parsed. Files are parsed outside the lock,
+            then written with executemany, chunk_size entries per
+            transaction. Songs belong to the album of their directory,
+            see _get_records: no album is created from their tags.
+            Paths that can't be added are logged and skipped.
+
+            Return the list of the added ids.
+        """
+        chunk_size = chunk_size or self.chunk_size
+        ret = []
+        chunk = []
+        fingerprints = dict()
+        paths = iter(paths)
+        while True:
+            pending = []
+            for item in islice(paths, chunk_size):
+                (path, album, st) = split_scan_item(item)
+                try:
+                    st = st or os.stat(path)
+                    pending.append((MediaManager.uuid(path), path, album,
+                                    MediaManager.get_fingerprint(path, st), st))
+                except OSError as e:
+                    self.log.error("Can't add path: %s" % e)
+            if not pending:
+                break
+            known = self.get_fingerprints([x[0] for x in pending])
+            parsed = dict()
+            if parse:
+                files = [(x[1], x[4]) for x in pending
+                         if S_ISREG(x[4].st_mode) and known.get(x[0]) != x[3]
+                         and MediaManager.is_allowed_extension(x[1])]
+                if files:
+                    parsed = dict([(x[0], x[1:]) for x in parse(files)])
+            for (eid, path, album, fingerprint, st) in pending:
+                if known.get(eid) == fingerprint:
+                    ret.append(eid)
+                    continue
+                (info, error) = parsed.get(path, (None, None))
+                try:
+                    if error:
+                        raise IposonicException(error)
+                    (eid, record) = self._get_records(path, album, info, st)
+                except Exception as e:
+                    self.log.error("Can't add path: %s" % e)
+                    continue
+                ret.append(eid)
+                fingerprints[eid] = fingerprint
+                chunk.append((record, True))
+                if len(chunk) >= chunk_size:
+                    self._write_records(chunk, fingerprints)
+                    (chunk, fingerprints) = ([], dict())
+                    if written:
+                        written()
+        if chunk:
+            self._write_records(chunk, fingerprints)
+            if written:
+                written()
+        return ret
+
+    def _write_records(self, records, fingerprints=None):
+        """Write a list of (record, overwrite) in a single transaction.
+
+            New records are inserted. Existing records are updated
+            only if overwrite, preserving the user_fields (eg. rating).
+            fingerprints: { eid: fingerprint } to store in the manifest
+        """
+        by_table = dict()
+        for (record, overwrite) in records:
+            # ids are stored as integers
+            by_table.setdefault(record.__table__, dict())[
+                int(record.id)] = (record, overwrite)
+
+        self.log.info("writing %s records" % len(records))
+        (album_ids, artist_ids) = ([], [])
+        with self.sql_lock:
+            conn = self.engine.connect()
+            trans = conn.begin()
+            try:
+                for (table, entries) in by_table.items():
+                    # the parent column is read to update the old parent aggregates
+                    parent = {'song': 'albumId', 'album': 'artistId'}.get(table.name)
+                    columns = [table.c.id] + ([table.c[parent]] if parent else [])
+                    existing = dict([(r[0], r[1:]) for r in conn.execute(
+                        select(columns, table.c.id.in_(entries.keys())))])
+                    inserts = []
+                    updates = []
+                    for (eid, (record, overwrite)) in entries.items():
+                        if eid not in existing or overwrite:
+                            (albums, artists) = self._get_parents(record)
+                            album_ids += albums
+                            artist_ids += artists
+                        if eid not in existing:
+                            inserts.append(dict([(c.key, record.get(c.key))
+                                                 for c in table.columns]))
+                        elif overwrite:
+                            if parent == 'albumId':
+                                album_ids += existing[eid]
+                            elif parent == 'artistId':
+                                artist_ids += existing[eid]
+                            row = dict([(c.key, record.get(c.key))
+                                        for c in table.columns
+                                        if c.key not in self.user_fields + ['id']])
+                            row['_id'] = eid
+                            updates.append(row)
+                    if inserts:
+                        conn.execute(table.insert(), inserts)
+                    if updates:
+                        conn.execute(table.update().where(
+                            table.c.id == bindparam('_id')), updates)
+                    # rewrite the directory entries
+                    directory = self.Directory.__table__
+                    conn.execute(directory.delete().where(
+                        directory.c.id.in_(entries.keys())))
+                    conn.execute(directory.insert(), [
+                        {'id': eid, 'kind': table.name} for eid in entries])
+                if fingerprints:
+                    manifest = self.Manifest.__table__
+                    conn.execute(manifest.delete().where(
+                        manifest.c.id.in_([int(k) for k in fingerprints])))
+                    conn.execute(manifest.insert(), [
+                        dict(zip(ManifestDAO.__fields__, (int(k),) + tuple(v)))
+                        for (k, v) in fingerprints.items()])
+                self._update_aggregates(conn, album_ids, artist_ids)
+                trans.commit()
+                self.page_keys.clear()
+                for (eid, (record, overwrite)) in by_table.get(
+                        self.Artist.__table__, {}).items():
+                    self._update_artist_index(eid, record)
+            except:
+                trans.rollback()
+                raise
+            finally:
+                conn.close()
+
     @transactional
     def walk_music_directory_depecated(self, session=None):
         """Find all artists (top-level directories) and create indexes.
@@ -0,0 +1,531 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# iposonic - a micro implementation of the subsonic server API
+#
+# In-memory indexes used by IposonicDB to avoid
+#  scanning every entry on each request.
+#
+# license:  AGPL v3
+#
+from __future__ import unicode_literals
+
+import re
+import heapq
+import random
+import time
+from bisect import bisect_left, insort
+
+from mediamanager.stringutils import to_unicode, to_int
+
+re_token = re.compile(r"\w+", re.UNICODE)
+
+# postings with up to this many ids are tuples: most tokens and
+#  values match a few entries, and an empty set is 232 bytes
+SMALL_POSTING = 8
+
+
+def tokenize(s):
+    """Return the normalized tokens of a string.
+
+        Tokens are the lowercase alphanumeric words of s.
+    """
+    if not s:
+        return []
+    if not isinstance(s, unicode):
+        s = to_unicode(s)
+    return re_token.findall(s.lower())
+
+
+def shared(value):
+    """Return a shared copy of a string value.
+
+        Indexes keep a value for each entry, eg. its genre: interned
+        values are stored once whatever the number of entries.
+        Unicode values are interned utf-8 encoded, so the lookups
+        must use shared too.
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if type(value) is str:
+        return intern(value)
+    return value
+
+
+def add_posting(postings, key, eid):
+    """Add eid to the ids of key, return True if key is new."""
+    ids = postings.get(key, ())
+    if isinstance(ids, tuple):
+        if eid in ids:
+            return False
+        if len(ids) < SMALL_POSTING:
+            postings[key] = ids + (eid, )
+            return not ids
+        ids = postings[key] = set(ids)
+    ids.add(eid)
+    return False
+
+
+def discard_posting(postings, key, eid):
+    """Remove eid from the ids of key, return True if key is removed.
+
+        Shrinking sets are replaced by tuples, so a lookup may return
+        either: use them as read-only collections.
+    """
+    ids = postings.get(key)
+    if ids is None:
+        return False
+    if isinstance(ids, tuple):
+        ids = tuple([x for x in ids if x != eid])
+    else:
+        ids.discard(eid)
+        if len(ids) <= SMALL_POSTING // 2:
+            ids = tuple(ids)
+    if not ids:
+        del postings[key]
+        return True
+    postings[key] = ids
+    return False
+
+
+class TokenIndex(object):
+    """An inverted index mapping normalized tokens to entry ids.
+
+        fields: the entry fields to index, eg. ['title', 'artist']
+
+        Every query token is matched as a prefix, so that "beat"
+        finds "Beatles". Entries containing all the query tokens
+        are returned, ranked by:
+         - number of tokens matching exactly;
+         - number of tokens of the entry (shorter is better).
+
+        Tokens are shared, and postings are tuples until they grow,
+        see add_posting.
+    """
+    def __init__(self, fields):
+        self.fields = fields
+        self.reset()
+
+    def reset(self):
+        # token -> ids, see add_posting
+        self.postings = dict()
+        # eid -> (token, ..), used for ranking and removing entries
+        self.entries = dict()
+        # sorted tokens for prefix lookup, lazily rebuilt
+        self._vocabulary = None
+
+    def _tokens(self, entry):
+        ret = set()
+        for field in self.fields:
+            value = entry.get(field)
+            if isinstance(value, basestring):
+                ret.update(tokenize(value))
+        return tuple([shared(t) for t in ret])
+
+    def add(self, eid, entry):
+        """Index entry, eventually replacing the previous one."""
+        self.remove(eid)
+        tokens = self._tokens(entry)
+        for t in tokens:
+            if add_posting(self.postings, t, eid):
+                self._vocabulary = None
+        self.entries[eid] = tokens
+
+    def remove(self, eid):
+        for t in self.entries.pop(eid, ()):
+            if discard_posting(self.postings, t, eid):
+                self._vocabulary = None
+
+    def lookup(self, token):
+        """Return the ids of the entries with a token starting with token.
+
+            token: a shared token, see shared
+        """
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self.postings)
+        vocabulary = self._vocabulary
+        i = bisect_left(vocabulary, token)
+        if i < len(vocabulary) and vocabulary[i] == token and (
+                i + 1 == len(vocabulary) or not vocabulary[i + 1].startswith(token)):
+            # exact match, avoid copying
+            return self.postings[token]
+        ret = set()
+        while i < len(vocabulary) and vocabulary[i].startswith(token):
+            ret.update(self.postings[vocabulary[i]])
+            i += 1
+        return ret
+
+    def search(self, query, limit=None):
+        """Return the ids of the best `limit` entries matching query."""
+        tokens = set([shared(t) for t in tokenize(query)])
+        if not tokens:
+            return []
+
+        # intersect starting from the smallest posting
+        postings = sorted([self.lookup(t) for t in tokens], key=len)
+        hits = set(postings[0])
+        for p in postings[1:]:
+            if not hits:
+                return []
+            hits.intersection_update(p)
+
+        def f_rank(eid):
+            entry_tokens = self.entries[eid]
+            exact = len([t for t in tokens if t in entry_tokens])
+            return (-exact, len(entry_tokens), eid)
+
+        if limit is None:
+            return sorted(hits, key=f_rank)
+        return heapq.nsmallest(limit, hits, key=f_rank)
+
+
+class HashIndex(object):
+    """A secondary index mapping a field value to entry ids.
+
+        String values are compared case-insensitively and shared,
+        see add_posting. Entries missing the field are not indexed,
+        so that 'notNull' queries only walk the indexed values.
+    """
+    def __init__(self, field):
+        self.field = field
+        self.fields = [field]
+        self.reset()
+
+    def reset(self):
+        # value -> ids, see add_posting
+        self.values = dict()
+        # eid -> value, used for removing entries
+        self.entries = dict()
+
+    @staticmethod
+    def normalize(value):
+        if isinstance(value, basestring):
+            return shared(value.lower())
+        return value
+
+    def add(self, eid, entry):
+        """Index entry, eventually replacing the previous one."""
+        self.remove(eid)
+        value = entry.get(self.field)
+        if value is None:
+            return
+        value = self.normalize(value)
+        add_posting(self.values, value, eid)
+        self.entries[eid] = value
+
+    def remove(self, eid):
+        if eid not in self.entries:
+            return
+        discard_posting(self.values, self.entries.pop(eid), eid)
+
+    def lookup(self, value):
+        """Return the ids of the entries with field == value,
+            a read-only set or tuple.
+
+            The protected word 'notNull' returns all the indexed ids.
+        """
+        if value == 'notNull':
+            return set(self.entries)
+        return self.values.get(self.normalize(value), ())
+
+
+class SortedIndex(object):
+    """Keep entry ids sorted by the values of some fields.
+
+        fields: the sort fields, eg. ['artist', 'title']
+        reverse: sort in descending order
+
+        Ties are broken by entry id. Entries missing any of the
+        fields are not indexed. A page is read by position,
+        so its cost depends on its size and not on the index one.
+    """
+    def __init__(self, fields, reverse=False):
+        self.fields = fields
+        self.reverse = reverse
+        self.reset()
+
+    def reset(self):
+        # sorted (value, .., eid)
+        self.keys = []
+        # eid -> key, used for removing entries
+        self.entries = dict()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, eid, entry):
+        """Index entry, eventually replacing the previous one."""
+        self.remove(eid)
+        values = tuple(entry.get(f) for f in self.fields)
+        if None in values:
+            return
+        key = values + (eid,)
+        insort(self.keys, key)
+        self.entries[eid] = key
+
+    def remove(self, eid):
+        if eid not in self.entries:
+            return
+        key = self.entries.pop(eid)
+        del self.keys[bisect_left(self.keys, key)]
+
+    def bounds(self, low=None, high=None):
+        """Return the positions (start, end) of the entries
+            with low <= first field <= high. A None bound is open.
+        """
+        (start, end) = (0, len(self.keys))
+        if low is not None:
+            start = self._bisect(lambda v: v < low)
+        if high is not None:
+            end = self._bisect(lambda v: v <= high)
+        return (start, max(start, end))
+
+    def _bisect(self, f_before):
+        """Return the position of the first key whose first value
+            is not f_before.
+        """
+        (lo, hi) = (0, len(self.keys))
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if f_before(self.keys[mid][0]):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def range(self, low=None, high=None):
+        """Return the ids of the entries with low <= first field <= high."""
+        (start, end) = self.bounds(low, high)
+        return [k[-1] for k in self.keys[start:end]]
+
+    def page(self, offset=0, size=None):
+        """Return the ids of the entries from offset to offset + size."""
+        offset = offset or 0
+        if not self.reverse:
+            end = offset + size if size else None
+            return [k[-1] for k in self.keys[offset:end]]
+        end = len(self.keys) - offset
+        if end <= 0:
+            return []
+        start = max(0, end - size) if size else 0
+        return [k[-1] for k in reversed(self.keys[start:end])]
+
+    def walk(self):
+        """Generate the ids in order, reading the keys by position.
+
+            Unlike page the keys are not copied, so stopping after
+            n ids costs O(n). Writers may shift the keys while
+            walking: an id may be skipped, but never returned twice.
+        """
+        keys = self.keys
+        seen = set()
+        i = 0
+        while True:
+            try:
+                key = keys[-1 - i] if self.reverse else keys[i]
+            except IndexError:
+                return
+            i += 1
+            if key[-1] not in seen:
+                seen.add(key[-1])
+                yield key[-1]
+
+
+class SampleIndex(object):
+    """An array of entry ids supporting O(1) updates and random sampling.
+
+        Removed ids are replaced by the last one, so that the
+        array has no holes and a random position is a random entry.
+    """
+    # entries don't need reindexing when their fields change
+    fields = []
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.ids = []
+        # eid -> position in ids
+        self.positions = dict()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, eid, entry=None):
+        if eid in self.positions:
+            return
+        self.positions[eid] = len(self.ids)
+        self.ids.append(eid)
+
+    def remove(self, eid):
+        if eid not in self.positions:
+            return
+        i = self.positions.pop(eid)
+        last = self.ids.pop()
+        if last != eid:
+            self.ids[i] = last
+            self.positions[last] = i
+
+    def sample(self, k, accept=None, candidates=None):
+        """Return k distinct random ids, or less if there aren't enough.
+
+            accept: a function filtering the ids
+            candidates: restrict the sample to this collection of ids,
+                eg. the ones of an indexed predicate
+
+            Without filters this costs O(k). Filtered ids are found
+            by drawing random positions, so a filter accepting a
+            fraction p of the ids costs about k / p draws. Only after
+            as many draws as ids, ie. if the filter accepts about k
+            ids or less, they are all checked.
+        """
+        ids = self.ids if candidates is None else list(candidates)
+        if accept is None:
+            return random.sample(ids, min(k, len(ids)))
+        ret = []
+        seen = set()
+        for i in xrange(len(ids)):
+            eid = ids[random.randrange(len(ids))]
+            if eid in seen:
+                continue
+            seen.add(eid)
+            if accept(eid):
+                ret.append(eid)
+                if len(ret) == k:
+                    return ret
+        ids = [eid for eid in ids if accept(eid)]
+        return random.sample(ids, min(k, len(ids)))
+
+
+class GroupIndex(object):
+    """Entries grouped by initial and sorted by name, eg. the getIndexes tree.
+
+        field: the name field, eg. 'name'
+        f_key: return the sort key of a name, eg. without articles
+
+        The formatted tree is cached until the next change.
+        last_modified is the time of the last change in milliseconds,
+        so that polling clients can skip unchanged trees.
+    """
+    def __init__(self, field, f_key=None):
+        self.field = field
+        self.fields = [field]
+        self.f_key = f_key or (lambda x: x.lower())
+        self.reset()
+
+    def reset(self):
+        # initial -> sorted [(key, eid)]
+        self.groups = dict()
+        # eid -> (initial, key, name)
+        self.entries = dict()
+        self._tree = None
+        self.touch()
+
+    def touch(self):
+        self.last_modified = max(
+            int(time.time() * 1000), getattr(self, 'last_modified', 0) + 1)
+        self._tree = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def get_initial(key):
+        initial = key[:1].upper()
+        return initial if initial.isalpha() else "#"
+
+    def add(self, eid, entry):
+        """Index entry, eventually replacing the previous one."""
+        name = entry.get(self.field)
+        if not name:
+            self.remove(eid)
+            return
+        if eid in self.entries and self.entries[eid][2] == name:
+            return
+        self.remove(eid)
+        key = self.f_key(name)
+        initial = self.get_initial(key)
+        insort(self.groups.setdefault(initial, []), (key, eid))
+        self.entries[eid] = (initial, key, name)
+        self.touch()
+
+    def remove(self, eid):
+        if eid not in self.entries:
+            return
+        (initial, key, name) = self.entries.pop(eid)
+        group = self.groups[initial]
+        del group[bisect_left(group, (key, eid))]
+        if not group:
+            del self.groups[initial]
+        self.touch()
+
+    def tree(self):
+        """Return {'lastModified': .., 'index': [{'name': 'A', 'artist': [..]}, ..]}."""
+        if self._tree is None:
+            self._tree = {
+                'lastModified': self.last_modified,
+                'index': [{
+                    'name': initial,
+                    'artist': [{'id': eid, 'name': self.entries[eid][2]}
+                               for (key, eid) in self.groups[initial]]
+                } for initial in sorted(self.groups, key=lambda x: (x == "#", x))]
+            }
+        return self._tree
+
+
+class CountIndex(object):
+    """Count the entries by group and sum one of their fields.
+
+        field: the group field, eg. 'albumId'
+        sum_field: the field to sum, eg. 'duration'
+
+        Changed groups are collected until pop_changed(), so
+        that the aggregates can be copied to the group entries.
+    """
+    def __init__(self, field, sum_field=None):
+        self.field = field
+        self.sum_field = sum_field
+        self.fields = [f for f in (field, sum_field) if f]
+        self.reset()
+
+    def reset(self):
+        # group -> [count, sum]
+        self.groups = dict()
+        # eid -> (group, value), used for removing entries
+        self.entries = dict()
+        self.changed = set()
+
+    def add(self, eid, entry):
+        """Index entry, eventually replacing the previous one."""
+        self.remove(eid)
+        group = shared(entry.get(self.field))
+        if group is None:
+            return
+        value = 0
+        if self.sum_field:
+            value = to_int(entry.get(self.sum_field), 0)
+        aggregate = self.groups.setdefault(group, [0, 0])
+        aggregate[0] += 1
+        aggregate[1] += value
+        self.entries[eid] = (group, value)
+        self.changed.add(group)
+
+    def remove(self, eid):
+        if eid not in self.entries:
+            return
+        (group, value) = self.entries.pop(eid)
+        aggregate = self.groups[group]
+        aggregate[0] -= 1
+        aggregate[1] -= value
+        if not aggregate[0]:
+            del self.groups[group]
+        self.changed.add(group)
+
+    def get(self, group):
+        """Return (count, sum) of group."""
+        return tuple(self.groups.get(group, (0, 0)))
+
+    def pop_changed(self):
+        ret = self.changed
+        self.changed = set()
+        return ret
@@ -0,0 +1,213 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# iposonic - a micro implementation of the subsonic server API
+#
+# Query planner used by IposonicDB to combine
+#  the predicates of a query using the indexes.
+#
+# license:  AGPL v3
+#
+from __future__ import unicode_literals
+
+from itertools import islice
+
+from mediamanager.stringutils import to_unicode, to_int
+from iposonicindex import HashIndex, SortedIndex
+
+
+class Predicate(object):
+    """A condition on an entry field.
+
+        op is one of:
+        - 'eq': field == value. Strings are compared case-insensitively,
+            integers with to_int(value)
+        - 'prefix': field starts with value, case-insensitively
+        - 'like': field contains value, case-insensitively
+        - 'range': low <= field <= high, a None bound is open
+        - 'isNull', 'notNull'
+        - 'match': 'eq' on integers, 'like' on strings. This is the
+            meaning of a plain value in a query, eg. {'title': 'help'}
+    """
+    ops = ['eq', 'prefix', 'like', 'range', 'isNull', 'notNull', 'match']
+
+    def __init__(self, field, op, *args):
+        if op not in self.ops:
+            raise ValueError("Unsupported operator: %s" % op)
+        self.field = field
+        self.op = op
+        if op == 'range':
+            (low, high) = args
+            args = (self.to_bound(low), self.to_bound(high))
+        elif op not in ('isNull', 'notNull'):
+            (value,) = args
+            self.text = (to_unicode(value) if isinstance(value, basestring)
+                         else "%s" % value).lower()
+            self.number = to_int(value)
+        self.args = args
+
+    @classmethod
+    def parse(klass, field, value):
+        """Return the predicate of a query item.
+
+            value may be a tuple (op, args..), eg. ('range', 1990, 1999),
+            one of the protected words 'isNull' and 'notNull'
+            or a plain value.
+        """
+        if isinstance(value, tuple):
+            return klass(field, *value)
+        if value in ('isNull', 'notNull'):
+            return klass(field, value)
+        return klass(field, 'match', value)
+
+    @staticmethod
+    def to_bound(value):
+        """Integer strings are compared as integers, eg. a fromYear."""
+        if isinstance(value, basestring) and value.lstrip('-').isdigit():
+            return int(value)
+        return value
+
+    def __repr__(self):
+        return "<Predicate: %s %s %s>" % (self.field, self.op, self.args)
+
+    def match(self, value):
+        """Return True if the field value satisfies the predicate."""
+        op = self.op
+        if value is None:
+            return op == 'isNull'
+        if op in ('isNull', 'notNull'):
+            return op == 'notNull'
+        if op == 'range':
+            (low, high) = self.args
+            bound = low if low is not None else high
+            if isinstance(bound, (int, long)) and not isinstance(value, (int, long)):
+                # eg. year="2012-11-03"
+                value = to_int(value)
+                if value is None:
+                    return False
+            return (low is None or low <= value) and (high is None or value <= high)
+        if not isinstance(value, basestring):
+            if op in ('eq', 'match'):
+                return value == self.number
+            value = "%s" % value
+        value = value.lower()
+        if op == 'eq':
+            return value == self.text
+        if op == 'prefix':
+            return value.startswith(self.text)
+        return self.text in value
+
+    def estimate(self, index):
+        """Return the number of ids returned by lookup,
+            or None if index can't resolve the predicate.
+        """
+        if isinstance(index, HashIndex):
+            if self.op == 'eq':
+                return len(index.lookup(self.args[0]))
+            if self.op == 'notNull':
+                return len(index.entries)
+        elif isinstance(index, SortedIndex):
+            if self.op == 'range':
+                (start, end) = index.bounds(*self.args)
+                return end - start
+            if self.op == 'notNull':
+                return len(index)
+        return None
+
+    def lookup(self, index):
+        """Return the ids matching the predicate using index."""
+        if self.op == 'notNull':
+            return index.entries
+        if self.op == 'range':
+            return index.range(*self.args)
+        return index.lookup(self.args[0])
+
+
+class QueryPlan(object):
+    """The evaluation plan of a query on a hash of entries.
+
+        hash_: the entries, eg. IposonicDB.songs
+        query: a dict { field: value }, see Predicate.parse
+        indexes: the indexes of hash_ by field. HashIndexes resolve
+            'eq' and 'notNull' and their plain values are compared
+            with 'eq'; SortedIndexes on a single field resolve
+            'range' and 'notNull'.
+
+        The ids returned by the most selective indexed predicate are
+        the candidates. They are checked against the id sets of the
+        other HashIndexes, then against the remaining predicates
+        reading the entry fields. Without indexed predicates every
+        entry is a candidate.
+    """
+    def __init__(self, hash_, query, indexes=None):
+        self.hash_ = hash_
+        indexes = indexes or {}
+        # RecordStores read a field without materializing the record
+        self.f_value = getattr(hash_, 'get_field', None) or (
+            lambda eid, field: hash_[eid].get(field))
+        # (estimate, predicate, index)
+        indexed = []
+        self.filters = []
+        for (field, value) in query.items():
+            predicate = Predicate.parse(field, value)
+            index = indexes.get(field)
+            if predicate.op == 'match' and isinstance(index, HashIndex):
+                predicate = Predicate(field, 'eq', *predicate.args)
+            size = predicate.estimate(index)
+            if size is None:
+                self.filters.append(predicate)
+            else:
+                indexed.append((size, predicate, index))
+        indexed.sort(key=lambda x: x[0])
+
+        self.candidates = None
+        # id sets of the other indexed predicates
+        self.id_sets = []
+        if indexed:
+            (size, predicate, index) = indexed[0]
+            self.candidates = predicate.lookup(index)
+        for (size, predicate, index) in indexed[1:]:
+            if isinstance(index, HashIndex):
+                self.id_sets.append(predicate.lookup(index))
+            else:
+                self.filters.append(predicate)
+
+    def is_filtered(self):
+        """Return True if the candidates need to be checked by accept."""
+        return bool(self.id_sets or self.filters)
+
+    def accept(self, eid):
+        """Return True if the candidate eid matches the query."""
+        for ids in self.id_sets:
+            if eid not in ids:
+                return False
+        try:
+            for predicate in self.filters:
+                if not predicate.match(self.f_value(eid, predicate.field)):
+                    return False
+        except KeyError:
+            # removed in the meantime
+            return False
+        return True
+
+    def select(self, limit=None):
+        """Generate the ids of the matching entries, up to limit.
+
+            The candidates are checked while iterating, so that the
+            caller may stop after a page. Writers may change the index
+            of the candidates, so only that set is copied; the id sets
+            of the other indexes are just read.
+        """
+        if self.candidates is None:
+            # RecordStores iterate a copy of their keys
+            ret = iter(list(self.hash_) if isinstance(self.hash_, dict) else self.hash_)
+        elif isinstance(self.candidates, list):
+            # eg. a SortedIndex range, already a copy
+            ret = iter(self.candidates)
+        else:
+            ret = iter(list(self.candidates))
+        if self.is_filtered():
+            ret = (eid for eid in ret if self.accept(eid))
+        if limit:
+            ret = islice(ret, limit)
+        return ret
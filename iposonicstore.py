@@ -0,0 +1,393 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# iposonic - a micro implementation of the subsonic server API
+#
+# Compact in-memory record storage used by IposonicDB,
+#  and its snapshot and journal files.
+#
+# license:  AGPL v3
+#
+from __future__ import unicode_literals
+
+import os
+import struct
+import marshal
+from array import array
+from threading import RLock
+
+from mediamanager.stringutils import to_unicode
+
+# marks a missing value in the integer columns
+NULL = -2 ** 63
+
+# marshal format of the snapshot headers and journal records
+MARSHAL_VERSION = 2
+
+
+class RecordStore(object):
+    """A mapping eid -> record storing the records by column.
+
+        fields: the record fields, eg. MediaDAO.__fields__
+        ints: the integer fields, stored in arrays
+        ids: the id fields, eg. 'parent'. Ids are numeric strings,
+            stored as integers and returned as strings.
+        symbols: the low-cardinality fields, eg. 'genre', whose
+            values are shared between records
+        factory: the class of the returned records
+        lock: the lock held by the writers, eg. IposonicDB.write_lock
+
+        Other strings are stored utf-8 encoded and returned as unicode.
+        Integer strings in the ints fields are returned as integers,
+        like the SQL backends do. Values that don't fit their column
+        (eg. year='mock_year') and unknown fields are kept in a
+        per-record dict.
+
+        Records are materialized when read, so changing a returned
+        record doesn't change the store: use update_record.
+        Records are read under lock, so that a record being written
+        is never returned. Iterators walk a snapshot of the keys and
+        skip the records deleted in the meantime.
+    """
+    def __init__(self, fields, ints=(), ids=(), symbols=(), factory=dict, lock=None):
+        self.kinds = dict()
+        for field in fields:
+            if field == 'id':
+                # the id is the key
+                continue
+            if field in ids:
+                self.kinds[field] = 'id'
+            elif field in ints:
+                self.kinds[field] = 'int'
+            elif field in symbols:
+                self.kinds[field] = 'symbol'
+            else:
+                self.kinds[field] = 'text'
+        self.factory = factory
+        self.lock = lock or RLock()
+        self.reset()
+
+    def reset(self):
+        # key -> row
+        self.rows = dict()
+        # rows of deleted records, reused by the new ones
+        self.free = []
+        self.size = 0
+        self.columns = dict([(field, array(b'l') if kind in ('id', 'int') else [])
+                             for (field, kind) in self.kinds.items()])
+        # row -> {field: value}
+        self.extras = dict()
+        # value -> shared value, for symbols
+        self.symbols = dict()
+
+    @staticmethod
+    def _key(eid):
+        """Numeric ids are stored as integers."""
+        try:
+            key = int(eid)
+        except (TypeError, ValueError):
+            return eid
+        if key == eid or str(key) == eid:
+            return key
+        return eid
+
+    @staticmethod
+    def _eid(key):
+        if isinstance(key, (int, long)):
+            return str(key)
+        return key
+
+    def _allocate(self):
+        if self.free:
+            return self.free.pop()
+        for (field, column) in self.columns.items():
+            column.append(NULL if self.kinds[field] in ('id', 'int') else None)
+        self.size += 1
+        return self.size - 1
+
+    def _clear(self, row):
+        for (field, column) in self.columns.items():
+            column[row] = NULL if self.kinds[field] in ('id', 'int') else None
+        self.extras.pop(row, None)
+
+    def _set(self, row, field, value):
+        """Store value in its column or in the record extras."""
+        extras = self.extras.get(row)
+        if extras and field in extras:
+            del extras[field]
+            if not extras:
+                del self.extras[row]
+        kind = self.kinds.get(field)
+        if kind is None:
+            if value is not None:
+                self.extras.setdefault(row, dict())[field] = value
+            return
+        column = self.columns[field]
+        stored = self._encode(kind, value)
+        if stored is None and value is not None:
+            self.extras.setdefault(row, dict())[field] = value
+        if kind in ('id', 'int'):
+            column[row] = NULL if stored is None else stored
+        else:
+            column[row] = stored
+
+    def _encode(self, kind, value):
+        """Return the value to store in a column, or None if it doesn't fit."""
+        if value is None or isinstance(value, bool):
+            return None
+        if kind in ('id', 'int'):
+            try:
+                ret = int(value)
+            except (TypeError, ValueError):
+                return None
+            if not (-NULL > ret > NULL):
+                return None
+            if isinstance(value, basestring):
+                return ret if str(ret) == value else None
+            if kind == 'int' and ret == value:
+                return ret
+            return None
+        if not isinstance(value, basestring):
+            return None
+        if kind == 'symbol':
+            return self.symbols.setdefault(value, value)
+        return to_unicode(value).encode('utf-8')
+
+    def _get(self, row, field):
+        kind = self.kinds.get(field)
+        if kind is not None:
+            value = self.columns[field][row]
+            if kind in ('id', 'int'):
+                if value != NULL:
+                    return str(value) if kind == 'id' else value
+            elif value is not None:
+                return value.decode('utf-8') if kind == 'text' else value
+        extras = self.extras.get(row)
+        if extras:
+            return extras.get(field)
+        return None
+
+    def _record(self, key, row):
+        ret = self.factory()
+        ret['id'] = self._eid(key)
+        # inlined _get, as this is the hot path of every read
+        columns = self.columns
+        for (field, kind) in self.kinds.iteritems():
+            value = columns[field][row]
+            if kind == 'text':
+                if value is not None:
+                    ret[field] = value.decode('utf-8')
+            elif kind == 'symbol':
+                if value is not None:
+                    ret[field] = value
+            elif value != NULL:
+                ret[field] = str(value) if kind == 'id' else value
+        extras = self.extras.get(row)
+        if extras:
+            ret.update(extras)
+        return ret
+
+    #
+    # dict-like interface
+    #
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, eid):
+        return self._key(eid) in self.rows
+
+    def __iter__(self):
+        # copying the keys is atomic, iterating the dict is not
+        for key in list(self.rows):
+            yield self._eid(key)
+
+    def keys(self):
+        return list(self)
+
+    def __getitem__(self, eid):
+        key = self._key(eid)
+        with self.lock:
+            return self._record(key, self.rows[key])
+
+    def get(self, eid, default=None):
+        key = self._key(eid)
+        with self.lock:
+            if key not in self.rows:
+                return default
+            return self._record(key, self.rows[key])
+
+    def _iterrecords(self):
+        """Generate the (key, record) of a snapshot of the rows."""
+        for (key, row) in self.rows.items():
+            with self.lock:
+                # skip the rows deleted or reused since the snapshot
+                if self.rows.get(key) != row:
+                    continue
+                record = self._record(key, row)
+            yield (key, record)
+
+    def itervalues(self):
+        for (key, record) in self._iterrecords():
+            yield record
+
+    def values(self):
+        return list(self.itervalues())
+
+    def iteritems(self):
+        for (key, record) in self._iterrecords():
+            yield (self._eid(key), record)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __setitem__(self, eid, entry):
+        """Add or replace a record."""
+        key = self._key(eid)
+        with self.lock:
+            row = self.rows.get(key)
+            if row is None:
+                row = self._allocate()
+            else:
+                self._clear(row)
+            for (field, value) in entry.items():
+                if field != 'id':
+                    self._set(row, field, value)
+            # publish the row once written
+            self.rows[key] = row
+
+    def __delitem__(self, eid):
+        with self.lock:
+            row = self.rows.pop(self._key(eid))
+            self._clear(row)
+            self.free.append(row)
+
+    #
+    # field access without materializing the records
+    #
+    def update_record(self, eid, new):
+        """Update some fields of a record, like dict.update."""
+        with self.lock:
+            row = self.rows[self._key(eid)]
+            for (field, value) in new.items():
+                if field != 'id':
+                    self._set(row, field, value)
+
+    def get_field(self, eid, field):
+        """Return the value of a field of a record."""
+        key = self._key(eid)
+        if field == 'id':
+            return self._eid(key) if key in self.rows else None
+        with self.lock:
+            return self._get(self.rows[key], field)
+
+    #
+    # snapshot
+    #
+    def dump(self, f):
+        """Write the store to the file f.
+
+            Integer columns are written as raw arrays,
+            the rest is marshalled in a header.
+        """
+        ints = sorted([field for (field, kind) in self.kinds.items()
+                       if kind in ('id', 'int')])
+        marshal.dump({
+            'kinds': self.kinds,
+            'itemsize': array(b'l').itemsize,
+            'size': self.size,
+            'rows': self.rows,
+            'free': self.free,
+            'extras': self.extras,
+            'columns': dict([(field, column) for (field, column) in self.columns.items()
+                             if field not in ints])
+        }, f, MARSHAL_VERSION)
+        for field in ints:
+            self.columns[field].tofile(f)
+
+    def load(self, f):
+        """Replace the store with the one written by dump.
+
+            Raise ValueError if the file was written by a store
+            with different fields.
+        """
+        header = marshal.load(f)
+        if header['kinds'] != self.kinds or header['itemsize'] != array(b'l').itemsize:
+            raise ValueError("Snapshot fields don't match the store ones")
+        self.reset()
+        (self.size, self.rows, self.free, self.extras) = [
+            header[k] for k in ('size', 'rows', 'free', 'extras')]
+        self.columns.update(header['columns'])
+        for field in sorted(self.kinds):
+            if self.kinds[field] in ('id', 'int'):
+                self.columns[field].fromfile(f, self.size)
+            elif self.kinds[field] == 'symbol':
+                # share the symbols again
+                column = self.columns[field]
+                for (row, value) in enumerate(column):
+                    if value is not None:
+                        column[row] = self.symbols.setdefault(value, value)
+
+
+class Journal(object):
+    """An append-only file of records, eg. the changes since a snapshot.
+
+        Records are tuples of marshallable values, written with
+        their length so that a record truncated by a crash
+        is detected and discarded on replay.
+    """
+    header = struct.Struct(b'<I')
+
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+        # records appended since the last truncate
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def replay(self):
+        """Generate the records in the journal, then open it for appending."""
+        if os.path.isfile(self.path):
+            with open(self.path, 'rb') as f:
+                end = 0
+                while True:
+                    data = f.read(self.header.size)
+                    if len(data) < self.header.size:
+                        break
+                    (size,) = self.header.unpack(data)
+                    data = f.read(size)
+                    if len(data) < size:
+                        break
+                    try:
+                        record = marshal.loads(data)
+                    except (EOFError, ValueError, TypeError):
+                        break
+                    end = f.tell()
+                    self.count += 1
+                    yield record
+            # drop a partially written record
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+        self.open()
+
+    def open(self):
+        if self.f is None:
+            self.f = open(self.path, 'ab')
+
+    def append(self, *record):
+        data = marshal.dumps(record, MARSHAL_VERSION)
+        self.f.write(self.header.pack(len(data)) + data)
+        self.f.flush()
+        self.count += 1
+
+    def truncate(self):
+        """Empty the journal, eg. after a snapshot."""
+        self.f.seek(0)
+        self.f.truncate()
+        self.count = 0
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
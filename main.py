@@ -18,6 +18,7 @@ logging.basicConfig(level=logging.INFO)
 
 import sys
 import os
+import atexit
 os.path.supports_unicode_filenames = True
 import argparse
 from threading import Thread
@@ -91,10 +92,29 @@ def run(argc, argv):
         '--rename-non-utf8', dest='rename_non_utf8', action=None, type=bool,
         const=True, default=False, nargs='?',
         help='Rename non utf8 files to utf8 guessing encoding. When false, iposonic support only utf8 filenames.')
+    parser.add_argument(
+        '--scan-processes', dest='scan_processes', action=None, type=int,
+        default=0, metavar='N',
+        help='Parse the media files with N processes. Default is 0: the number of cores.')
+    parser.add_argument(
+        '--watch', dest='watch', action=None, type=bool,
+        const=True, default=False, nargs='?',
+        help='Watch the music folders with inotify, so that new music shows up in seconds. Requires pyinotify.')
+    parser.add_argument(
+        '--rescan-interval', dest='rescan_interval', action=None, type=int,
+        default=0, metavar='SECONDS',
+        help='Poll the music folders for changes every SECONDS, eg. on NFS where inotify does not work. Default is 0: disabled.')
 
     args = parser.parse_args()
     print(args)
 
+    if args.watch:
+        try:
+            import pyinotify
+        except ImportError:
+            parser.error("--watch requires pyinotify: install it"
+                         " or poll the folders with --rescan-interval")
+
     if args.profile:
         yappize()
 
@@ -103,9 +123,17 @@ def run(argc, argv):
     for x in args.collection:
         assert(os.path.isdir(x)), "Missing music folder: %s" % x
 
+    #
+    # Fork the parser processes before starting any thread
+    #
+    from scanner import create_pool
+    pool = create_pool(args.scan_processes)
+
     app.iposonic = Iposonic(args.collection, dbhandler=Dbh,
                             recreate_db=args.resetdb, tmp_dir=args.tmp_dir)
     app.iposonic.db.init_db()
+    # eventually persist the in-memory db
+    atexit.register(app.iposonic.db.end_db)
 
     # While developing don't enforce authentication
     #   otherwise you can use a credential file
@@ -137,7 +165,25 @@ def run(argc, argv):
     #
     from scanner import walk_music_folder
     for i in range(1):
-        t = Thread(target=walk_music_folder, args=[app.iposonic])
+        t = Thread(target=walk_music_folder,
+                   args=[app.iposonic, args.scan_processes, pool])
+        t.daemon = True
+        t.start()
+
+    #
+    # Run inotify watcher
+    #
+    if args.watch:
+        from scanner import watch_music_folder
+        watch_music_folder(app.iposonic)
+
+    #
+    # Run poller thread
+    #
+    if args.rescan_interval > 0:
+        from scanner import DirectoryPoller
+        poller = DirectoryPoller(app.iposonic, interval=args.rescan_interval)
+        t = Thread(target=poller.run, args=[])
         t.daemon = True
         t.start()
 
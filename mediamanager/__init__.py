@@ -12,6 +12,7 @@ import os
 import sys
 import logging
 from binascii import crc32
+from stat import S_ISDIR
 
 from os.path import dirname, basename, join
 
@@ -34,6 +35,26 @@ def get_cover_art_from_file(path):
             img.write(artwork)
 
 
+def parse_file(path, st=None):
+    """Parse a media file, eg. in a multiprocessing pool.
+
+        st: the os.stat of path, if already known
+
+        Return (path, info, error): info is the MediaManager.get_info
+        of path with its coverArt, error the message of the exception
+        raised while parsing. Errors are returned as strings,
+        as not every exception can be pickled.
+    """
+    try:
+        info = MediaManager.get_info(path, st)
+        if not info:
+            raise UnsupportedMediaError("Missing header in file: %s" % path)
+        info['coverArt'] = MediaManager.cover_art_uuid(info)
+        return (path, info, None)
+    except Exception as e:
+        return (path, None, "%s" % e)
+
+
 class MediaManager:
     """Class to manage media object."""
     ALLOWED_FILE_EXTENSIONS = ["mp3", "ogg", "wma"]
@@ -45,6 +66,7 @@ class MediaManager:
     re_notes = re.compile('\((.+)\)')
     re_notes_2 = re.compile(b'\[.+\]')
     re_notascii = re.compile("[^A-Za-z0-9]")
+    re_year = re.compile("(?<![0-9])([0-9]{4})(?![0-9])")
 
     stopwords = set(['i', 'the'])
 
@@ -65,6 +87,17 @@ class MediaManager:
         MediaManager.log.debug("normalize_artist(%s): %s" % (x, ret))
         return ret
 
+    @staticmethod
+    def get_sort_name(name):
+        """Return the sort key of an artist name, ignoring leading articles.
+
+            eg. "The Beatles" -> "beatles"
+        """
+        words = name.lower().split()
+        if len(words) > 1 and words[0] in MediaManager.stopwords:
+            words = words[1:]
+        return " ".join(words)
+
     @staticmethod
     def normalize_album(x):
         """Return the normalized album name.
@@ -109,6 +142,18 @@ class MediaManager:
             data = path.encode('utf-8')
         return str(crc32(data))
 
+    @staticmethod
+    def get_fingerprint(path, info=None):
+        """Return the (size, mtime, inode) of path.
+
+            Paths with the same fingerprint of the last scan
+            are not parsed again.
+
+            info: the os.stat of path, if already known
+        """
+        info = info or os.stat(path)
+        return (info.st_size, int(info.st_mtime), info.st_ino)
+
     @staticmethod
     def is_allowed_extension(file_name):
         for e in MediaManager.ALLOWED_FILE_EXTENSIONS:
@@ -185,8 +230,12 @@ class MediaManager:
         }
 
     @staticmethod
-    def get_info_from_filename2(path_u):
-        """Get from an existing file: title, artist, album"""
+    def get_info_from_filename2(path_u, st=None, is_dir=False):
+        """Get from an existing file: title, artist, album
+
+            st: the os.stat of path_u, if already known
+            is_dir: parse a directory name, eg. an album, without stat'ing it
+        """
         filename = basename(path_u)
 
         # strip extension
@@ -229,12 +278,18 @@ class MediaManager:
             elif not artist:
                 album, artist = x, album
 
-        try:
-            size = os.path.getsize(path_u)
-        except:
-            size = -1
+        if is_dir:
+            size = None
+        elif st:
+            (size, is_dir) = (st.st_size, S_ISDIR(st.st_mode))
+        else:
+            try:
+                size = os.path.getsize(path_u)
+            except:
+                size = -1
+            is_dir = isdir(path_u)
 
-        if not 'track' in ret and not isdir(path_u):
+        if not 'track' in ret and not is_dir:
             try:
                 t, n = title.split(" ", 1)
                 track = int(t)
@@ -263,7 +318,7 @@ class MediaManager:
         """
         #if not os.path.isdir(path_u):
         #    raise UnsupportedMediaError("Path is not an Album: %s" % path_u)
-        return MediaManager.get_info_from_filename2(path_u).get('title')
+        return MediaManager.get_info_from_filename2(path_u, is_dir=True).get('title')
 
         MediaManager.log.info("parsing album path: %s" % path_u)
         title = basename(path_u)
@@ -279,8 +334,12 @@ class MediaManager:
         return title
 
     @staticmethod
-    def get_info(path):
+    def get_info(path, st=None):
         """Get id3 or ogg info from a file.
+
+           st: the os.stat of path, if already known. Otherwise
+            path is stat'ed once.
+
            "bitRate": 192,
            "contentType": "audio/mpeg",
            "duration": 264,
@@ -293,8 +352,9 @@ class MediaManager:
         if True:  # os.path.isfile(path):
             try:
                 path_u = to_unicode(path)
+                st = st or os.stat(path)
                 # get basic info
-                ret = MediaManager.get_info_from_filename2(path)
+                ret = MediaManager.get_info_from_filename2(path, st)
 
                 manager = MediaManager.get_tag_manager(path)
                 audio = manager(path.encode('utf-8'))
@@ -309,7 +369,10 @@ class MediaManager:
                 ret['isDir'] = 'false'
                 ret['isVideo'] = 'false'
                 ret['parent'] = MediaManager.uuid(dirname(path))
-                ret['created'] = int(os.stat(path).st_ctime)
+                ret['created'] = int(st.st_ctime)
+                year = MediaManager.get_year(ret)
+                if year:
+                    ret['year'] = year
 
                 try:
                     ret['bitRate'] = audio.info.bitrate / 1000
@@ -357,6 +420,20 @@ class MediaManager:
                 except ID3NoHeaderError as e:
                     MediaManager.log.warn("Media has no id3 header: %s" % path)
 
+    @staticmethod
+    def get_year(x):
+        """Return the year of the year or date tags, eg. 2012 from
+            date=2012-11-03, or None.
+        """
+        for field in ['year', 'date']:
+            value = x.get(field)
+            if isinstance(value, (int, long)):
+                return value
+            m_year = MediaManager.re_year.search(value or "")
+            if m_year:
+                return int(m_year.group(1))
+        return None
+
     @staticmethod
     def get_track_number(x):
         """Return track info searching it in various parameters."""
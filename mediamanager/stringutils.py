@@ -17,6 +17,8 @@ from os.path import dirname, basename, join
 trace = False
 log = logging.getLogger(__name__)
 
+re_int = re.compile(r"^\s*(-?[0-9]+)")
+
 encodings = ['utf-8', 'ascii', 'latin_1', 'iso8859_15', 'cp850',
              'cp037', 'cp1252']
 
@@ -72,3 +74,19 @@ def to_unicode(s, getencoding=False):
         except UnicodeDecodeError:
             pass
     raise UnicodeDecodeError("Cannot decode object: %s" % s.__class__)
+
+
+def to_int(s, default=None):
+    """Return the integer value of s or of its leading digits.
+
+        eg. 2012, "2012" and "2012-11-03" all return 2012.
+        If s can't be converted, return default.
+    """
+    try:
+        return int(s)
+    except (ValueError, TypeError):
+        pass
+    m = re_int.match(s) if isinstance(s, basestring) else None
+    if m:
+        return int(m.group(1))
+    return default
@@ -3,13 +3,27 @@
 from __future__ import unicode_literals
 import os
 import sys
+import time
 import logging
-from os.path import join, basename
+from stat import S_ISDIR, S_ISREG
+from os.path import join, basename, dirname, normpath
 
-#from pyinotify import ProcessEvent, WatchManager, IN_DELETE, IN_CREATE, ThreadedNotifier
+try:
+    from pyinotify import (ProcessEvent, WatchManager, ThreadedNotifier,
+                           IN_CLOSE_WRITE, IN_CREATE, IN_DELETE, IN_MOVED_FROM, IN_MOVED_TO)
+except ImportError:
+    # inotify is not available, eg. on NFS use DirectoryPoller
+    (ProcessEvent, WatchManager) = (object, None)
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
 from mediamanager.stringutils import to_unicode
 from Queue import Queue
-from mediamanager import stringutils
+from threading import Thread, Lock
+from multiprocessing import Pool, TimeoutError, cpu_count
+from mediamanager import stringutils, MediaManager, parse_file
+from iposonic import IposonicException
 
 q = Queue()
 
@@ -28,42 +42,139 @@ from decorator import decorator
 
 
 class ProcessDir(ProcessEvent):
-    """Performs Actions based on mask values.
+    """Collect the inotify events of the music folders
+        and apply them in batches.
 
         event functions signature should be
             event_f(self, event)
         every other argument should be passed via `self`
 
         inotify returns an event object!
+
+        - IN_CLOSE_WRITE: a file was written;
+        - IN_CREATE on directories, IN_MOVED_TO: an entry appeared.
+            Directories are walked, as their content may be
+            created before the watch;
+        - IN_DELETE, IN_MOVED_FROM: an entry disappeared with
+            the ones under it.
+
+        Events are coalesced by path, the last one wins. They are
+        applied by flush with one delete_paths and one add_paths
+        when no event arrives for `delay` seconds, or after
+        `max_delay` seconds of events: eg. copying an album is
+        a single batch.
     """
-    def __init__(self, iposonic):
+    def __init__(self, iposonic, delay=2, max_delay=30):
+        ProcessEvent.__init__(self)
         self.iposonic = iposonic
+        self.delay = delay
+        self.max_delay = max_delay
+        # path -> 'file', 'dir' or 'delete'
+        self.pending = dict()
+        # times of the first and last pending event
+        self.first = self.last = 0
+        self.lock = Lock()
 
     #@decorator
     def unbreakable(fn):
         def f(self, *args, **kwds):
             try:
-                log.info("executing unbreakable %s" % f.__name__)
+                log.debug("executing unbreakable %s" % fn.__name__)
                 fn(self, *args, **kwds)
             except Exception:
-                log.exception("error managing %s" % f.__name__)
+                log.exception("error managing %s" % fn.__name__)
+        f.__name__ = fn.__name__
         return f
 
+    def queue(self, event, action):
+        """Add the event path to the pending ones."""
+        try:
+            path = event.pathname
+            if not isinstance(path, unicode):
+                path = path.decode('utf-8')
+        except UnicodeDecodeError:
+            log.warn("skipping non unicode path: %s" % to_unicode(event.pathname))
+            return
+        if not event.dir and not MediaManager.is_allowed_extension(path):
+            return
+        log.debug("queue %s: %s" % (action, path))
+        with self.lock:
+            now = time.time()
+            if not self.pending:
+                self.first = now
+            self.pending[path] = action
+            self.last = now
+
+    @unbreakable
+    def process_IN_CLOSE_WRITE(self, event):
+        self.queue(event, 'file')
+
     @unbreakable
     def process_IN_CREATE(self, event):
-        log.info("Creating File and File Record:", event.pathname)
-        log.info("event object: %s" % {'path': event.path, 'name': event.name})
-        #self.iposonic.add_path(event.pathname)
+        # files are added when closed
+        if event.dir:
+            self.queue(event, 'dir')
+
+    @unbreakable
+    def process_IN_MOVED_TO(self, event):
+        self.queue(event, 'dir' if event.dir else 'file')
 
     @unbreakable
     def process_IN_DELETE(self, event):
-        log.info("Deleting File and File Record:", event.pathname)
-        log.debug("event object: %s" % event)
-        self.iposonic.delete_entry(event.pathname)
+        self.queue(event, 'delete')
+
+    @unbreakable
+    def process_IN_MOVED_FROM(self, event):
+        self.queue(event, 'delete')
+
+    def is_due(self):
+        """Return True if the pending events should be applied."""
+        now = time.time()
+        with self.lock:
+            return bool(self.pending) and (
+                now - self.last >= self.delay or now - self.first >= self.max_delay)
+
+    def flush(self):
+        """Apply the pending events, return the (added, deleted) ids."""
+        with self.lock:
+            (pending, self.pending) = (self.pending, dict())
+        deleted = [p for (p, action) in pending.items() if action == 'delete']
+        if deleted:
+            log.info("Deleting %s paths" % len(deleted))
+            deleted = self.iposonic.delete_paths(deleted)
+
+        folders = set([normpath(x) for x in self.iposonic.get_music_folders()])
+        dirs = sorted([p for (p, action) in pending.items() if action == 'dir'])
+        items = []
+        for d in dirs:
+            try:
+                items.append((d, normpath(dirname(d)) not in folders, os.stat(d)))
+            except OSError:
+                # removed since
+                continue
+            items.extend(walk_dir(d))
+        # skip the files found by the walks
+        prefixes = tuple([d + "/" for d in dirs])
+        items.extend([p for (p, action) in pending.items()
+                      if action == 'file' and not (prefixes and p.startswith(prefixes))])
+        added = []
+        if items:
+            log.info("Adding %s paths" % len(items))
+            added = self.iposonic.add_paths(items)
+        return (added, deleted)
+
+    def run(self, tick=0.5):
+        """Apply the pending events when due, every tick seconds."""
+        while True:
+            time.sleep(tick)
+            try:
+                if self.is_due():
+                    self.flush()
+            except Exception:
+                log.exception("error applying the inotify events")
 
 
 def eventually_rename_child(child, dir_path, rename_non_utf8=True):
-    print ("eventually_rename_child")
     #
     # To manage non-utf8 filenames
     # the easiest thing is to rename
@@ -94,54 +205,184 @@ def eventually_rename_child(child, dir_path, rename_non_utf8=True):
     return child
 
 
-def walk_music_folder(iposonic):
-    log.info("Start walker thread")
+def list_dir(path):
+    """Return the [(name, stat)] of the children of the directory path.
 
-    def add_or_log(path, album=False):
+        Every child is stat'ed once, following links. The listing
+        uses scandir when available. Children that can't be stat'ed,
+        eg. broken links, are skipped.
+    """
+    ret = []
+    if scandir:
+        for entry in scandir(path):
+            try:
+                ret.append((entry.name, entry.stat()))
+            except OSError:
+                log.warn("can't stat: %s" % entry.path)
+        return ret
+    for name in os.listdir(path):
         try:
-            iposonic.add_path(path, album)
-        except Exception as e:
-            iposonic.log.error(e)
+            ret.append((name, os.stat(join(path, name))))
+        except (OSError, UnicodeError):
+            log.warn("can't stat: %s" % to_unicode(name))
+    return ret
+
+
+def walk_paths(iposonic):
+    """Generate the (path, album, stat) to be indexed in the music folders.
 
+        Artists are the top-level directories. Every entry is
+        stat'ed once by list_dir, and the stat is carried to
+        add_paths. Non utf-8 directories are renamed, files skipped.
+    """
     for music_folder in iposonic.get_music_folders():
         log.info("Walking into: %s" % music_folder)
         # Assume artist names in utf-8
-        artists_local = [x for x in os.listdir(
-            music_folder) if os.path.isdir(join("/", music_folder, x))]
-        log.info("Local artists: %s" % artists_local)
-        #index all artists
-        for a in artists_local:
+        for (a, st) in list_dir(music_folder):
+            if not a or not S_ISDIR(st.st_mode):
+                continue
             try:
-                iposonic.log.info(u"scanning artist: %s" % a)
-            except:
-                iposonic.log.info(u'cannot read object: %s' % a.__class__)
-            if a:
                 a = eventually_rename_child(a, music_folder)
-                path = join("/", music_folder, a)
-                add_or_log(path)
+            except Exception:
+                log.warn("error: %s" % to_unicode(a))
+                continue
+            path = join("/", music_folder, a)
+            log.info("scanning artist: %s" % path)
+            yield (path, False, st)
+            for item in walk_dir(path):
+                yield item
 
-                #
-                # Scan recurrently only if not refresh_always
-                #
+
+def walk_dir(path):
+    """Generate the (path, album, stat) of the entries under the
+        directory path: its subdirectories are albums.
+    """
+    stack = [path]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            children = list_dir(dirpath)
+        except OSError:
+            log.warn("error traversing: %s" % dirpath)
+            continue
+        for (name, st) in children:
+            if S_ISDIR(st.st_mode):
                 try:
-                    for dirpath, dirnames, filenames in os.walk(path):
-                        for d in dirnames:
-                            try:
-                                d = eventually_rename_child(d, dirpath)
-                                d = join("/", path, dirpath, d)
-                                add_or_log(d, album=True)
-                            except:
-                                iposonic.log.info("error: %s" % stringutils.to_unicode(d))
-
-                        for f in filenames:
-                            try:
-                                p = join("/", path.encode('utf-8'), dirpath.encode('utf-8'), f.encode('utf-8')).decode('utf-8')
-                                iposonic.log.info("p: %s" % stringutils.to_unicode(p))
-                                add_or_log(p)
-                            except:
-                                iposonic.log.info("error: %s" % stringutils.to_unicode(f))
-                except:
-                    iposonic.log.warn("error traversing: %s" % path)
+                    name = eventually_rename_child(name, dirpath)
+                except Exception:
+                    log.warn("error: %s" % to_unicode(name))
+                    continue
+                child = join(dirpath, name)
+                stack.append(child)
+                yield (child, True, st)
+            elif isinstance(name, unicode):
+                yield (join(dirpath, name), False, st)
+            else:
+                log.warn("skipping non unicode file: %s" % to_unicode(name))
+
+
+def parse_item(item):
+    """Parse a (path, stat) in a pool process."""
+    return parse_file(*item)
+
+
+def create_pool(processes=None):
+    """Return a pool of `processes` parsers, or None with one process.
+
+        Fork it before starting any thread, so that the workers
+        don't inherit a lock held by one, eg. logging's.
+    """
+    processes = processes or cpu_count()
+    if processes > 1:
+        return Pool(processes)
+    return None
+
+
+class ScanPipeline(object):
+    """Index the music folders parsing the files in a process pool.
+
+        A walker thread enumerates the music folders into a bounded
+        queue. The caller thread is the only writer: it reads the
+        queue and adds the paths in batches with add_paths, while
+        the new or changed files of each batch are parsed by
+        a multiprocessing pool.
+
+        processes: the parser processes, default is the number of cores.
+            With one process the files are parsed by the writer.
+        queue_size: the paths enumerated ahead of the writer
+        timeout: the seconds to wait for the next parsed chunk. The chunk
+            of a worker that dies is lost: the scan fails after timeout.
+        pool: the parser pool of `processes` workers, see create_pool.
+            Without it run creates one, and terminates it at the end.
+    """
+    def __init__(self, iposonic, processes=None, queue_size=10000, timeout=300,
+                 pool=None):
+        self.iposonic = iposonic
+        self.processes = processes or cpu_count()
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.pool = pool
+
+    def parse(self, files):
+        """Parse a list of (path, stat) in the pool, see mediamanager.parse_file."""
+        chunksize = max(1, len(files) // (4 * self.processes))
+        results = self.pool.imap_unordered(parse_item, files, chunksize)
+        for i in range(len(files)):
+            try:
+                yield results.next(self.timeout)
+            except TimeoutError:
+                raise IposonicException(
+                    "parser timeout after %s seconds, %s files left" % (
+                        self.timeout, len(files) - i))
+
+    def walk(self, queue):
+        try:
+            for item in walk_paths(self.iposonic):
+                queue.put(item)
+        except Exception:
+            log.exception("error walking the music folders")
+        finally:
+            queue.put(None)
+
+    def run(self):
+        """Index the music folders, return the list of the added ids.
+
+            A missing pool is forked before the walker thread starts,
+            but other threads may be running: the callers starting
+            threads should pass one created before them.
+        """
+        pool = self.pool
+        if pool is None:
+            self.pool = create_pool(self.processes)
+        parse = self.parse if self.pool else None
+        try:
+            queue = Queue(self.queue_size)
+            walker = Thread(target=self.walk, args=[queue])
+            walker.daemon = True
+            walker.start()
+            return self.iposonic.add_paths(iter(queue.get, None), parse=parse)
+        finally:
+            if self.pool is not pool:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+
+
+def walk_music_folder(iposonic, processes=None, pool=None):
+    """Index the music folders, see ScanPipeline.
+
+        pool: the parser pool, see create_pool. It's
+            terminated after the scan.
+    """
+    log.info("Start walker thread")
+
+    # add entries in bulk
+    try:
+        ScanPipeline(iposonic, processes=processes, pool=pool).run()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
 
     # do something when the app signals something
     while True:
@@ -150,15 +391,138 @@ def walk_music_folder(iposonic):
         q.task_done()
 
 
-def watch_music_folder(iposonic):
-    #Pyionotify
+def watch_music_folder(iposonic, delay=2):
+    """Watch the music folders with inotify, applying the changes
+        in batches after `delay` seconds without events, see ProcessDir.
+
+        Return the started notifier.
+    """
+    if WatchManager is None:
+        raise IposonicException("Watching the music folders requires pyinotify")
+    handler = ProcessDir(iposonic, delay=delay)
+    t = Thread(target=handler.run, args=[])
+    t.daemon = True
+    t.start()
+
     wm = WatchManager()
-    mask = IN_DELETE | IN_CREATE
-    notifier = ThreadedNotifier(wm, ProcessDir(iposonic))
+    mask = IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+    notifier = ThreadedNotifier(wm, handler)
+    notifier.daemon = True
     notifier.start()
     for path in iposonic.get_music_folders():
         log.info("watching path: %s" % path)
         try:
-            wdd = wm.add_watch(path.encode('utf-8'), mask, rec=True)
+            wm.add_watch(path.encode('utf-8'), mask, rec=True, auto_add=True)
         except Exception as e:
             log.exception("error in watch thread: %s" % path)
+    return notifier
+
+
+class DirectoryPoller(object):
+    """Rescan the music folders polling the directory mtimes,
+        eg. on NFS where inotify events are not delivered.
+
+        A directory mtime changes when its children are added, removed
+        or renamed: only those directories are listed, their new or
+        changed entries are added and the missing ones are deleted.
+        The other directories are just stat'ed and compared with their
+        fingerprint in the manifest, while their subdirectories are
+        read from the albums. The music folders are listed every time.
+
+        A pass costs a stat per directory and a listing per changed
+        one. Mtimes are in seconds, so the directories changed since
+        the second before the last pass are listed again. Files
+        rewritten in place don't change their directory mtime:
+        they are found by the walk at startup.
+
+        interval: seconds between the passes
+    """
+    def __init__(self, iposonic, interval=300):
+        self.iposonic = iposonic
+        self.interval = interval
+        # start time of the last pass
+        self.last_poll = time.time()
+
+    def run(self):
+        log.info("Start poller thread, interval: %ss" % self.interval)
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.poll()
+            except Exception:
+                log.exception("error polling the music folders")
+
+    def poll(self):
+        """Rescan the music folders, return the number of listed directories."""
+        db = self.iposonic.db
+        (start, listed) = (time.time(), 0)
+        racy = self.last_poll - 1
+        # (path, album), album is None for the music folders
+        stack = [(x, None) for x in self.iposonic.get_music_folders()]
+        while stack:
+            (path, album) = stack.pop()
+            eid = MediaManager.uuid(path)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # removed since, the parent listing deletes it
+                continue
+            fingerprint = MediaManager.get_fingerprint(path, st)
+            if album is not None and fingerprint[1] < racy and (
+                    db.get_fingerprints([eid]).get(eid) == fingerprint):
+                stack.extend([(x['path'], True) for x in db.get_albums(query={'parent': eid})])
+                continue
+            try:
+                stack.extend(self.rescan(path, album, st))
+                listed += 1
+            except Exception:
+                log.exception("error rescanning: %s" % path)
+        self.last_poll = start
+        log.info("Polled music folders, listed %s directories" % listed)
+        return listed
+
+    def rescan(self, path, album=None, st=None):
+        """List a changed directory: add its new and changed files,
+            delete the missing entries and update its fingerprint.
+
+            st: the os.stat of path, if already known
+
+            Return the subdirectories to poll.
+        """
+        is_root = album is None
+        (dirs, files) = ([], [])
+        for (name, child_st) in list_dir(path):
+            try:
+                name = eventually_rename_child(name, path)
+            except ValueError:
+                continue
+            child = join(path, name)
+            if S_ISDIR(child_st.st_mode):
+                dirs.append(child)
+            elif not is_root and S_ISREG(child_st.st_mode) and (
+                    MediaManager.is_allowed_extension(name)):
+                files.append((child, False, child_st))
+
+        present = set([MediaManager.uuid(x) for x in dirs + [f[0] for f in files]])
+        missing = [x.get('path') for x in self.get_children(path, is_root)
+                   if "%s" % x.get('id') not in present]
+        if missing:
+            log.info("Deleting missing entries: %s" % missing)
+            self.iposonic.delete_paths(missing)
+        # the directory is added last, so that its fingerprint
+        #  is updated only if the rescan succeeds
+        self.iposonic.add_paths(files + ([] if is_root else [(path, album, st)]))
+        return [(x, not is_root) for x in dirs]
+
+    def get_children(self, path, is_root=False):
+        """Return the entries stored under the directory path."""
+        db = self.iposonic.db
+        if is_root:
+            try:
+                artists = db.get_artists() or []
+            except NotImplementedError:
+                # no artists yet
+                artists = []
+            return [x for x in artists if normpath(dirname(x.get('path'))) == normpath(path)]
+        eid = MediaManager.uuid(path)
+        return db.get_songs(query={'parent': eid}) + db.get_albums(query={'parent': eid})
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Read benchmark of SqliteIposonicDB.get_songs.
+#
+# Loads synthetic tracks in a temporary sqlite db, then reads
+#  all of them creating the database objects and serializing
+#  them with json() (the former read path) and with get_songs,
+#  and prints the rows read per second.
+#
+# usage: python test/bench_sql.py [ntracks ...]
+#
+from __future__ import unicode_literals
+import os
+import sys
+import time
+import shutil
+import tempfile
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bench_store import get_track
+
+SIZES = [10000, 100000]
+REPEAT = 3
+
+
+def best_rate(fn, n):
+    """Return the rows per second of the fastest of REPEAT runs."""
+    best = None
+    for i in xrange(REPEAT):
+        start = time.time()
+        assert len(fn()) == n
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return int(n / best)
+
+
+def measure(n):
+    from iposonicdb import SqliteIposonicDB
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db = SqliteIposonicDB([], dbfile=os.path.join(tmpdir, "bench.db"))
+        db.init_db()
+        db.log.setLevel(logging.WARN)
+        fields = db.Media.__fields__
+        rows = []
+        for i in xrange(n):
+            track = get_track(i)
+            track['isvideo'] = track.pop('isVideo')
+            rows.append(dict([(k, track.get(k)) for k in fields]))
+        db.engine.execute(db.Media.__table__.insert(), rows)
+
+        def orm():
+            session = db.Session()
+            try:
+                return [r.json() for r in db._query(db.Media, None, session=session)]
+            finally:
+                db.Session.remove()
+        return (best_rate(orm, n), best_rate(db.get_songs, n))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main(sizes):
+    print "%10s %12s %12s" % ('tracks', 'orm rows/s', 'core rows/s')
+    for n in sizes:
+        print "%10d %12d %12d" % ((n,) + measure(n))
+
+
+if __name__ == '__main__':
+    main([int(x) for x in sys.argv[1:]] or SIZES)
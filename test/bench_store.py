@@ -0,0 +1,123 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Memory benchmark of the in-memory song storage.
+#
+# Loads synthetic tracks shaped like MediaManager.get_info output
+#  in a dict of dicts (the former storage), in a RecordStore and
+#  in a whole IposonicDB with its indexes, and prints the resident
+#  memory used per track.
+#
+# usage: python test/bench_store.py [ntracks ...]
+#
+from __future__ import unicode_literals
+import os
+import sys
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+SIZES = [10000, 100000, 300000]
+
+
+def rss():
+    """Return the resident memory of this process in bytes."""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf(str('SC_PAGE_SIZE'))
+
+
+def get_track(i):
+    album = i // 12
+    artist = album // 8
+    path = "/music/Artist %d/Album %d/%02d - Track title %d.mp3" % (
+        artist, album, i % 12 + 1, i)
+    return {
+        'id': str(-1000000000 - i), 'path': path,
+        'parent': str(2000000000 + album), 'albumId': str(2000000000 + album),
+        'isDir': 'false', 'isVideo': 'false',
+        'title': "Track title %d" % i, 'album': "Album %d" % album,
+        'artist': "Artist %d" % artist, 'genre': "Genre %d" % (artist % 20),
+        'track': i % 12 + 1, 'year': 1960 + artist % 50, 'suffix': 'mp3',
+        'size': 5000000 + i, 'bitRate': 256, 'duration': 180 + i % 120,
+        'created': 1300000000 + i, 'coverArt': str(2000000000 + album),
+        'scrobbleId': str(3000000000 + i),
+    }
+
+
+def get_album(album):
+    artist = album // 8
+    return {
+        'id': str(2000000000 + album), 'isDir': 'true',
+        'path': "/music/Artist %d/Album %d" % (artist, album),
+        'parent': str(1000000000 + artist), 'artistId': str(1000000000 + artist),
+        'name': "Album %d" % album, 'title': "Album %d" % album,
+        'album': "Album %d" % album, 'artist': "Artist %d" % artist,
+        'created': 1300000000 + album, 'coverArt': str(2000000000 + album),
+    }
+
+
+def get_artist(artist):
+    return {
+        'id': str(1000000000 + artist), 'isDir': 'true',
+        'name': "Artist %d" % artist, 'path': "/music/Artist %d" % artist,
+        'created': 1300000000 + artist,
+    }
+
+
+def load_db(db, n):
+    """Add n tracks with their albums and artists to db, like a scan."""
+    from iposonic import IposonicDBTables
+    albums = set()
+    with db.write_lock:
+        for i in xrange(n):
+            track = get_track(i)
+            album = i // 12
+            if album not in albums:
+                albums.add(album)
+                if album % 8 == 0:
+                    artist = get_artist(album // 8)
+                    db._set_entry('artists', artist['id'], IposonicDBTables.BaseB(artist),
+                                  fingerprint=(4096, 1300000000, i))
+                entry = get_album(album)
+                db._set_entry('albums', entry['id'], IposonicDBTables.BaseB(entry),
+                              fingerprint=(4096, 1300000000, i))
+            db._set_entry('songs', track['id'], IposonicDBTables.BaseB(track),
+                          fingerprint=(track['size'], 1300000000, i))
+
+
+def measure(storage, n):
+    from iposonic import IposonicDB, MediaDAO, IposonicDBTables
+    if storage == 'db':
+        db = IposonicDB([])
+        before = rss()
+        load_db(db, n)
+        return (rss() - before) / n
+    if storage == 'store':
+        songs = IposonicDB([])._create_store(MediaDAO)
+    else:
+        songs = dict()
+    before = rss()
+    for i in xrange(n):
+        track = get_track(i)
+        if storage == 'dict':
+            track = IposonicDBTables.BaseB(track)
+        songs[track['id']] = track
+    return (rss() - before) / n
+
+
+def main(sizes):
+    storages = ('dict', 'store', 'db')
+    print "%10s %12s %12s %12s" % (
+        'tracks', 'dict B/track', 'store B/track', 'db B/track')
+    for n in sizes:
+        ret = [subprocess.check_output(
+            [sys.executable, __file__, '--child', storage, str(n)]).strip()
+            for storage in storages]
+        print "%10d %12s %12s %12s" % ((n, ) + tuple(ret))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        print measure(sys.argv[2], int(sys.argv[3]))
+    else:
+        main([int(x) for x in sys.argv[1:]] or SIZES)
@@ -1,7 +1,10 @@
 """Test harnesses"""
 
-from os.path import join
-from os import getcwd, walk
+from os.path import join, dirname, isdir
+from os import getcwd, walk, makedirs
+from shutil import copy, rmtree
+from tempfile import mkdtemp
+from contextlib import contextmanager
 import logging
 logging.basicConfig()
 
@@ -25,4 +28,21 @@ def harn_load_fs2(klass):
                 klass.db.add_path(path, album=(root is not klass.test_dir)))
         for f in files:
             path = join("/", root, f)
-            klass.id_songs.append(klass.db.add_path(path))
\ No newline at end of file
+            klass.id_songs.append(klass.db.add_path(path))
+
+
+@contextmanager
+def harn_tmp_dir(klass, songs=()):
+    """Yield a temporary directory, removed on exit, with a copy
+        of the sample song at each path of songs, eg. "album/1.ogg".
+    """
+    tmp = mkdtemp()
+    try:
+        for song in songs:
+            path = join(tmp, song)
+            if not isdir(dirname(path)):
+                makedirs(dirname(path))
+            copy(join(klass.test_dir, "mock_artist/mock_album/sample.ogg"), path)
+        yield tmp
+    finally:
+        rmtree(tmp)
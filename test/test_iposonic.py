@@ -1,11 +1,13 @@
 from nose import *
 
 import os
+import shutil
+import tempfile
 from os.path import join
 
-from harnesses import harn_setup, harn_load_fs2
+from harnesses import harn_setup, harn_load_fs2, harn_tmp_dir
 
-from iposonic import Iposonic
+from iposonic import Iposonic, IposonicDB
 
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -81,6 +83,23 @@ class TestIposonic:
         for x in ['album', 'title', 'artist']:
             assert ret[x], "Missing %s in %s" % (x, ret)
 
+    def test_get_indexes_if_modified_since(self):
+        ret = self.iposonic.get_indexes()
+        assert ret['index'], ret
+        ret = self.iposonic.get_indexes(ifModifiedSince=ret['lastModified'])
+        assert 'index' not in ret, ret
+        ret = self.iposonic.get_indexes(ifModifiedSince=ret['lastModified'] - 1)
+        assert ret['index'], ret
+
+    def test_get_artist(self):
+        artist = self.iposonic.db.get_artists(query={'name': 'mock_artist'})[0]
+        ret = self.iposonic.get_artist(artist['id'])
+        assert ret['albumCount'] == 1, ret
+        assert ret['album'][0]['title'] == 'mock_album', ret
+        assert ret['album'][0]['songCount'], ret
+        ret = self.iposonic.get_artists_index()
+        assert ret['index'][0]['artist'][0]['albumCount'] == 1, ret
+
     def test_genre_songs(self):
         ret = self.iposonic.get_genre_songs("mock_genre")
         assert ret
@@ -98,12 +117,172 @@ class TestIposonic:
 
     def test_starred(self):
         eid = self.iposonic.get_songs()[0].get('id')
-        print "songs: %s" % self.iposonic.get_songs()[0]
-        self.iposonic.update_entry(eid, {'starred': '12 12 23'})
-        print self.iposonic.get_songs(eid=eid)
-        ret = self.iposonic.get_starred()
-        assert ret, "Missing ret. %s" % ret
-        assert '12 12 23' in [x.get('starred') for x in ret['title']
-                              ], "Missing starred. %s" % ret['title']
-        print "ret: %s" % ret
+        self.iposonic.star(eid, username='alice')
+        ret = self.iposonic.get_starred(username='alice')
+        assert [x['id'] for x in ret['title']] == [eid], ret
+        assert ret['title'][0]['starred'], ret
+        # stars are per user
+        assert not self.iposonic.get_starred(username='bob')['title']
+        ret = self.iposonic.annotate(self.iposonic.get_songs(), username='bob')
+        assert not [x for x in ret if x.get('starred')], ret
+        self.iposonic.unstar(eid, username='alice')
+        assert not self.iposonic.get_starred(username='alice')['title']
+
+    def test_set_rating(self):
+        album = self.iposonic.get_albums()[0]
+        self.iposonic.set_rating(album['id'], '5', username='alice')
+        self.iposonic.set_rating(album['id'], '2', username='bob')
+        ret = self.iposonic.get_starred_albums(username='alice')
+        assert ret[0]['userRating'] == 5 and ret[0]['starred'], ret
+        ret = self.iposonic.annotate([self.iposonic.get_albums(eid=album['id'])], 'bob')
+        assert ret[0]['userRating'] == 2 and 'starred' not in ret[0], ret
+        assert not self.iposonic.get_starred_albums(username='bob')
+        # ratings are per user
+        ret = self.iposonic.annotate([self.iposonic.get_albums(eid=album['id'])], 'carol')
+        assert 'userRating' not in ret[0], ret
+        self.iposonic.set_rating(album['id'], '0', username='bob')
+        ret = self.iposonic.annotate([self.iposonic.get_albums(eid=album['id'])], 'alice')
+        assert ret[0]['userRating'] == 5, ret
+
+    def test_cache_during_scan(self):
+        with harn_tmp_dir(self, ["album/1.ogg"]) as tmp:
+            album = join(tmp, "album")
+            hits = []
+
+            def scan():
+                # the items of a chunk don't invalidate the cache
+                yield (album, True)
+                self.iposonic.get_albums()
+                yield join(album, "1.ogg")
+                self.iposonic.get_albums()
+                hits.append(self.iposonic.cache.hits)
+            self.iposonic.add_paths(scan())
+            assert hits == [1], hits
+            assert album in [x['path'] for x in self.iposonic.get_albums()]
+
+    def test_cache(self):
+        album = self.iposonic.get_albums()[0]
+        self.iposonic.get_albums()
+        assert self.iposonic.cache.hits == 1, self.iposonic.cache.stats()
+        self.iposonic.update_entry(album['id'], {'title': 'new title'})
+        assert self.iposonic.get_albums(eid=album['id'])['title'] == 'new title'
+        ret = self.iposonic.get_albums()
+        assert ret[0]['title'] == 'new title', ret
+        self.iposonic.star(album['id'], username='alice')
+        assert self.iposonic.get_starred_albums(username='alice')
+        iposonic = Iposonic([self.test_dir], cache=False)
+        iposonic.get_indexes()
+        iposonic.get_indexes()
+        assert not iposonic.cache.hits
+
+
+class TestIposonicDBPersistence:
+    """Test the snapshot and journal of the in-memory data store."""
+    id_songs = []
+    id_artists = []
+    id_albums = []
+
+    def setup(self):
+        self.test_dir = os.getcwd() + "/test/data/"
+        self.datadir = tempfile.mkdtemp()
+        self.db = self.restart()
+        harn_load_fs2(self)
+
+    def teardown(self):
+        shutil.rmtree(self.datadir)
+
+    def restart(self):
+        db = IposonicDB([self.test_dir], datadir=self.datadir)
+        db.init_db()
+        return db
+
+    def test_journal(self):
+        eid = self.db.get_songs()[0]['id']
+        self.db.update_entry(eid, {'starred': '12 12 23'})
+        self.db.update_usermedia('1', eid, {'userRating': 3})
+        # restart without a snapshot, eg. after a crash
+        self.db.journal.close()
+        db = self.restart()
+        assert sorted(db.get_songs()) == sorted(self.db.get_songs())
+        assert db.get_songs(eid=eid)['starred'] == '12 12 23'
+        assert db.get_usermedia('1', [eid])[eid]['userRating'] == 3
+        assert db.get_indexes()['index'] == self.db.get_indexes()['index']
+        assert db.search2("mock_artist")['title']
+
+    def test_snapshot(self):
+        album = self.db.get_albums(query={'title': 'mock_album'})[0]
+        self.db.end_db()
+        assert not os.path.getsize(join(self.datadir, IposonicDB.journal_file))
+        db = self.restart()
+        assert db.get_albums(eid=album['id']) == album
+        song = db.get_songs()[0]
+        db.update_usermedia('1', song['id'], {'starred': '12 12 23'})
+        db.end_db()
+        db = self.restart()
+        assert db.get_user_starred('1', 'songs') == [song]
+        db.delete_entry(song['id'])
+        db.end_db()
+        db = self.restart()
+        assert song['id'] not in db.directory
+        assert not db.get_songs(query={'albumId': album['id']})
+
+    def test_unchanged_paths(self):
+        eid = self.db.get_songs()[0]['id']
+        self.db.update_entry(eid, {'starred': '12 12 23'})
+        self.db = db = self.restart()
+        journal_size = len(db.journal)
+        # rescanning keeps the stored entries
+        harn_load_fs2(self)
+        assert db.get_songs(eid=eid)['starred'] == '12 12 23'
+        assert len(db.journal) == journal_size
+
+
+class TestIposonicBackends:
+    """Iposonic methods depending on the backend writes."""
+    dbhandler = IposonicDB
+    id_songs = []
+    id_artists = []
+    id_albums = []
+
+    def setup(self):
+        self.test_dir = os.getcwd() + "/test/data/"
+        self.tmp_dir = tempfile.mkdtemp()
+        self.iposonic = Iposonic([self.test_dir], dbhandler=self.dbhandler,
+                                 tmp_dir=self.tmp_dir)
+        self.db = self.iposonic.db
+        self.db.init_db()
+        harn_load_fs2(self)
+
+    def teardown(self):
+        self.db.end_db()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_artist(self):
+        artist = self.db.get_artists(query={'name': 'mock_artist'})[0]
+        ret = self.iposonic.get_artist("%s" % artist.get('id'))
+        assert [(x.get('title'), x.get('songCount'), x.get('duration'))
+                for x in ret['album']] == [('mock_album', 1, 1)], ret
+
+    def test_set_rating_highest(self):
+        album = "%s" % self.db.get_albums(query={'title': 'mock_album'})[0]['id']
+        song = "%s" % self.db.get_songs(query={'title': 'mock_title'})[0]['id']
+        for eid in (album, song):
+            self.iposonic.set_rating(eid, '4', username='bob')
+            self.iposonic.set_rating(eid, '1', username='alice')
+        ret = self.db.get_albums(order='highest')
+        assert [("%s" % x['id'], x['userRating'], x['averageRating'])
+                for x in ret] == [(album, 3, '2.5')], ret
+        ret = self.db.get_highest()
+        assert ("%s" % ret[0]['id'], ret[0]['userRating']) == (song, 3), ret
+        # removing a rating keeps the ones of the other users
+        self.iposonic.set_rating(song, '0', username='alice')
+        assert self.db.get_highest()[0]['userRating'] == 4
+        ret = self.iposonic.annotate([self.db.get_songs(eid=song)], 'alice')
+        assert 'userRating' not in ret[0] and ret[0]['averageRating'] == '4.0', ret
+
 
+class TestSqliteIposonicBackends(TestIposonicBackends):
+    def dbhandler(self, music_folders, datadir=None, **kwds):
+        from iposonicdb import SqliteIposonicDB
+        return SqliteIposonicDB(music_folders, datadir=datadir,
+                                dbfile=join(datadir, "iposonic.db"), **kwds)
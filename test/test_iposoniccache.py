@@ -0,0 +1,52 @@
+from __future__ import unicode_literals
+from nose import *
+
+from iposoniccache import ResultCache, freeze
+
+
+class TestResultCache:
+    def setup(self):
+        self.cache = ResultCache(size=2, max_weight=40)
+        self.calls = []
+
+    def f(self, x):
+        self.calls.append(x)
+        return [{'id': x}]
+
+    def call(self, x, depends=('media',)):
+        return self.cache.call(('f', x), depends, self.f, x)
+
+    def test_hit(self):
+        assert self.call(1) == [{'id': 1}]
+        ret = self.call(1)
+        assert ret == [{'id': 1}] and self.calls == [1]
+        assert self.cache.stats()['hits'] == 1
+        assert self.cache.stats()['misses'] == 1
+        # results are copied
+        ret[0]['id'] = 2
+        assert self.call(1) == [{'id': 1}]
+
+    def test_bump(self):
+        self.call(1)
+        self.call(2, depends=('usermedia',))
+        self.cache.bump('media')
+        self.call(1)
+        self.call(2, depends=('usermedia',))
+        assert self.calls == [1, 2, 1], self.calls
+
+    def test_bounds(self):
+        for x in (1, 2, 1, 3):
+            self.call(x)
+        # 2 is the least recently used
+        assert self.cache.results.keys() == [freeze(('f', 1)), freeze(('f', 3))]
+        # big results are not cached
+        self.cache.call('big', (), lambda: range(20))
+        assert len(self.cache.results) == 2
+        self.cache.call('big', (), lambda: range(10))
+        assert self.cache.weight <= 40
+
+    def test_disabled(self):
+        self.cache.enabled = False
+        self.call(1)
+        self.call(1)
+        assert self.calls == [1, 1]
@@ -8,6 +8,7 @@ import re
 from os.path import join, dirname
 from iposonic import Iposonic, MediaManager, IposonicDB
 from iposonicdb import SqliteIposonicDB, MySQLIposonicDB
+from sqlalchemy import event
 
 from test_iposonicdb_simple import TestIposonicDB
 
@@ -55,6 +56,29 @@ class TestSqliteIposonicDB(TestIposonicDB):
         ret = self.db.get_songs(query={'parent': parent})
         assert ret, "ret_get_songs: %s" % ret
 
+    def test_serialize_row(self):
+        path = join(self.test_dir, "mock_artist/mock_album/sample.ogg")
+        eid = self.db.add_path(path)
+        self.db.update_entry(eid, {'userRating': 4})
+        session = self.db.Session()
+        entry = session.query(self.db.Media).filter_by(id=eid).one()
+        row = session.execute(session.query(self.db.Media).filter_by(
+            id=eid).statement.with_only_columns(self.db.Media.columns())).first()
+        assert self.db.Media.serialize_row()(row) == entry.json(), row
+        assert self.db.get_songs(eid=eid) == entry.json()
+
+    def test_get_entry_by_id_single_query(self):
+        path = join(self.test_dir, "mock_artist/mock_album/sample.ogg")
+        eid = self.db.add_path(path)
+        statements = []
+        event.listen(self.db.engine, 'before_cursor_execute',
+                     lambda *args: statements.append(args[2]))
+        assert self.db.get_entry_by_id(eid)['title'] == 'mock_title'
+        assert len(statements) == 1, statements
+        # entries missing in the directory are searched in every table
+        self.db.engine.execute("DELETE FROM directory")
+        assert self.db.get_entry_by_id(eid)['title'] == 'mock_title'
+
     def test_get_songs_with_select(self):
         self.db.add_path(self.test_dir + "/mock_artist/mock_album/sample.ogg")
         l_session = self.db.Session()
@@ -78,7 +102,54 @@ class TestSqliteIposonicDB(TestIposonicDB):
 
         # check if updated
         dup = session.query(self.db.Artist).filter_by(id=eid).one()
-        assert dup.userRating == '5', "dup: %s" % dup
+        assert dup.userRating == 5, "dup: %s" % dup
+
+    def test_add_paths_preserves_rating(self):
+        path = join(self.test_dir, "mock_artist/mock_album/sample.ogg")
+        eid = self.db.add_paths([path])[0]
+        self.db.update_entry(eid, {'userRating': 4})
+        self.db.add_paths([path, path])
+        assert self.db.get_songs(eid=eid)['userRating'] == 4
+
+    def test_get_random_songs_uniform(self):
+        # the matching ids are 1, 2 and 1000: a seek past a random id
+        # would almost always return 1000
+        song = self.db.Media.__table__
+        self.db.engine.execute(song.insert(), [
+            {'id': i, 'path': "/%s" % i, 'title': "%s" % i,
+             'genre': 'gap' if i in (1, 2, 1000) else 'other'}
+            for i in range(1, 1001)])
+        ret = set()
+        for i in range(200):
+            ret.update([x['id'] for x in self.db.get_random_songs(size=1, genre='gap')])
+        assert ret == set([1, 2, 1000]), ret
+
+    def test_nocase_index(self):
+        plan = self.db.engine.execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM song WHERE genre = ? COLLATE NOCASE",
+            "Rock").fetchall()
+        assert 'ix_song_genre_nocase' in "%s" % plan, plan
+
+    def test_get_indexes_copy(self):
+        ret = self.db.get_indexes()
+        ret['index'][0]['artist'].pop()
+        assert self.db.get_indexes() != ret
+        # a write while loading discards the loaded tree
+        self.db.reset()
+        self.db.add_path(join(self.test_dir, "mock_artist"))
+        get_sort_name = MediaManager.get_sort_name
+
+        def writing(name):
+            self.db.artist_serial += 1
+            return get_sort_name(name)
+        MediaManager.get_sort_name = staticmethod(writing)
+        try:
+            assert self.db.get_indexes()['index'], "empty tree"
+        finally:
+            MediaManager.get_sort_name = staticmethod(get_sort_name)
+        assert self.db.artist_index is None
+        self.db.get_indexes()
+        assert self.db.artist_index is not None
 
     def test_add(self):
         path = "./test/data/Aretha Franklin/20 Greatest hits/Angel.mp3"
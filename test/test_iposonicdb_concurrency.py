@@ -0,0 +1,125 @@
+from __future__ import unicode_literals
+from nose import *
+
+import os
+import shutil
+import tempfile
+from os.path import join
+from threading import Thread
+
+from iposonic import IposonicDB
+from iposonicdb import SqliteIposonicDB
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class TestSqliteConcurrency:
+    """Stress the db with a scanner and many readers at the same time."""
+    dbhandler = SqliteIposonicDB
+    n_albums = 10
+    n_songs = 20
+    n_readers = 8
+
+    def setup(self):
+        # a collection of n_albums x n_songs copies of the sample file
+        self.tmp_dir = tempfile.mkdtemp()
+        sample = join(os.getcwd(), "test/data/mock_artist/mock_album/sample.ogg")
+        self.paths = []
+        for a in range(self.n_albums):
+            album = join(self.tmp_dir, "music", "mock_artist", "album_%s" % a)
+            os.makedirs(album)
+            self.paths.append((album, True))
+            for s in range(self.n_songs):
+                path = join(album, "%02d - song_%s.ogg" % (s, s))
+                shutil.copy(sample, path)
+                self.paths.append(path)
+
+        self.db = self.dbhandler([join(self.tmp_dir, "music")],
+                                 dbfile=join(self.tmp_dir, "iposonic.db"),
+                                 chunk_size=10)
+        self.db.init_db()
+        self.db.reset()
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_scanner_and_readers(self):
+        errors = []
+        done = []
+
+        def scanner():
+            try:
+                self.db.add_paths(self.paths)
+                for eid in [x.get('id') for x in self.db.get_songs()[:20]]:
+                    self.db.update_entry(eid, {'userRating': 5})
+            except Exception as e:
+                log.exception("scanner error")
+                errors.append(e)
+            done.append(True)
+
+        def reader():
+            try:
+                while not done:
+                    self.db.get_songs()
+                    self.db.get_albums()
+                    self.db.get_albums(query={'title': 'album'})
+                    self.db.search2("mock")
+                    self.db.get_highest()
+            except Exception as e:
+                log.exception("reader error")
+                errors.append(e)
+
+        threads = [Thread(target=reader) for i in range(self.n_readers)]
+        threads.append(Thread(target=scanner))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert not errors, errors
+        songs = self.db.get_songs()
+        assert len(songs) == self.n_albums * self.n_songs, len(songs)
+        assert len([x for x in songs if x.get('userRating') == 5]) == 20
+        self.check_db()
+
+    def test_many_readers(self):
+        """Readers don't close the connections in use by other threads."""
+        self.db.add_paths(self.paths[:self.n_songs + 1])
+        errors = []
+
+        def reader():
+            try:
+                self.db.get_songs()
+            except Exception as e:
+                log.exception("reader error")
+                errors.append(e)
+
+        conn = self.db.engine.connect()
+        try:
+            for i in range(2):
+                threads = [Thread(target=reader) for i in range(40)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+            assert conn.execute("select count(*) from song").scalar() == self.n_songs
+        finally:
+            conn.close()
+        assert not errors, errors
+
+    def check_db(self):
+        assert self.db.engine.execute(
+            "PRAGMA journal_mode").scalar() == 'wal'
+
+
+class TestIposonicDBConcurrency(TestSqliteConcurrency):
+    """Readers iterate the in-memory stores while the scanner writes them."""
+    dbhandler = IposonicDB
+    n_albums = 20
+
+    def test_many_readers(self):
+        pass
+
+    def check_db(self):
+        pass
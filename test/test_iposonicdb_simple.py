@@ -1,10 +1,10 @@
 from __future__ import unicode_literals
 from nose import SkipTest
-from harnesses import harn_setup, harn_load_fs2
+from harnesses import harn_setup, harn_load_fs2, harn_tmp_dir
 import os
 from os.path import join
 
-from iposonic import IposonicDB
+from iposonic import IposonicDB, EntryNotFoundException
 from iposonicdb import SqliteIposonicDB
 from mediamanager import MediaManager
 
@@ -60,6 +60,125 @@ class TestIposonicDB:
         ret = self.db.get_artists(eid=eid)
         assert int(ret.get('userRating')) == 5, "Value was: %s" % ret
 
+    def test_starred_songs(self):
+        eid = self.db.get_songs(query={'genre': 'mock_genre'})[0].get('id')
+        self.db.update_entry(eid, {'starred': '2012-11-03T10:00:00'})
+        ret = self.db.get_songs(query={'starred': 'notNull'})
+        assert eid in [x.get('id') for x in ret], ret
+        self.db.update_entry(eid, {'starred': None})
+        ret = self.db.get_songs(query={'starred': 'notNull'})
+        assert eid not in [x.get('id') for x in ret], ret
+
+    def test_usermedia(self):
+        (alice, bob) = [MediaManager.uuid(x) for x in ('alice', 'bob')]
+        song = self.db.get_songs(query={'genre': 'mock_genre'})[0]
+        album = self.db.get_albums()[0]
+        self.db.update_usermedia(alice, song['id'], {'starred': '2012-11-03T10:00:00'})
+        self.db.update_usermedia(alice, album['id'], {'starred': '2012-11-03T10:00:01'})
+        self.db.update_usermedia(bob, song['id'], {'userRating': 4})
+        ret = self.db.get_user_starred(alice, 'songs')
+        assert [x['id'] for x in ret] == [song['id']], ret
+        assert [x['id'] for x in self.db.get_user_starred(alice, 'albums')] == [album['id']]
+        assert not self.db.get_user_starred(bob, 'songs')
+        ret = self.db.get_usermedia(bob, [song['id'], album['id']])
+        assert ret.keys() == [str(song['id'])], ret
+        assert ret[str(song['id'])]['userRating'] == 4, ret
+        # records without annotations are removed
+        self.db.update_usermedia(alice, song['id'], {'starred': None})
+        assert not self.db.get_user_starred(alice, 'songs')
+        assert not self.db.get_usermedia(alice, [song['id']])
+        # deleting an entry deletes its annotations
+        self.db.delete_entry(song['id'])
+        assert not self.db.get_usermedia(bob, [song['id']])
+        self.db.delete_paths([album['path']])
+        assert not self.db.get_usermedia(alice, [album['id']])
+
+    def test_add_paths(self):
+        self.db.reset()
+        albums, songs = [], []
+        for (root, dirfile, files) in os.walk(self.test_dir):
+            albums.extend([(join("/", root, d), True) for d in dirfile])
+            songs.extend([join("/", root, f) for f in files])
+        ret = self.db.add_paths(albums + songs + ["/missing/file.mp3"],
+                                chunk_size=1)
+        assert len(ret) == len(albums) + len(songs), ret
+        for eid in ret[:len(albums)]:
+            assert self.db.get_albums(eid=eid)
+        for eid in ret[len(albums):]:
+            song = self.db.get_songs(eid=eid)
+            assert "%s" % song['albumId'] == "%s" % song['parent'], song
+        # the album tags don't add albums
+        assert len(self.db.get_albums()) == len(albums)
+
+    def test_get_albums_paging(self):
+        with harn_tmp_dir(self) as tmp:
+            for i in range(5):
+                path = join(tmp, "artist %s" % (i % 2), "album %s" % i)
+                os.makedirs(path)
+                eid = self.db.add_path(path, album=True)
+                self.db.update_entry(eid, {'userRating': i % 3 + 1})
+            for order in ['newest', 'highest',
+                          'alphabeticalByName', 'alphabeticalByArtist']:
+                expected = [a['id'] for a in self.db.get_albums(order=order)]
+                ret = []
+                for offset in range(0, len(expected) + 2, 2):
+                    ret += [a['id'] for a in self.db.get_albums(
+                        order=order, offset=offset, size=2)]
+                assert ret == expected, "%s: %s != %s" % (order, ret, expected)
+            ratings = [a['userRating'] for a in self.db.get_albums(order='highest')]
+            assert ratings == [3, 2, 2, 1, 1], ratings
+            names = [a['name'] for a in self.db.get_albums(
+                order='alphabeticalByArtist', offset=1, size=2)]
+            assert names == ['album 2', 'album 4'], names
+            # a filter without an index walks the sorted albums
+            names = [a['name'] for a in self.db.get_albums(
+                query={'artist': 'artist 0'},
+                order='alphabeticalByName', offset=1, size=2)]
+            assert names == ['album 2', 'album 4'], names
+
+    def test_get_random_songs(self):
+        songs = self.db.get_songs()
+        ret = self.db.get_random_songs(size=len(songs) + 10)
+        assert len(ret) == len(songs), ret
+        assert len(set([x['id'] for x in ret])) == len(songs), ret
+        assert len(self.db.get_random_songs(size=1)) == 1
+        ret = self.db.get_random_songs(size=10, genre='mock_genre')
+        assert ret and all([x['genre'] == 'mock_genre' for x in ret]), ret
+        assert self.db.get_random_songs(size=10, genre='MOCK_GENRE')
+        # the genre is not a LIKE pattern
+        assert not self.db.get_random_songs(size=10, genre='mock%')
+        assert not self.db.get_random_songs(size=10, folder="/missing")
+        assert self.db.get_random_songs(size=10, folder=self.test_dir)
+
+    def test_get_random_albums(self):
+        ret = self.db.get_random_albums(size=1)
+        assert len(ret) == 1, ret
+
+    def test_aggregates(self):
+        with harn_tmp_dir(self, ["artist/album/sample.ogg"]) as tmp:
+            artist = join(tmp, "artist")
+            album = join(artist, "album")
+            song = join(album, "sample.ogg")
+            artist_id = self.db.add_path(artist)
+            song_id = self.db.add_path(song)
+            album_id = self.db.add_path(album, album=True)
+
+            # songs belong to the album of their directory
+            song = self.db.get_songs(eid=song_id)
+            assert "%s" % song['albumId'] == "%s" % album_id, song
+            songs = self.db.get_songs(query={'albumId': song['albumId']})
+            ret = self.db.get_albums(eid=song['albumId'])
+            assert ret['songCount'] == len(songs), ret
+            assert ret['duration'] == sum([x['duration'] for x in songs]), ret
+            assert self.db.get_entry_by_id(artist_id)['albumCount'] == 1
+
+            self.db.delete_entry(song_id)
+            ret = self.db.get_albums(eid=song['albumId'])
+            assert ret['songCount'] == len(songs) - 1, ret
+            assert ret['duration'] == sum([x['duration'] for x in songs]) - song['duration'], ret
+            self.db.delete_entry(album_id)
+            assert self.db.get_entry_by_id(artist_id)['albumCount'] == 0
+
     def test_get_artists(self):
         ret = self.db.get_artists()
         assert ret, "No artists in the DB"
@@ -82,6 +201,25 @@ class TestIposonicDB:
             assert 'path' in info, "error processing eid: %s" % eid
             assert 'created' in info, "missing created in %s" % info
 
+    def test_get_songs_by_ids(self):
+        eids = [x.get('id') for x in self.db.get_songs()]
+        assert eids
+        # ids may come from a playlist entry string
+        query = ["%s" % eids[-1], '12345', None, "%s" % eids[0]]
+        ret = self.db.get_songs_by_ids(query)
+        assert ["%s" % x.get('id') for x in ret] == [
+            "%s" % eids[-1], "%s" % eids[0]], ret
+
+    def test_get_entry_by_id(self):
+        for eid in self.id_songs + self.id_albums:
+            ret = self.db.get_entry_by_id(eid)
+            assert "%s" % ret.get('id') == "%s" % eid, ret
+        try:
+            self.db.get_entry_by_id('12345')
+            assert False, "Entry should not exist"
+        except EntryNotFoundException:
+            pass
+
     def test_search_songs_by_title(self):
         harn_load_fs2(self)
         ret = self.db.get_songs(query={'title': 'mock_title'})
@@ -90,8 +228,81 @@ class TestIposonicDB:
         assert info.get('bitRate'), ret
         print info
 
+    def test_fingerprints(self):
+        with harn_tmp_dir(self, ["sample.ogg"]) as tmp:
+            song = join(tmp, "sample.ogg")
+            eid = self.db.add_paths([song])[0]
+            assert self.db.get_fingerprints([eid]) == {
+                "%s" % eid: MediaManager.get_fingerprint(song)}
+            # unchanged files are not parsed again
+            self.db.update_entry(eid, {'title': 'changed'})
+            assert self.db.add_paths([song]) == [eid]
+            assert self.db.get_songs(eid=eid)['title'] == 'changed'
+            os.utime(song, (1, 1))
+            self.db.add_paths([song])
+            assert self.db.get_songs(eid=eid)['title'] == 'mock_title'
+            self.db.delete_entry(eid)
+            assert not self.db.get_fingerprints([eid])
+
+    def test_delete_paths(self):
+        song = self.db.get_songs()[0]
+        album = self.db.get_albums(eid=song['parent'])
+        ret = self.db.delete_paths([album['path'], "/missing/path"])
+        assert "%s" % album['id'] in ret and "%s" % song['id'] in ret, ret
+        assert not self.db.get_songs(query={'parent': "%s" % album['id']})
+        assert not self.db.get_fingerprints([song['id']])
+        assert not self.db.delete_paths([album['path']])
+
+    def test_search_case_insensitive(self):
+        songs = self.db.get_songs(query={'genre': 'mock_genre'})
+        assert songs
+        assert self.db.get_songs(query={'genre': 'Mock_Genre'}) == songs
+        assert self.db.get_songs(query={'genre': ('eq', 'MOCK_GENRE')}) == songs
+        albums = self.db.get_albums(query={'name': 'mock_album'})
+        assert albums and self.db.get_albums(query={'name': 'MOCK_ALBUM'}) == albums
+
+    def test_search_songs_compound(self):
+        song = self.db.get_songs(query={'genre': 'mock_genre'})[0]
+        query = {'genre': 'mock_genre', 'title': 'mock_t', 'path': ('prefix', song['path'])}
+        assert [x['id'] for x in self.db.get_songs(query=query)] == [song['id']]
+        # every predicate is applied
+        for (k, v) in [('title', 'missing_title'), ('created', ('range', None, 1)),
+                       ('path', ('prefix', '/missing'))]:
+            assert not self.db.get_songs(query=dict(query, **{k: v})), k
+        songs = self.db.get_songs()
+        ret = self.db.get_songs(offset=1, size=len(songs))
+        assert len(ret) == len(songs) - 1, ret
+
+    def test_get_albums_query_and_order(self):
+        album = self.db.get_albums()[0]
+        ret = self.db.get_albums(query={'artistId': album['artistId']},
+                                 order='alphabeticalByName')
+        assert "%s" % album['id'] in ["%s" % x['id'] for x in ret], ret
+        assert all(["%s" % x['artistId'] == "%s" % album['artistId'] for x in ret]), ret
+        assert not self.db.get_albums(query={'artistId': album['artistId'], 'name': 'missing'},
+                                      order='alphabeticalByName')
+
+    def test_search2(self):
+        ret = self.db.search2('mock_title', songCount=1)
+        assert len(ret['title']) == 1, ret
+        assert ret['title'][0]['title'] == 'mock_title', ret
+        ret = self.db.search2('mock_artist', artistCount=1)
+        assert ret['artist'][0]['name'] == 'mock_artist', ret
+
     def test_get_indexes(self):
-        print self.db.get_indexes()
+        ret = self.db.get_indexes()
+        last_modified = ret['lastModified']
+        names = [a['name'] for i in ret['index'] for a in i['artist']]
+        assert 'mock_artist' in names, ret
+
+        with harn_tmp_dir(self) as tmp:
+            path = join(tmp, "The Zombies")
+            os.makedirs(path)
+            self.db.add_path(path)
+            ret = self.db.get_indexes()
+            assert ret['lastModified'] > last_modified, ret
+            index = dict([(i['name'], i['artist']) for i in ret['index']])
+            assert 'The Zombies' in [a['name'] for a in index['Z']], ret
 
     def test__search(self):
         artists = {'-1408122649': {'isDir': 'true', 'path': '/opt/music/mock_artist', 'name': 'mock_artist', 'id': '-1408122649'}}
@@ -104,6 +315,21 @@ class TestIposonicDB:
         assert ret, "Missing ret. %s" % ret
         print "ret: %s" % ret
 
+    def test_highest_order(self):
+        songs = ["%s - sample.ogg" % i for i in range(4)]
+        with harn_tmp_dir(self, songs) as tmp:
+            for (i, song) in enumerate(songs):
+                eid = self.db.add_path(join(tmp, song))
+                if i:
+                    self.db.update_entry(eid, {'userRating': i})
+            ratings = [x.get('userRating') for x in self.db.get_highest(size=3)]
+            assert ratings == [3, 2, 1], ratings
+            ret = self.db.get_highest(size=10)
+            assert len(ret) == len(self.db.get_songs()), ret
+            assert not ret[-1].get('userRating'), ret
+            self.db.update_entry(eid, {'userRating': 1})
+            assert self.db.get_highest(size=1)[0]['userRating'] == 2
+
     def test_latest(self):
         album = self.db.add_path(os.getcwd(
         ) + '/test/data/mock_artist/mock_album/', album=True)
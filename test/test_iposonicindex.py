@@ -0,0 +1,150 @@
+from __future__ import unicode_literals
+from nose import *
+
+from iposonicindex import TokenIndex, HashIndex, SortedIndex, SampleIndex, GroupIndex, tokenize
+
+
+def test_tokenize():
+    assert tokenize("The Beatles - Let it Be!") == [
+        'the', 'beatles', 'let', 'it', 'be']
+    assert tokenize(None) == []
+
+
+class TestTokenIndex:
+    def setup(self):
+        self.index = TokenIndex(['title', 'artist'])
+        self.index.add('1', {'title': 'Let it be', 'artist': 'The Beatles'})
+        self.index.add('2', {'title': 'Yesterday', 'artist': 'The Beatles'})
+        self.index.add('3', {'title': 'Be', 'artist': 'Common'})
+
+    def test_search_intersect(self):
+        assert self.index.search("beatles let") == ['1']
+
+    def test_search_prefix(self):
+        ret = self.index.search("beat")
+        assert set(ret) == set(['1', '2']), ret
+
+    def test_search_rank_and_limit(self):
+        # exact match on a shorter entry comes first
+        ret = self.index.search("be", limit=1)
+        assert ret == ['3'], ret
+
+    def test_update_and_remove(self):
+        self.index.add('2', {'title': 'Help', 'artist': 'The Beatles'})
+        assert not self.index.search("yesterday")
+        assert self.index.search("help") == ['2']
+        self.index.remove('2')
+        assert not self.index.search("help")
+        assert 'help' not in self.index.postings
+
+
+class TestHashIndex:
+    def setup(self):
+        self.index = HashIndex('genre')
+        self.index.add('1', {'genre': 'Rock'})
+        self.index.add('2', {'genre': 'rock'})
+        self.index.add('3', {'title': 'no genre'})
+
+    def test_lookup(self):
+        assert set(self.index.lookup('ROCK')) == set(['1', '2'])
+        assert self.index.lookup('notNull') == set(['1', '2'])
+        assert not self.index.lookup('pop')
+
+    def test_update(self):
+        self.index.add('2', {'genre': 'Pop'})
+        assert set(self.index.lookup('rock')) == set(['1'])
+        assert set(self.index.lookup('pop')) == set(['2'])
+        self.index.remove('1')
+        assert 'rock' not in self.index.values
+
+    def test_postings(self):
+        # small postings are tuples, large ones sets
+        assert isinstance(self.index.values['rock'], tuple)
+        for i in range(10, 30):
+            self.index.add(str(i), {'genre': 'Rock'})
+        assert isinstance(self.index.values['rock'], set)
+        for i in range(10, 30):
+            self.index.remove(str(i))
+        assert self.index.values['rock'] in (('1', '2'), ('2', '1'))
+
+
+class TestSortedIndex:
+    def setup(self):
+        self.index = SortedIndex(['created'], reverse=True)
+        for i in range(5):
+            self.index.add(str(i), {'created': i % 3})
+        self.index.add('5', {'title': 'not created'})
+
+    def test_page(self):
+        assert len(self.index) == 5
+        assert self.index.page() == ['2', '4', '1', '3', '0']
+        assert self.index.page(1, 2) == ['4', '1']
+        assert self.index.page(4, 2) == ['0']
+        assert self.index.page(5, 2) == []
+
+    def test_walk(self):
+        assert list(self.index.walk()) == self.index.page()
+        ids = self.index.walk()
+        assert ids.next() == '2'
+        # a write shifting the keys doesn't repeat an id
+        self.index.add('5', {'created': 5})
+        assert list(ids) == ['4', '1', '3', '0']
+
+    def test_range(self):
+        assert sorted(self.index.range(1, 2)) == ['1', '2', '4']
+        assert sorted(self.index.range(high=0)) == ['0', '3']
+        assert self.index.bounds(3, None) == (5, 5)
+
+    def test_update(self):
+        self.index.add('0', {'created': 10})
+        assert self.index.page(0, 1) == ['0']
+        self.index.remove('0')
+        assert '0' not in self.index.page()
+
+
+class TestSampleIndex:
+    def setup(self):
+        self.index = SampleIndex()
+        for i in range(10):
+            self.index.add(i)
+
+    def test_sample(self):
+        ret = self.index.sample(5)
+        assert len(set(ret)) == 5, ret
+        assert sorted(self.index.sample(20)) == range(10)
+        ret = self.index.sample(3, accept=lambda x: x % 2)
+        assert len(ret) == 3 and all([x % 2 for x in ret]), ret
+        assert self.index.sample(3, candidates=[1, 2]) in ([1, 2], [2, 1])
+
+    def test_remove(self):
+        self.index.remove(0)
+        self.index.remove(9)
+        assert len(self.index) == 8
+        assert sorted(self.index.sample(10)) == range(1, 9)
+        assert all([self.index.ids[p] == eid
+                    for (eid, p) in self.index.positions.items()])
+
+
+class TestGroupIndex:
+    def setup(self):
+        self.index = GroupIndex('name')
+        self.index.add('1', {'name': 'Beatles'})
+        self.index.add('2', {'name': 'abba'})
+        self.index.add('3', {'name': '883'})
+        self.index.add('4', {'name': 'ACDC'})
+
+    def test_tree(self):
+        ret = self.index.tree()
+        assert [i['name'] for i in ret['index']] == ['A', 'B', '#'], ret
+        assert [a['id'] for a in ret['index'][0]['artist']] == ['2', '4'], ret
+        assert self.index.tree() is ret
+
+    def test_update(self):
+        last_modified = self.index.tree()['lastModified']
+        self.index.add('1', {'name': 'Beatles'})
+        assert self.index.tree()['lastModified'] == last_modified
+        self.index.add('1', {'name': 'Zombies'})
+        self.index.remove('3')
+        ret = self.index.tree()
+        assert ret['lastModified'] > last_modified
+        assert [i['name'] for i in ret['index']] == ['A', 'Z'], ret
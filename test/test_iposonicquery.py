@@ -0,0 +1,68 @@
+from __future__ import unicode_literals
+from nose import *
+
+from iposonicindex import HashIndex, SortedIndex
+from iposonicquery import Predicate, QueryPlan
+
+
+def test_predicate():
+    assert Predicate.parse('title', 'HELP').match('Help!')
+    assert Predicate.parse('year', '1970').match(1970)
+    assert Predicate.parse('year', 'notNull').match(1970)
+    assert Predicate.parse('year', 'isNull').match(None)
+    assert Predicate('path', 'prefix', '/Music/').match('/music/a.mp3')
+    assert not Predicate('genre', 'eq', 'rock').match('Rock and Roll')
+    year = Predicate('year', 'range', '1960', None)
+    assert year.match(1970) and year.match('1970-05-08')
+    assert not year.match(1950) and not year.match('mock_year')
+
+
+class TestQueryPlan:
+    def setup(self):
+        self.songs = dict()
+        for i in range(20):
+            self.songs[str(i)] = {
+                'id': str(i), 'title': 'Song %d' % i, 'year': 1960 + i,
+                'genre': 'Rock' if i % 2 else 'Pop',
+                'path': '/music/%s/%d.mp3' % ('a' if i < 10 else 'b', i)}
+        self.indexes = {'genre': HashIndex('genre'), 'year': SortedIndex(['year'])}
+        for (eid, song) in self.songs.items():
+            for index in self.indexes.values():
+                index.add(eid, song)
+
+    def test_indexed(self):
+        plan = QueryPlan(self.songs, {
+            'genre': 'rock', 'year': ('range', 1965, 1968)}, self.indexes)
+        # the year range is the most selective
+        assert sorted(plan.candidates) == ['5', '6', '7', '8']
+        assert sorted(plan.select()) == ['5', '7']
+
+    def test_filters(self):
+        plan = QueryPlan(self.songs, {
+            'genre': 'pop', 'path': ('prefix', '/music/b/'), 'title': '1'}, self.indexes)
+        assert len(plan.filters) == 2
+        assert sorted(plan.select()) == ['10', '12', '14', '16', '18']
+        assert len(list(plan.select(limit=2))) == 2
+
+    def test_no_index(self):
+        plan = QueryPlan(self.songs, {'year': ('range', None, 1961), 'genre': 'notNull'})
+        assert plan.candidates is None
+        assert sorted(plan.select()) == ['0', '1']
+
+    def test_select_lazy(self):
+        class Songs(object):
+            """A store counting the ids read."""
+            def __init__(self, songs):
+                (self.songs, self.read) = (songs, 0)
+
+            def __iter__(self):
+                for eid in sorted(self.songs, key=int):
+                    self.read += 1
+                    yield eid
+
+            def __getitem__(self, eid):
+                return self.songs[eid]
+        songs = Songs(self.songs)
+        plan = QueryPlan(songs, {'title': 'song'})
+        assert list(plan.select(limit=3)) == ['0', '1', '2']
+        assert songs.read == 3, songs.read
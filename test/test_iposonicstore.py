@@ -0,0 +1,107 @@
+from __future__ import unicode_literals
+from nose import *
+
+import os
+import tempfile
+
+from iposonicstore import RecordStore, Journal
+
+
+class TestRecordStore:
+    def setup(self):
+        self.store = RecordStore(['id', 'title', 'artist', 'parent', 'year'],
+                                 ints=['year'], ids=['parent'], symbols=['artist'])
+        self.song = {'id': '-123', 'title': 'Let it be', 'artist': 'The Beatles',
+                     'parent': '456', 'year': 1970, 'isVideo': 'false'}
+        self.store['-123'] = self.song
+
+    def test_get(self):
+        assert self.store['-123'] == self.song, self.store['-123']
+        assert self.store.get('-123') == self.song
+        assert self.store.get('0') is None
+        assert '-123' in self.store and '0' not in self.store
+        assert list(self.store) == ['-123']
+        assert self.store.values() == [self.song]
+
+    def test_columns(self):
+        assert self.store.get_field('-123', 'parent') == '456'
+        assert self.store.get_field('-123', 'year') == 1970
+        # values not fitting their column are kept as is
+        self.store.update_record('-123', {'year': 'mock_year', 'parent': 'p1'})
+        assert self.store.get_field('-123', 'year') == 'mock_year'
+        assert self.store['-123']['parent'] == 'p1'
+        self.store.update_record('-123', {'year': '1971'})
+        assert self.store.get_field('-123', 'year') == 1971
+        # year fits again, while the parent and the unknown fields don't
+        assert self.store.extras == {0: {'parent': 'p1', 'isVideo': 'false'}}
+
+    def test_symbols(self):
+        self.store['1'] = dict(self.song, id='1')
+        assert self.store['1']['artist'] is self.store['-123']['artist']
+
+    def test_materialized(self):
+        song = self.store['-123']
+        song['title'] = 'Help'
+        assert self.store['-123']['title'] == 'Let it be'
+        self.store.update_record('-123', {'title': 'Help', 'starred': 'now'})
+        assert self.store['-123']['title'] == 'Help'
+        assert self.store['-123']['starred'] == 'now'
+
+    def test_delete(self):
+        del self.store['-123']
+        assert not self.store
+        self.store['1'] = {'id': '1', 'title': 'Yesterday'}
+        # rows are reused
+        assert self.store.size == 1
+        assert self.store['1'] == {'id': '1', 'title': 'Yesterday'}
+
+    def test_dump_load(self):
+        self.store['1'] = dict(self.song, id='1', year='mock_year')
+        del self.store['-123']
+        f = tempfile.TemporaryFile()
+        self.store.dump(f)
+        f.seek(0)
+        store = RecordStore(['id', 'title', 'artist', 'parent', 'year'],
+                            ints=['year'], ids=['parent'], symbols=['artist'])
+        store.load(f)
+        assert store.items() == self.store.items()
+        assert store.free == [0]
+        store['2'] = self.song
+        assert store['1']['artist'] is store['2']['artist']
+
+    def test_load_other_fields(self):
+        f = tempfile.TemporaryFile()
+        self.store.dump(f)
+        f.seek(0)
+        try:
+            RecordStore(['id', 'title']).load(f)
+            assert False, "Expected ValueError"
+        except ValueError:
+            pass
+
+
+class TestJournal:
+    def setup(self):
+        (fd, self.path) = tempfile.mkstemp()
+        os.close(fd)
+
+    def teardown(self):
+        os.unlink(self.path)
+
+    def test_replay(self):
+        journal = Journal(self.path)
+        assert not list(journal.replay())
+        journal.append('set', '1', {'title': 'Let it be'})
+        journal.append('delete', '1')
+        journal.close()
+        # a torn write is discarded
+        with open(self.path, 'ab') as f:
+            f.write(b'\xff\x00')
+        journal = Journal(self.path)
+        assert list(journal.replay()) == [
+            ('set', '1', {'title': 'Let it be'}), ('delete', '1')]
+        journal.append('delete', '2')
+        assert len(journal) == 3
+        journal.truncate()
+        journal.close()
+        assert not list(Journal(self.path).replay())
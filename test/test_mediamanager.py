@@ -138,6 +138,12 @@ class TestMediaManager:
             ret = MediaManager.normalize_artist(info, stopwords=True)
             assert ret == 'beatles'
 
+    def test_get_sort_name(self):
+        assert MediaManager.get_sort_name(u'The Beatles') == 'beatles'
+        assert MediaManager.get_sort_name(u'I Muvrini') == 'muvrini'
+        assert MediaManager.get_sort_name(u'The') == 'the'
+        assert MediaManager.get_sort_name(u'Theatres des Vampires') == 'theatres des vampires'
+
     def test_normalize_album(self):
         info_l = [
             {'artist': 'pippo', 'album': u'Evanescence'},
@@ -151,6 +157,18 @@ class TestMediaManager:
             assert ret == expected, "Expecting: [%s], got [%s]" % (
                 expected, ret)
 
+    def test_get_year(self):
+        for (info, expected) in [
+            ({'date': '2012-11-03'}, 2012),
+            ({'year': 'mock_year', 'date': '1999'}, 1999),
+            ({'year': 1972}, 1972),
+            ({'date': '20121103'}, None),
+            ({'year': 'mock_year'}, None)
+        ]:
+            ret = MediaManager.get_year(info)
+            assert ret == expected, "Expecting: [%s], got [%s]" % (
+                expected, ret)
+
     def test_coverart_uuid(self):
         info_l = [
             {'artist': 'Antony & the Johnsons', 'album': 'The crying light'},
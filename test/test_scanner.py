@@ -1,9 +1,19 @@
 from __future__ import unicode_literals
 from nose import *
-from iposonic import Iposonic
-from iposonicdb import MySQLIposonicDB
+from iposonic import Iposonic, IposonicDB, IposonicException
+from iposonicdb import MySQLIposonicDB, SqliteIposonicDB
 import os
-from scanner import walk_music_folder, watch_music_folder
+import shutil
+import tempfile
+from os.path import join
+from mediamanager import MediaManager
+import scanner
+from scanner import walk_music_folder, watch_music_folder, walk_paths, DirectoryPoller, ScanPipeline, ProcessDir
+
+
+def kill_worker(item):
+    """Parse a file crashing the pool process."""
+    os._exit(1)
 
 
 def test_scanner_mysql():
@@ -38,3 +48,158 @@ def test_inotify_mysql():
     print ("albums: %s" % iposonic.get_albums())
 
     iposonic.db.end_db()
+
+
+class TestDirectoryPoller:
+    dbhandler = IposonicDB
+
+    def setup(self):
+        self.test_dir = os.getcwd() + "/test/data/"
+        self.tmp_dir = tempfile.mkdtemp()
+        self.music = join(self.tmp_dir, "music")
+        album = join(self.music, "artist", "album")
+        os.makedirs(album)
+        shutil.copy(join(self.test_dir, "mock_artist/mock_album/sample.ogg"), album)
+        self.iposonic = Iposonic([self.music], dbhandler=self.dbhandler,
+                                 recreate_db=True, tmp_dir=self.tmp_dir)
+        self.iposonic.db.init_db()
+        self.poller = DirectoryPoller(self.iposonic)
+        # add the directories as changed long ago
+        self.touch(join(self.music, "artist"), album)
+        self.iposonic.add_paths(walk_paths(self.iposonic))
+
+    def teardown(self):
+        self.iposonic.db.end_db()
+        shutil.rmtree(self.tmp_dir)
+
+    def touch(self, *paths):
+        for p in paths:
+            os.utime(p, (1000000, 1000000))
+
+    def song_paths(self):
+        return sorted([x['path'] for x in self.iposonic.db.get_songs()])
+
+    def test_poll(self):
+        album = join(self.music, "artist", "album")
+        song = join(album, "sample.ogg")
+        assert self.song_paths() == [song]
+        # unchanged directories are not listed
+        assert self.poller.poll() == 1
+
+        shutil.copy(song, join(album, "new.ogg"))
+        self.poller.poll()
+        assert self.song_paths() == [join(album, "new.ogg"), song]
+
+        os.unlink(song)
+        os.makedirs(join(self.music, "artist2", "album2"))
+        self.poller.poll()
+        assert self.song_paths() == [join(album, "new.ogg")]
+        assert join(self.music, "artist2", "album2") in [
+            x['path'] for x in self.iposonic.db.get_albums()]
+
+        # missing directories are deleted with their entries
+        shutil.rmtree(join(self.music, "artist"))
+        self.poller.poll()
+        assert not self.song_paths()
+        assert [x.get('name') for x in self.iposonic.db.get_artists()] == ['artist2']
+
+    def test_walk_paths(self):
+        ret = list(walk_paths(self.iposonic))
+        assert [(p, album) for (p, album, st) in ret] == [
+            (join(self.music, "artist"), False),
+            (join(self.music, "artist", "album"), True),
+            (join(self.music, "artist", "album", "sample.ogg"), False)], ret
+        # the walker stat is carried to add_paths
+        for (p, album, st) in ret:
+            assert MediaManager.get_fingerprint(p, st) == MediaManager.get_fingerprint(p)
+
+    def test_process_dir(self):
+        class Event(object):
+            def __init__(self, pathname, dir=False):
+                (self.pathname, self.dir) = (pathname, dir)
+
+        album = join(self.music, "artist", "album")
+        song = join(album, "sample.ogg")
+        handler = ProcessDir(self.iposonic, delay=0)
+        # a new album is copied: its files are found by walking it
+        album2 = join(self.music, "artist", "album2")
+        os.makedirs(album2)
+        for name in ["1.ogg", "2.ogg"]:
+            shutil.copy(song, join(album2, name))
+            handler.process_IN_CLOSE_WRITE(Event(join(album2, name)))
+        handler.process_IN_CREATE(Event(album2, dir=True))
+        shutil.copy(song, join(album, "3.ogg"))
+        handler.process_IN_CLOSE_WRITE(Event(join(album, "3.ogg")))
+        handler.process_IN_CLOSE_WRITE(Event(join(album, "cover.jpg")))
+        assert len(handler.pending) == 4
+        assert handler.is_due()
+        (added, deleted) = handler.flush()
+        assert len(added) == 4 and not deleted, added
+        assert len(self.song_paths()) == 4, self.song_paths()
+        assert not handler.pending
+
+        os.rename(join(album, "3.ogg"), join(album2, "3.ogg"))
+        handler.process_IN_MOVED_FROM(Event(join(album, "3.ogg")))
+        handler.process_IN_MOVED_TO(Event(join(album2, "3.ogg")))
+        shutil.rmtree(album)
+        handler.process_IN_DELETE(Event(song))
+        handler.process_IN_DELETE(Event(album, dir=True))
+        handler.flush()
+        assert self.song_paths() == [join(album2, x) for x in ["1.ogg", "2.ogg", "3.ogg"]]
+        assert album not in [x['path'] for x in self.iposonic.db.get_albums()]
+
+    def test_pipeline(self):
+        album = join(self.music, "artist", "album")
+        for i in range(5):
+            shutil.copy(join(album, "sample.ogg"), join(album, "%d.ogg" % i))
+        open(join(album, "broken.mp3"), "w").close()
+        ScanPipeline(self.iposonic, processes=2, queue_size=2).run()
+        assert len(self.song_paths()) == 6, self.song_paths()
+        song = self.iposonic.db.get_songs(query={'path': join(album, "0.ogg")})[0]
+        assert song['title'] == 'mock_title'
+        assert song.get('coverArt')
+
+    def test_pipeline_pool(self):
+        album = join(self.music, "artist", "album")
+        shutil.copy(join(album, "sample.ogg"), join(album, "0.ogg"))
+        pool = scanner.create_pool(2)
+        try:
+            ScanPipeline(self.iposonic, processes=2, pool=pool).run()
+            assert len(self.song_paths()) == 2, self.song_paths()
+            # the pool of the caller is not terminated
+            assert pool.map(abs, [-1]) == [1]
+        finally:
+            pool.terminate()
+            pool.join()
+        assert scanner.create_pool(1) is None
+
+    def test_pipeline_worker_dies(self):
+        album = join(self.music, "artist", "album")
+        for i in range(5):
+            shutil.copy(join(album, "sample.ogg"), join(album, "%d.ogg" % i))
+        parse_item = scanner.parse_item
+        scanner.parse_item = kill_worker
+        try:
+            ScanPipeline(self.iposonic, processes=2, timeout=1).run()
+            assert False, "a dead worker must fail the scan"
+        except IposonicException:
+            pass
+        finally:
+            scanner.parse_item = parse_item
+
+    def test_watch_without_pyinotify(self):
+        WatchManager = scanner.WatchManager
+        scanner.WatchManager = None
+        try:
+            watch_music_folder(self.iposonic)
+            assert False, "watching requires pyinotify"
+        except IposonicException:
+            pass
+        finally:
+            scanner.WatchManager = WatchManager
+
+
+class TestSqliteDirectoryPoller(TestDirectoryPoller):
+    def dbhandler(self, music_folders, datadir=None, **kwds):
+        return SqliteIposonicDB(music_folders, datadir=datadir,
+                                dbfile=join(datadir, "iposonic.db"), **kwds)
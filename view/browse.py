@@ -16,7 +16,7 @@ os.path.supports_unicode_filenames = True
 from flask import request, send_file
 from webapp import app, fs_cache
 from webapp import randomize2_list, randomize_list
-from iposonic import IposonicException, SubsonicProtocolException
+from iposonic import IposonicException, SubsonicProtocolException, SubsonicMissingParameterException
 import mediamanager
 from mediamanager import MediaManager
 from mediamanager.stringutils import isdir, to_unicode
@@ -78,23 +78,15 @@ def get_indexes_view():
         jsonp response
             ...
 
+        The indexes are kept up to date by the scanner: if nothing
+        changed since ifModifiedSince, only lastModified is returned.
+
         TODO implement @param musicFolderId
-        TODO implement @param ifModifiedSince
     """
-    (u, p, v, c, f, callback) = map(
-        request.args.get, ['u', 'p', 'v', 'c', 'f', 'callback'])
+    (u, p, v, c, f, callback, ifModifiedSince) = map(
+        request.args.get, ['u', 'p', 'v', 'c', 'f', 'callback', 'ifModifiedSince'])
 
-    # refresh indexes
-    import scanner
-    scanner.q.put("refresh")
-
-    #
-    # XXX we should think to reimplement the
-    #     DB in some consistent way before
-    #     wasting time with unsearchable, dict-based
-    #     data to format
-    #
-    return request.formatter({'indexes': app.iposonic.get_indexes()})
+    return request.formatter({'indexes': app.iposonic.get_indexes(ifModifiedSince)})
 
 
 @app.route("/rest/getArtists.view", methods=['GET', 'POST'])
@@ -132,16 +124,22 @@ def get_artists_view():
         </index>
     </artists>
     """
-    raise NotImplementedError()
+    (u, p, v, c, f, callback) = map(
+        request.args.get, ['u', 'p', 'v', 'c', 'f', 'callback'])
+    return request.formatter({'artists': app.iposonic.get_artists_index()})
 
 
-@app.route("/rest/getArtists.view", methods=['GET', 'POST'])
+@app.route("/rest/getArtist.view", methods=['GET', 'POST'])
 def get_artist_view():
     """
     <artist id="5432" name="AC/DC" coverArt="ar-5432" albumCount="15">
         <album id="11047" name="Back In Black" coverArt="al-11047" songCount="10" created="2004-11-08T23:33:11" duration="2534" artist="AC/DC" artistId="5432"/>
     """
-    raise NotImplementedError()
+    (u, p, v, c, f, callback, eid) = map(
+        request.args.get, ['u', 'p', 'v', 'c', 'f', 'callback', 'id'])
+    if not eid:
+        raise SubsonicMissingParameterException('id', 'get_artist_view')
+    return request.formatter({'artist': app.iposonic.get_artist(eid)})
 
 
 @app.route("/rest/getMusicDirectory.view", methods=['GET', 'POST'])
@@ -215,7 +213,7 @@ def get_music_directory_view():
     artist = app.iposonic.db.Artist(dir_path)
     #
     # if nothing changed before our last visit
-    #    or is a virtual path (eg. uniexistent)
+    #    or the path is missing (eg. removed)
     #    don't rescan
     #
     try:
@@ -223,10 +221,7 @@ def get_music_directory_view():
     except:
         last_modified = -1
 
-    if last_modified == -1:
-        print("Getting items from valbum.")
-        children = app.iposonic.get_songs(query={'albumId': dir_id})
-    elif fs_cache.get(dir_id, 0) == last_modified:
+    if last_modified == -1 or fs_cache.get(dir_id, 0) == last_modified:
         print("Getting items from cache.")
         children = app.iposonic.get_songs(query={'parent': dir_id})
         children.extend(app.iposonic.get_albums(query={'parent': dir_id}))
@@ -290,7 +285,7 @@ def get_music_directory_view():
         except:
             return 0
     # Sort songs by track id, if possible
-    children = sorted(children, key=_track_or_die)
+    children = sorted(app.iposonic.annotate(children, username=u), key=_track_or_die)
 
     return request.formatter(
         {'directory': {
@@ -4,7 +4,7 @@
 #
 import logging
 from flask import request
-from webapp import app, randomize2_list, randomize_list
+from webapp import app
 from iposonic import SubsonicMissingParameterException, SubsonicProtocolException, IposonicException
 from mediamanager import MediaManager, UnsupportedMediaError
 
@@ -52,7 +52,7 @@ def get_starred_view():
     (artistCount, albumCount, songCount) = map(
         request.args.get, ["artistCount", "albumCount", "songCount"])
 
-    ret = app.iposonic.get_starred(query, artistCount, albumCount, songCount)
+    ret = app.iposonic.get_starred(artistCount, albumCount, songCount, username=u)
     print("ret: %s" % ret)
     return request.formatter(
         {
@@ -73,15 +73,17 @@ def get_album_list_view():
 
         params:
            - type   in random,
-                    newest,     TODO
-                    highest,    TODO
+                    newest,
+                    highest,
                     frequent,   TODO
                     recent,     TODO
-                    starred,    TODO
-                    alphabeticalByName, TODO
-                    alphabeticalByArtist TODO
-           - size   items to return TODO
-           - offset paging offset   TODO
+                    starred,
+                    alphabeticalByName,
+                    alphabeticalByArtist
+           - size   items to return, max 500
+           - offset paging offset
+
+        Sorting and paging are done by the database.
 
         xml response:
             <albumList>
@@ -91,42 +93,36 @@ def get_album_list_view():
     """
     (u, p, v, c, f, callback, dir_id) = map(
         request.args.get, ['u', 'p', 'v', 'c', 'f', 'callback', 'id'])
-    (size, type_a, offset) = map(request.args.get, ['size', 'type', 'offset'])
+    (size, type_a, offset, musicFolderId) = map(
+        request.args.get, ['size', 'type', 'offset', 'musicFolderId'])
 
-    if not type_a in ['random', 'newest', 'highest', 'frequent', 'recent', 'starred']:
+    if not type_a in ['random', 'newest', 'highest', 'frequent', 'recent', 'starred',
+                      'alphabeticalByName', 'alphabeticalByArtist']:
         raise SubsonicProtocolException("Invalid or missing parameter: type")
 
     try:
-        size = int(size)
+        size = min(int(size), 500)
     except:
         size = 20
     try:
-        offset = int(offset)
+        offset = max(int(offset), 0)
     except:
         offset = 0
 
+    log.info("getting %s: %s,%s" % (type_a, offset, size))
     if type_a == 'random':
-        log.info("getting ", type_a)
-        albums = app.iposonic.get_albums()
-        albums = randomize2_list(albums, size)
-    elif type_a == 'highest':
-        log.info("getting ", type_a)
-        albums = app.iposonic.get_albums(
-            query={'userRating': 'notNull'}, order=('userRating', 1))
-    elif type_a == 'newest':
-        log.info("getting ", type_a)
-        albums = app.iposonic.get_albums(
-            query={'created': 'notNull'}, order=('created', 1))
+        albums = app.iposonic.get_random_albums(
+            size, musicFolderId=musicFolderId)
     elif type_a == 'starred':
-        log.info("getting ", type_a)
-        albums = app.iposonic.get_albums(query={'starred': 'notNull'})
+        albums = app.iposonic.get_starred_albums(offset, size, username=u)
+    elif type_a in ['frequent', 'recent']:
+        # TODO play counts are not tracked yet
+        albums = app.iposonic.get_albums(offset=offset, size=size)
     else:
-        # get all albums...hey, they may be a lot!
-        albums = [a for a in app.iposonic.get_albums()]
+        albums = app.iposonic.get_albums(
+            order=type_a, offset=offset, size=size)
 
-    last = min(offset + size, len(albums) - 1)
-    log.info("paging albums: %s,%s/%s" % (offset, last, len(albums)))
-    return request.formatter({'albumList': {'album': albums[offset:last]}})
+    return request.formatter({'albumList': {'album': albums}})
 
 
 @app.route("/rest/getRandomSongs.view", methods=['GET', 'POST'])
@@ -168,14 +164,15 @@ def get_random_songs_view():
     """
     (size, genre, fromYear, toYear, musicFolderId) = map(request.args.get,
                                                          ['size', 'genre', 'fromYear', 'toYear', 'musicFolderId'])
-    songs = []
+    try:
+        size = min(int(size), 500)
+    except:
+        size = 10
     if genre:
-        print("genre: %s" % genre)
-        songs = app.iposonic.get_genre_songs(genre.strip().lower())
-    else:
-        all_songs = app.iposonic.get_songs()
-        assert all_songs
-        songs = randomize2_list(all_songs)
+        genre = genre.strip()
+    songs = app.iposonic.get_random_songs(
+        size, genre=genre, fromYear=fromYear, toYear=toYear,
+        musicFolderId=musicFolderId)
 
     # add cover art
     songs = [x.update({'coverArt': x.get('id')}) or x for x in songs]
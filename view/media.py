@@ -153,11 +153,7 @@ def set_rating_view():
     if not eid:
         raise SubsonicMissingParameterException(
             'id', sys._getframe().f_code.co_name)
-    rating = int(rating)
-    app.iposonic.update_entry(eid, {'userRating': rating})
-    if rating == 5:
-        app.iposonic.update_entry(
-            eid, {'starred': time.strftime("%Y-%m-%dT%H:%M:%S")})
+    app.iposonic.set_rating(eid, rating, username=u)
     return request.formatter({})
 
 
@@ -169,23 +165,7 @@ def star_view():
     if not eid:
         raise SubsonicMissingParameterException(
             'id', sys._getframe().f_code.co_name)
-    app.iposonic.update_entry(
-        eid, {'starred': time.strftime("%Y-%m-%dT%H:%M:%S")})
-
-    # XXX example code to be added to Iposonic
-    # for managing user-based media tagging
-    # like starred.
-    # Going this way may need to really choiche ONE db
-    # because we'll multiply data (eg. #items x #users)
-    #usermedia = app.iposonic.db.UserMedia('mock_user', eid)
-    #usermedia.update( {
-    #    'starred': time.strftime("%Y-%m-%dT%H:%M:%S"),
-    #    'eid': "%s:%s" % ('mock',eid),
-    #    'mid' : eid,
-    #    'uid' : 'mock'
-    #    } )
-    app.iposonic.create_entry(usermedia)
-
+    app.iposonic.star(eid, username=u)
     return request.formatter({})
 
 
@@ -197,7 +177,7 @@ def unstar_view():
     if not eid:
         raise SubsonicMissingParameterException(
             'id', sys._getframe().f_code.co_name)
-    app.iposonic.update_entry(eid, {'starred': None})
+    app.iposonic.unstar(eid, username=u)
     return request.formatter({})
 
 
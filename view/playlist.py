@@ -92,11 +92,11 @@ def get_playlist_view():
     # use default playlists
     if eid == MediaManager.uuid('starred'):
         j_playlist = app.iposonic.get_playlists_static(eid=eid)
-        songs = app.iposonic.get_starred().get('title')
+        songs = app.iposonic.get_starred(username=u).get('title')
         entries = randomize2_list(songs, 5)
     elif eid in [x.get('id') for x in app.iposonic.get_playlists_static()]:
         j_playlist = app.iposonic.get_playlists_static(eid=eid)
-        entries = randomize2_list(app.iposonic.get_songs())
+        entries = app.iposonic.get_random_songs(20)
     else:
         playlist = app.iposonic.get_playlists(eid=eid)
         assert playlist, "Playlists: %s" % app.iposonic.db.playlists
@@ -149,6 +149,7 @@ def create_playlist_view():
             pass
         # TODO DAO should not be exposed
         playlist = app.iposonic.db.Playlist(name)
+        playlist.update(get_playlist_totals(songId_l))
         playlist.update({'entry': ",".join(songId_l)})
         app.iposonic.create_entry(playlist)
 
@@ -156,12 +157,25 @@ def create_playlist_view():
     else:
         playlist = app.iposonic.get_playlists(eid=playlistId)
         assert playlist
-        songs = playlist.get('entry')
-        songs += ",".join(songId_l)
-        app.iposonic.update_entry(eid=playlistId, new={'entry': songs})
+        songs = [x for x in (playlist.get('entry') or "").split(",") if x]
+        songs += songId_l
+        new = get_playlist_totals(songs)
+        new.update({'entry': ",".join(songs)})
+        app.iposonic.update_entry(eid=playlistId, new=new)
     return request.formatter({'status': 'ok'})
 
 
+def get_playlist_totals(song_ids):
+    """Return songCount and duration of a playlist, stored with it
+        so that getPlaylists doesn't read the songs.
+    """
+    songs = app.iposonic.get_song_list(song_ids)
+    return {
+        'songCount': len(songs),
+        'duration': sum([x.get('duration') or 0 for x in songs])
+    }
+
+
 @app.route("/rest/deletePlaylist.view", methods=['GET', 'POST'])
 def delete_playlist_view():
     """TODO move to app.iposonic
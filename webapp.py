@@ -79,6 +79,7 @@ def ping_view():
     log.warn("songs: %s" % len(iposonic.db.get_songs()))
     log.warn("albums: %s" % len(iposonic.db.get_albums()))
     log.warn("artists: %s" % len(iposonic.db.get_artists()))
+    log.warn("cache: %s" % iposonic.cache.stats())
     #log.warn("indexes: %s" % iposonic.db.get_indexes())
     #log.warn("playlists: %s" % iposonic.db.get_playlists())
 